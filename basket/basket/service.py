@@ -1,8 +1,10 @@
 import logging
 from nameko.events import event_handler, EventDispatcher
 from nameko.rpc import rpc
+from nameko.web.handlers import http
 from nameko_redis import Redis
 from .exceptions import NotFound
+from .metrics import Metrics, metrics_response, instrument_redis
 from datetime import datetime as dt
 import json
 
@@ -12,6 +14,8 @@ from .models import *
 
 logger = logging.getLogger(__name__)
 
+instrument_redis()
+
 
 BASKET_SERVICE = 'basket_service'
 ORDERS_SERVICE = 'command_orders'
@@ -22,6 +26,12 @@ class BasketService:
     dispatch = EventDispatcher()
 
     redis = Redis('development')
+    metrics = Metrics()
+
+    @http('GET', '/metrics')
+    def get_metrics(self, request):
+        """ latency, error and worker saturation metrics of every service in this process """
+        return metrics_response()
 
     @rpc
     def get_basket_by_id(self, buyer_id):
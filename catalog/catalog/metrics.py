@@ -0,0 +1,227 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from nameko.extensions import DependencyProvider
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry(object):
+    """
+    Process wide store for metrics, rendered in the prometheus text exposition format.
+
+    Every service container running in the process records into the same registry so a
+    single /metrics endpoint exposes all of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def add_gauge(self, name, amount, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = list(labels) + sorted(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f'{name}{self._labels(labels)} {value}')
+
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f'{name}{self._labels(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                # counts are already cumulative, observe() increments every bucket the value fits in
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{self._labels(labels, le=bound)} {count}')
+                lines.append(f'{name}_bucket{self._labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsRecorder(object):
+    """ handed to service methods through the Metrics dependency """
+
+    def __init__(self, service_name, registry=REGISTRY):
+        self.service_name = service_name
+        self.registry = registry
+
+    def observe(self, name, value, **labels):
+        self.registry.observe(name, value, service=self.service_name, **labels)
+
+    def inc(self, name, amount=1, **labels):
+        self.registry.inc(name, amount, service=self.service_name, **labels)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+
+class Metrics(DependencyProvider):
+    """
+    Records per entrypoint latency, error counts and the number of busy workers
+    against max_workers for the service it is declared on.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self._started = {}
+
+    def setup(self):
+        self.registry.set_gauge('nameko_max_workers', self.container.max_workers,
+                                service=self.container.service_name)
+        self.registry.set_gauge('nameko_workers_busy', 0, service=self.container.service_name)
+
+    def worker_setup(self, worker_ctx):
+        self._started[worker_ctx] = time.perf_counter()
+        self.registry.add_gauge('nameko_workers_busy', 1, service=worker_ctx.service_name)
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        started = self._started.pop(worker_ctx, None)
+        labels = dict(service=worker_ctx.service_name, entrypoint=worker_ctx.entrypoint.method_name)
+
+        self.registry.add_gauge('nameko_workers_busy', -1, service=worker_ctx.service_name)
+
+        if started is not None:
+            self.registry.observe('nameko_entrypoint_duration_seconds', time.perf_counter() - started, **labels)
+
+        if exc_info is not None:
+            self.registry.inc('nameko_entrypoint_errors_total', error=exc_info[0].__name__, **labels)
+
+    def get_dependency(self, worker_ctx):
+        return MetricsRecorder(worker_ctx.service_name, self.registry)
+
+
+def metrics_response(registry=REGISTRY):
+    """ response for an @http('GET', '/metrics') entrypoint """
+    return 200, {'Content-Type': CONTENT_TYPE}, registry.render()
+
+
+def instrument_sqlalchemy(registry=REGISTRY):
+    """ times every statement executed by any engine in the process, labelled by statement type """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    def operation_of(statement):
+        return statement.lstrip().split(' ', 1)[0].lower()
+
+    # the start time lives on the statement's execution context, a failed statement leaves nothing
+    # behind on the pooled connection
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_metrics_started', None)
+        if started is not None:
+            registry.observe('db_query_duration_seconds', time.perf_counter() - started,
+                             operation=operation_of(statement))
+
+    @event.listens_for(Engine, 'handle_error')
+    def handle_error(exception_context):
+        if exception_context.statement:
+            registry.inc('db_query_errors_total', operation=operation_of(exception_context.statement))
+
+
+def instrument_pymongo(registry=REGISTRY):
+    """
+    times every mongo command, labelled by command name.
+
+    pymongo only applies listeners to clients created afterwards, so this has to run before connect()
+    """
+    from pymongo import monitoring
+
+    class CommandTimer(monitoring.CommandListener):
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            registry.observe('mongo_command_duration_seconds', event.duration_micros / 1e6,
+                             command=event.command_name)
+
+        def failed(self, event):
+            registry.observe('mongo_command_duration_seconds', event.duration_micros / 1e6,
+                             command=event.command_name)
+            registry.inc('mongo_command_errors_total', command=event.command_name)
+
+    monitoring.register(CommandTimer())
+
+
+def instrument_redis(registry=REGISTRY):
+    """ times every redis command issued by any client in the process, labelled by command name """
+    import redis
+
+    execute_command = redis.StrictRedis.execute_command
+
+    def timed_execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return execute_command(self, *args, **options)
+        finally:
+            registry.observe('redis_command_duration_seconds', time.perf_counter() - started,
+                             command=str(args[0]).lower())
+
+    redis.StrictRedis.execute_command = timed_execute_command
@@ -9,6 +9,7 @@ from sqlalchemy import (
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import random
+from .metrics import instrument_sqlalchemy, instrument_pymongo
 
 
 class Base(object):
@@ -33,6 +34,12 @@ class ProductBrand(DeclarativeBase):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
 
+    # bumped by every update of the row, replication events carry it so the query side
+    # can drop changes older than the ones it already holds
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
 
 class Product(DeclarativeBase):
     __tablename__ = 'products'
@@ -52,6 +59,10 @@ class Product(DeclarativeBase):
 
     attributes = Column(JSONB, nullable=True)
 
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
     def remove_stock(self, quantity_desired):
         """ decreements the quantity of an item from inventory"""
 
@@ -89,6 +100,10 @@ class Product(DeclarativeBase):
         return self.available_stock - original
 
 
+# listeners only attach to clients created afterwards, so instrument before connecting
+instrument_sqlalchemy()
+instrument_pymongo()
+
 connect(os.getenv('MONGO_DATABASE', 'products'),
         host=os.environ.get('MONGO_HOST', '127.0.0.1'),
         port=int(os.environ.get('MONGO_PORT', 27017)))
@@ -99,6 +114,7 @@ class QueryBrandModel(Document):
     name = StringField()
     created_at = StringField()
     updated_at = StringField()
+    version = IntField()
 
 
 class QueryProductsModel(Document):
@@ -113,5 +129,6 @@ class QueryProductsModel(Document):
     product_brand_id = IntField()
     product_brand = StringField()
     attributes = DictField()
+    version = IntField()
 
 
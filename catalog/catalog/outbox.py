@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import uuid
+from datetime import date, datetime as dt
+from decimal import Decimal
+
+from nameko.extensions import DependencyProvider
+from sqlalchemy import BigInteger, Column, Index, String, Text, func
+
+from .models import DeclarativeBase
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 500))
+# events are relayed by the worker which committed them, the timer only sweeps up what a failed relay left behind
+OUTBOX_RELAY_INTERVAL = float(os.getenv('OUTBOX_RELAY_INTERVAL', 5))
+
+
+class OutboxMessage(DeclarativeBase):
+    """ an event committed in the same transaction as the change it announces, waiting to be published """
+    __tablename__ = 'outbox'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    # the service the event is published as, handlers subscribe by source service and event type
+    source = Column(String, nullable=False)
+    event_type = Column(String, nullable=False)
+    # events of the same aggregate are published in the order they were written
+    aggregate_id = Column(String, nullable=True)
+    payload = Column(Text, nullable=False)
+
+    __table_args__ = Index('ix_outbox_source_id', 'source', 'id'),
+
+
+def _encode(value):
+    """ the same conversions the kombu json serializer applies to event payloads """
+    if isinstance(value, (dt, date)):
+        return value.isoformat()
+    if isinstance(value, (Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class Outbox(DependencyProvider):
+    """
+    Used in place of EventDispatcher on the request path.
+
+    self.outbox(event_type, payload, aggregate_id) adds the event to the worker's database session,
+    so it is committed, or rolled back, together with the change it announces. Once a worker
+    which wrote events succeeds they are relayed on the same worker, after its result was sent,
+    so handlers don't wait on the broker and the next saga step doesn't wait for the relay timer.
+    Events a relay fails to publish stay in the outbox for the timer to sweep up.
+    """
+
+    def __init__(self, session='db', dispatcher='dispatch'):
+        self.session = session
+        self.dispatcher = dispatcher
+        self._written = {}
+
+    def get_dependency(self, worker_ctx):
+        source = worker_ctx.service_name
+
+        def add(event_type, payload, aggregate_id=None):
+            # looked up on every call, the session may be injected after this dependency
+            session = getattr(worker_ctx.service, self.session)
+            session.add(OutboxMessage(source=source,
+                                      event_type=event_type,
+                                      aggregate_id=None if aggregate_id is None else str(aggregate_id),
+                                      payload=json.dumps(payload, default=_encode)))
+            self._written[worker_ctx] = True
+
+        return add
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        if not self._written.pop(worker_ctx, False) or exc_info is not None:
+            return
+
+        session = getattr(worker_ctx.service, self.session)
+        try:
+            # whatever the worker left uncommitted is not announced
+            session.rollback()
+            relay(session, worker_ctx.service_name, getattr(worker_ctx.service, self.dispatcher))
+        except Exception as e:
+            session.rollback()
+            logger.error(f'{dt.utcnow()}: Unable to relay {worker_ctx.service_name} events, '
+                         f'the outbox sweep will retry: {e}')
+
+    def worker_teardown(self, worker_ctx):
+        self._written.pop(worker_ctx, None)
+
+
+def _publishable(session, source, messages):
+    """
+    Drops the events of aggregates which have an earlier event locked by another relay,
+    that relay has to publish it first
+    :param session:
+    :param source:
+    :param messages: locked events, in id order
+    :return:
+    """
+    held = {}
+    for message in messages:
+        held.setdefault(message.aggregate_id, message.id)
+
+    aggregates = [aggregate_id for aggregate_id in held if aggregate_id is not None]
+    if not aggregates:
+        return messages
+
+    first_pending = dict(session.query(OutboxMessage.aggregate_id, func.min(OutboxMessage.id))
+                         .filter(OutboxMessage.source == source, OutboxMessage.aggregate_id.in_(aggregates))
+                         .group_by(OutboxMessage.aggregate_id))
+
+    return [message for message in messages
+            if message.aggregate_id is None or first_pending[message.aggregate_id] == held[message.aggregate_id]]
+
+
+def relay(session, source, dispatch, batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Publishes the pending events of source in batches of batch_size, oldest first, until a batch
+    comes back short. Rows are locked with SKIP LOCKED so every replica of the service can relay
+    at the same time without publishing an event twice, and deleted in the transaction that
+    published them. Publishing stops at the first failure so no event overtakes an earlier one
+    of its aggregate, the rest are retried on the next run.
+    :param session: database session of the service
+    :param source: service name the events were written by
+    :param dispatch: EventDispatcher of that service
+    :param batch_size:
+    :return: number of events published
+    """
+    count = 0
+
+    while True:
+        messages = session.query(OutboxMessage) \
+            .filter(OutboxMessage.source == source) \
+            .order_by(OutboxMessage.id) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True) \
+            .all()
+
+        published = []
+        try:
+            for message in _publishable(session, source, messages):
+                dispatch(message.event_type, json.loads(message.payload))
+                published.append(message.id)
+        finally:
+            if published:
+                session.query(OutboxMessage) \
+                    .filter(OutboxMessage.id.in_(published)) \
+                    .delete(synchronize_session=False)
+            session.commit()
+
+        count += len(published)
+
+        if len(messages) < batch_size or not published:
+            break
+
+    if count:
+        logger.info(f'{dt.utcnow()}: {count} {source} events published from the outbox')
+
+    return count
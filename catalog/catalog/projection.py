@@ -0,0 +1,116 @@
+import os
+from collections import namedtuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+# write concern for projection writes, 0 is unacknowledged: fastest, but a failed write is never reported
+_write_concern = os.getenv('PROJECTION_WRITE_CONCERN', '1')
+PROJECTION_WRITE_CONCERN = WriteConcern(w=int(_write_concern) if _write_concern.isdigit() else _write_concern)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class Projection(namedtuple('Projection', ['fields', 'on_insert', 'set_once', 'version'])):
+    """
+    What one replicated record writes to its query model.
+
+    fields are set on every change and on_insert only when the record is created. When a version
+    is given the fields are only written if the stored version is older, while set_once, values
+    which never change after creation, are written whatever the version so a change which
+    overtook the creation event can't leave them missing.
+    """
+
+    def __new__(cls, fields, on_insert=None, set_once=None, version=None):
+        return super(Projection, cls).__new__(cls, fields, on_insert or {}, set_once or {}, version)
+
+
+def to_mongo(model, values):
+    """
+    Converts {field name: value} into {db field: mongo value} for the model, names which
+    aren't fields of the model are dropped
+    :param model:
+    :param values:
+    :return:
+    """
+    document = {}
+
+    for name, value in values.items():
+        field = model._fields.get(name)
+
+        if field is None or field.primary_key:
+            continue
+
+        document[field.db_field] = None if value is None else field.to_mongo(value)
+
+    return document
+
+
+def upsert_operations(model, id, projection):
+    """
+    bulk_write operations which create or update the projected record
+    :param model: mongoengine document class
+    :param id: primary key of the record
+    :param projection:
+    :return:
+    """
+    fields = dict(projection.fields)
+    on_insert = dict(projection.on_insert)
+
+    if projection.version is None:
+        fields.update(projection.set_once)
+    else:
+        fields['version'] = projection.version
+        on_insert.update(projection.set_once)
+
+    update = {'$set': to_mongo(model, fields)}
+
+    insert_only = {name: value for name, value in on_insert.items() if name not in fields}
+    if insert_only:
+        update['$setOnInsert'] = to_mongo(model, insert_only)
+
+    if projection.version is None:
+        return [UpdateOne({'_id': id}, update, upsert=True)]
+
+    # when a newer version is stored the filter misses and the upsert collides with the
+    # existing _id, bulk_upsert treats that duplicate key error as a skipped stale write
+    operations = [UpdateOne({'_id': id, 'version': {'$not': {'$gte': projection.version}}}, update, upsert=True)]
+
+    if projection.set_once:
+        operations.append(UpdateOne({'_id': id}, {'$set': to_mongo(model, projection.set_once)}))
+
+    return operations
+
+
+def _is_stale_write(error):
+    return error['code'] == DUPLICATE_KEY_ERROR and 'version' in error.get('op', {}).get('q', {})
+
+
+def bulk_upsert(model, operations, write_concern=PROJECTION_WRITE_CONCERN):
+    """
+    Applies upsert operations in one round trip, unordered so a failing record doesn't stop the
+    rest. The order operations are applied in isn't guaranteed
+    :param model:
+    :param operations:
+    :param write_concern:
+    :return:
+    """
+    collection = model._get_collection().with_options(write_concern=write_concern)
+
+    # a versioned upsert also collides when another worker inserted the same record first, so the
+    # colliding writes are retried once: now that the record exists only really stale ones collide again
+    for attempt in range(2):
+        if not operations:
+            return
+
+        try:
+            collection.bulk_write(operations, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+
+            if e.details.get('writeConcernErrors') or not all(_is_stale_write(error) for error in errors):
+                raise
+
+            operations = [operations[error['index']] for error in errors]
@@ -3,11 +3,17 @@ from random import randint
 
 from nameko.events import EventDispatcher, event_handler
 from nameko.rpc import rpc
+from nameko.web.handlers import http
 from nameko.timer import timer
 from nameko_sqlalchemy import DatabaseSession
-from sqlalchemy import Sequence
-from .exceptions import NotFound
+from sqlalchemy import Sequence, text
+from .batching import batch_event_handler, apply_batch
+from .exceptions import InvalidCursor, NotFound
+from .metrics import Metrics, metrics_response
 from .models import *
+from .outbox import OUTBOX_RELAY_INTERVAL, Outbox, relay
+from .pagination import keyset_page, ndjson_page, get_by_ids
+from .projection import Projection
 
 import json
 
@@ -24,17 +30,39 @@ BRANDS_QUERY_SERVICE = 'query_brands'
 PRODUCTS_COMMAND_SERVICE = 'command_products'
 PRODUCTS_QUERY_SERVICE = 'query_products'
 
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+
+# replicated product fields which overwrite the projection, created_at is only written on insert
+PRODUCT_FIELDS = ('name', 'description', 'price', 'product_brand_id', 'updated_at', 'discontinued', 'attributes')
+
 
 class CommandBrands:
     name = BRANDS_COMMAND_SERVICE
     dispatch = EventDispatcher()
+    outbox = Outbox()
     db = DatabaseSession(DeclarativeBase)
+    metrics = Metrics()
 
     def fire_replicate_db_event(self, data):
         """ fires off a replication event,
         this expose the event-sourcing pattern which will send the
-        record to the query database from the command database """
-        self.dispatch(REPLICATE_EVENT, data)
+        record to the query database from the command database.
+        The event goes through the outbox, it is published once the transaction commits """
+        self.outbox(REPLICATE_EVENT, data, aggregate_id=data['id'])
+
+    @timer(interval=OUTBOX_RELAY_INTERVAL)
+    def relay_outbox(self):
+        """ publishes the committed events the worker which wrote them failed to relay """
+        relay(self.db, self.name, self.dispatch)
+
+    @staticmethod
+    def _brand_document(brand):
+        """ the whole brand as replicated, every event carries all fields so they can be applied in any order """
+        return {'id': brand.id,
+                'version': brand.version,
+                'name': brand.name,
+                'created_at': brand.created_at,
+                'updated_at': brand.updated_at}
 
     @rpc
     def add(self, payload):
@@ -48,13 +76,14 @@ class CommandBrands:
         item.name = name
 
         self.db.add(item)
-        self.db.commit()
+        self.db.flush()
 
         payload['id'] = item.id
         payload['updated_at'] = item.updated_at
         payload['created_at'] = item.created_at
 
-        self.fire_replicate_db_event(payload)
+        self.fire_replicate_db_event(self._brand_document(item))
+        self.db.commit()
 
         return payload
 
@@ -69,13 +98,14 @@ class CommandBrands:
         brand.updated_at = datetime.datetime.utcnow()
 
         self.db.add(brand)
-        self.db.commit()
+        self.db.flush()
 
         payload['id'] = brand.id
         payload['created_at'] = brand.created_at
         payload['updated_at'] = brand.updated_at
 
-        self.fire_replicate_db_event(payload)
+        self.fire_replicate_db_event(self._brand_document(brand))
+        self.db.commit()
 
         return payload
 
@@ -88,27 +118,22 @@ class CommandBrands:
 
 class QueryBrands:
     name = BRANDS_QUERY_SERVICE  # this is the service name
+    metrics = Metrics()
 
-    @event_handler(BRANDS_COMMAND_SERVICE, REPLICATE_EVENT)
-    def normalize_db(self, data):
+    @batch_event_handler(BRANDS_COMMAND_SERVICE, REPLICATE_EVENT)
+    def normalize_db(self, payloads):
+        """ writes a batch of replicated brands with one bulk upsert, raising requeues the batch """
         try:
-            brand = QueryBrandModel.objects.get(
-                id=data['id']
-            )
-            brand.update(
-                name=data.get('name', brand.name),
-                updated_at=data.get('updated_at', brand.updated_at)
-            )
-            brand.reload()
-        except mongoengine.DoesNotExist:
-            QueryBrandModel(
-                id=data['id'],
-                name=data['name'],
-                created_at=data['created_at'],
-                updated_at=data['updated_at']
-            ).save()
+            apply_batch(QueryBrandModel, payloads, self._projection)
         except Exception as e:
-            return e
+            logger.error(f'There was an error replicating brands to the QueryDB: {e}')
+            raise
+
+    @staticmethod
+    def _projection(data):
+        return Projection({name: data[name] for name in ('name', 'updated_at') if name in data},
+                          on_insert={'created_at': data.get('created_at')},
+                          version=data.get('version'))
 
     @rpc
     def get(self, id):
@@ -121,13 +146,12 @@ class QueryBrands:
             return e
 
     @rpc
-    def list(self, num_page, limit):
+    def list(self, after=None, limit=None):
+        """ returns a page of brands, pass the next_cursor of a page as after to get the next one"""
         try:
-            if not num_page:
-                num_page = 1
-            offset = (num_page - 1) * limit
-            brands = QueryBrandModel.objects  # .skip(offset).limit(limit)
-            return brands.to_json()
+            return keyset_page(QueryBrandModel.objects, after, limit)
+        except InvalidCursor:
+            raise
         except Exception as e:
             return e
 
@@ -135,14 +159,36 @@ class QueryBrands:
 class CommandCatalog:
     name = PRODUCTS_COMMAND_SERVICE
     dispatch = EventDispatcher()
+    outbox = Outbox()
     db = DatabaseSession(DeclarativeBase)
+    metrics = Metrics()
 
     def fire_replicate_db_event(self, data):
-        self.dispatch(REPLICATE_EVENT, data)
-
-
+        """ adds a replication event to the outbox, imports replicate a list of products without an aggregate """
+        self.outbox(REPLICATE_EVENT, data, aggregate_id=None if isinstance(data, list) else data['id'])
 
+    @timer(interval=OUTBOX_RELAY_INTERVAL)
+    def relay_outbox(self):
+        """ publishes the committed events the worker which wrote them failed to relay """
+        relay(self.db, self.name, self.dispatch)
 
+    @staticmethod
+    def _product_document(product):
+        """
+        The whole product as replicated. Updates and deletes send every field too, the query side
+        only keeps the newest version so a partial change arriving late can't be half applied
+        """
+        return {'id': product.id,
+                'version': product.version,
+                'name': product.name,
+                'description': product.description,
+                'price': float(product.price) if product.price is not None else None,
+                'product_brand_id': product.product_brand_id,
+                'sku': str(product.sku),
+                'discontinued': product.discontinued,
+                'attributes': product.attributes,
+                'created_at': product.created_at,
+                'updated_at': product.updated_at}
 
     @rpc
     def add_product(self, data):
@@ -173,16 +219,16 @@ class CommandCatalog:
             product.attributes = data['attributes']
 
             self.db.add(product)
-            self.db.commit()
+            self.db.flush()
 
             data['id'] = product.id
             data['created_at'] = product.created_at
             data['updated_at'] = product.updated_at
 
-            self.fire_replicate_db_event(data)
+            self.fire_replicate_db_event(self._product_document(product))
+            self.outbox('product_added', {'product_id': data['id']}, aggregate_id=data['id'])
 
-            # TODO: Need to review this placement
-            self.dispatch('product_added', {'product_id':data['id']})
+            self.db.commit()
 
             return data
         except Exception as e:
@@ -190,6 +236,107 @@ class CommandCatalog:
             logger.error(f'{datetime.datetime.utcnow()}: There was an error saving this product: {e}')
             return e
 
+    @rpc
+    def import_products(self, rows):
+        """
+        Bulk version of add_product used by the catalog import.
+
+        Brands are resolved once per chunk, products are written with one multi-row insert and
+        one commit per chunk, and each chunk fans out a single replication event and a single
+        product_added event carrying every new product id. Rows that fail validation are
+        reported back by their index and do not stop the rest of the import.
+        :param rows: list of product payloads
+        :return: {'ids': [{'index', 'id'}], 'errors': [{'index', 'error'}]}
+        """
+        if isinstance(rows, str):
+            rows = json.loads(rows)
+
+        ids = []
+        errors = []
+
+        for start in range(0, len(rows), IMPORT_BATCH_SIZE):
+            chunk = list(enumerate(rows[start:start + IMPORT_BATCH_SIZE], start))
+
+            # a failed chunk reports every row once with the failure, not also what was checked before it
+            chunk_errors = []
+
+            try:
+                self._import_chunk(chunk, ids, chunk_errors)
+            except Exception as e:
+                self.db.rollback()
+                logger.error(f'{datetime.datetime.utcnow()}: Unable to import products {start} to '
+                             f'{start + len(chunk) - 1}: {e}')
+                chunk_errors = [{'index': index, 'error': str(e)} for index, _ in chunk]
+
+            errors.extend(chunk_errors)
+
+        return {'ids': ids, 'errors': errors}
+
+    def _import_chunk(self, chunk, ids, errors):
+        checked = []
+        for index, data in chunk:
+            try:
+                if not isinstance(data, dict):
+                    raise ValueError('Product must be an object')
+
+                missing = [field for field in ('name', 'sku', 'price', 'product_brand_id')
+                           if data.get(field) in (None, '')]
+                if missing:
+                    raise ValueError(f'Missing required fields: {", ".join(missing)}')
+
+                try:
+                    brand_id = int(data['product_brand_id'])
+                except (TypeError, ValueError):
+                    raise ValueError('product_brand_id must be an integer')
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+                continue
+
+            checked.append((index, data, brand_id))
+
+        if not checked:
+            return
+
+        brand_ids = {brand_id for _, _, brand_id in checked}
+        brands = {id for (id,) in self.db.query(ProductBrand.id).filter(ProductBrand.id.in_(brand_ids))}
+
+        valid = []
+        for index, data, brand_id in checked:
+            if brand_id not in brands:
+                errors.append({'index': index, 'error': 'Brand not found, cannot add product.'})
+            else:
+                valid.append((index, dict(data, product_brand_id=brand_id)))
+
+        if not valid:
+            return
+
+        now = datetime.datetime.utcnow()
+
+        # one round trip for all of the chunk's ids, so rows and ids line up without relying on RETURNING order
+        product_ids = [id for (id,) in self.db.execute(
+            text("select nextval('products_id_seq') from generate_series(1, :count)"), {'count': len(valid)})]
+
+        product_rows = [{'id': id,
+                         'name': data['name'],
+                         'description': data.get('description'),
+                         'price': data['price'],
+                         'product_brand_id': data['product_brand_id'],
+                         'sku': str(data['sku']),
+                         'attributes': data.get('attributes'),
+                         'discontinued': False,
+                         'version': 1,
+                         'created_at': now,
+                         'updated_at': now} for id, (_, data) in zip(product_ids, valid)]
+
+        self.db.execute(Product.__table__.insert().values(product_rows))
+
+        self.fire_replicate_db_event(product_rows)
+        self.outbox('product_added', {'product_ids': product_ids})
+
+        self.db.commit()
+
+        ids.extend({'index': index, 'id': id} for id, (index, _) in zip(product_ids, valid))
+
     @rpc
     def update_product(self, payload):
 
@@ -212,13 +359,13 @@ class CommandCatalog:
         product.attributes = payload.get('attributes')
 
         self.db.add(product)
-        self.db.commit()
+        self.db.flush()
 
         payload['updated_at'] = product.updated_at
+        payload['version'] = product.version
 
-        # d#ata = ProductSchema().dump(product).data
-
-        self.fire_replicate_db_event(payload)
+        self.fire_replicate_db_event(self._product_document(product))
+        self.db.commit()
 
         return payload
 
@@ -230,13 +377,10 @@ class CommandCatalog:
         product.updated_at = datetime.datetime.utcnow()
 
         self.db.add(product)
-        self.db.commit()
-
-        data = {'id':id,
-                'discontinued':product.discontinued,
-                'updated_at':product.updated_at}
+        self.db.flush()
 
-        self.fire_replicate_db_event(data)
+        self.fire_replicate_db_event(self._product_document(product))
+        self.db.commit()
 
     #@event_handler(ORDERS_SERVICE, 'order_status_changed_to_paid')
     def handle_order_status_changed_paid(self, payload):
@@ -331,57 +475,49 @@ class CommandCatalog:
 
 class QueryProducts:
     name = PRODUCTS_QUERY_SERVICE
+    metrics = Metrics()
 
+    @http('GET', '/metrics')
+    def get_metrics(self, request):
+        """ latency, error and worker saturation metrics of every service in this process """
+        return metrics_response()
 
-    @event_handler(PRODUCTS_COMMAND_SERVICE, REPLICATE_EVENT)
-    def normalize_db(self, data):
+    @batch_event_handler(PRODUCTS_COMMAND_SERVICE, REPLICATE_EVENT)
+    def normalize_db(self, payloads):
+        """
+        writes a batch of replicated products with one bulk upsert, bulk imports replicate
+        a whole chunk of products with one event. Raising requeues the batch
+        """
         try:
-            product = QueryProductsModel.objects.get(id=data['id'])
-
-            product.update(
-                name=data.get('name', product.name),
-                description=data.get('description', product.description),
-                price=data.get('price', product.price),
-                product_brand_id=data.get('product_brand_id', product.product_brand_id),
-                updated_at=data.get('updated_at', product.updated_at),
-                sku=str(data.get('sku', product.sku)),
-                discontinued=data.get('discontinued', product.discontinued),
-                attributes=data.get('attributes', product.attributes)
-            )
-            product.reload()
-            logger.info('Product Updated')
-        except mongoengine.DoesNotExist:
-            logger.info('Creating a new product in Query DB')
-
-            QueryProductsModel(
-                id=data['id'],
-                name=data['name'],
-                description=data['description'],
-                price=data['price'],
-                product_brand_id=data['product_brand_id'],
-                created_at=data['created_at'],
-                updated_at=data['updated_at'],
-                sku=str(data['sku']),
-                attributes=data.get('attributes'),
-                discontinued=data.get('discontinued')
-            ).save()
-            logger.info('Product Added')
+            count = apply_batch(QueryProductsModel, payloads, self._projection)
+            logger.info(f'{count} Products Replicated')
         except Exception as e:
             logger.info(f'There was an error updating products in the QueryDB: {e}')
-            return e
+            raise
+
+    @staticmethod
+    def _projection(data):
+        fields = {name: data[name] for name in PRODUCT_FIELDS if name in data}
+        if 'sku' in data:
+            fields['sku'] = str(data['sku'])
+
+        return Projection(fields, on_insert={'created_at': data.get('created_at')}, version=data.get('version'))
 
     @rpc
-    def list(self, num_page, limit):
-        """ returns all the products requested"""
+    def list(self, after=None, limit=None):
+        """ returns a page of products, pass the next_cursor of a page as after to get the next one"""
         try:
-            if not num_page:
-                num_page = 1
-            offset = (num_page - 1) * limit
-            products = QueryProductsModel.objects  # .skip(offset).limit(limit)
-            return products.to_json()
+            return keyset_page(QueryProductsModel.objects, after, limit)
+        except InvalidCursor:
+            raise
         except Exception as e:
             return e
 
+    @rpc
+    def list_ndjson(self, after=None, limit=None):
+        """ returns a chunk of products as ndjson rows, used by the gateway to stream the collection"""
+        return ndjson_page(QueryProductsModel.objects, after, limit)
+
     @rpc
     def get(self, id):
         """ returns a product based on the provided ID"""
@@ -392,3 +528,8 @@ class QueryProducts:
             return e
         except Exception as e:
             return e
+
+    @rpc
+    def get_many(self, ids):
+        """ returns every product in ids with one query, missing ids are skipped"""
+        return get_by_ids(QueryProductsModel.objects, ids)
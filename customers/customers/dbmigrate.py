@@ -1,5 +1,6 @@
 import os
 from .models import DeclarativeBase
+from .outbox import OutboxMessage  # registers the outbox table with DeclarativeBase
 from sqlalchemy import create_engine
 
 
@@ -16,6 +17,9 @@ def create_db():
     db.execute('CREATE SEQUENCE IF NOT EXISTS customer_id_seq START 1;')
     DeclarativeBase.metadata.create_all(db)
 
+    # create_all doesn't alter existing tables
+    db.execute('ALTER TABLE customers ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;')
+
 
 if __name__ == '__main__':
     print('creating databases')
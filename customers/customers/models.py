@@ -4,10 +4,11 @@ from mongoengine import *
 from sqlalchemy.dialects import postgresql
 
 from sqlalchemy import (
-    DECIMAL, Column, DateTime, ForeignKey, BigInteger, String, Boolean
+    DECIMAL, Column, DateTime, ForeignKey, BigInteger, Integer, String, Boolean
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from .metrics import instrument_sqlalchemy, instrument_pymongo
 
 
 class Base(object):
@@ -52,6 +53,16 @@ class Customer(DeclarativeBase):
                         ForeignKey('accounts.id', name='fk_customers_accounts'), nullable=True)
     account = relationship('Account', backref='customers')
 
+    # bumped by every update of the row, replication events carry it so the query side
+    # can drop changes older than the ones it already holds
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
+
+# listeners only attach to clients created afterwards, so instrument before connecting
+instrument_sqlalchemy()
+instrument_pymongo()
 
 connect(os.getenv('MONGO_DATABASE', 'customers'),
         host=os.environ.get('MONGO_HOST', '127.0.0.1'),
@@ -74,3 +85,4 @@ class QueryCustomersModel(Document):
     created_at = StringField()
     updated_at = StringField()
     account_id = IntField()
+    version = IntField()
@@ -3,10 +3,18 @@ import logging
 
 from nameko.events import event_handler, EventDispatcher
 from nameko.rpc import rpc
+from nameko.timer import timer
+from nameko.web.handlers import http
 from nameko_sqlalchemy import DatabaseSession
+from sqlalchemy.dialects.postgresql import insert
 
+from .batching import batch_event_handler, apply_batch
 from .exceptions import *
+from .metrics import Metrics, metrics_response
 from .models import *
+from .outbox import OUTBOX_RELAY_INTERVAL, Outbox, relay
+from .pagination import keyset_page, ndjson_page, get_by_ids
+from .projection import Projection
 
 logger = logging.getLogger(__name__)
 
@@ -15,18 +23,59 @@ COMMAND_SERVICE = 'command_customers'
 QUERY_SERVICE = 'query_customers'
 ORDERS_SERVICE = os.environ.get('ORDERS_COMMAND', 'command_orders')
 
+REGISTER_BATCH_SIZE = int(os.getenv('REGISTER_BATCH_SIZE', 500))
+REQUIRED_ACCOUNT_FIELDS = ('user_name', 'email', 'password_hash', 'name', 'last_name',
+                           'street_1', 'city', 'state', 'zip_code', 'country')
+
+# replicated customer fields written to the projection on every change
+CUSTOMER_FIELDS = ('full_name', 'name', 'last_name', 'phone', 'email', 'street_1', 'street_2', 'city',
+                   'state', 'zip_code', 'country', 'created_at', 'updated_at', 'account_id')
+
 
 class Command:
     name = COMMAND_SERVICE
     dispatch = EventDispatcher()
+    outbox = Outbox()
     db = DatabaseSession(DeclarativeBase)
+    metrics = Metrics()
 
     def _save_to_db(self, item):
         self.db.add(item)
         self.db.commit()
 
     def fire_replicate_db_event(self, data):
-        self.dispatch(REPLICATE_DB_EVENT, data)
+        """ adds a replication event to the outbox, registrations replicate a list of customers without an aggregate """
+        self.outbox(REPLICATE_DB_EVENT, data, aggregate_id=None if isinstance(data, list) else data['id'])
+
+    @timer(interval=OUTBOX_RELAY_INTERVAL)
+    def relay_outbox(self):
+        """ publishes the committed events the worker which wrote them failed to relay """
+        relay(self.db, self.name, self.dispatch)
+
+    @staticmethod
+    def _customer_document(customer):
+        """
+        The whole customer as replicated. Updates send every field too, the query side only
+        keeps the newest version so a partial change arriving late can't be half applied
+        :param customer:
+        :return:
+        """
+        return {'id': customer.id,
+                'version': customer.version,
+                'account_id': customer.account_id,
+                'full_name': customer.full_name,
+                'name': customer.name,
+                'last_name': customer.last_name,
+                'phone': customer.phone,
+                'email': customer.email,
+                'street_1': customer.street_1,
+                'street_2': customer.street_2,
+                'city': customer.city,
+                'state': customer.state,
+                'country': customer.country,
+                'zip_code': customer.zip_code,
+                'created_at': customer.created_at,
+                'updated_at': customer.updated_at}
 
     @rpc
     def validate_account(self, id):
@@ -47,7 +96,9 @@ class Command:
         account = Account(user_name=data['user_name'], email=data['email'],
                           password_hash=data['password_hash'])
 
-        self._save_to_db(account)
+        # committed by add_customer together with the customer and its replication event
+        self.db.add(account)
+        self.db.flush()
 
         data['account_id'] = account.id
 
@@ -55,6 +106,147 @@ class Command:
 
         return {'id': account.id}
 
+    @rpc
+    def register_many(self, accounts):
+        """
+        Bulk version of register, accounts and customers are written with multi-row inserts
+        in one transaction per chunk and replicated with one event per chunk.
+
+        Records that fail validation, or whose user name/email is already taken, are reported
+        back by their index in the request without failing the rest of the batch.
+        :param accounts: list of register payloads
+        :return: {'ids': [{'index', 'account_id', 'customer_id'}], 'errors': [{'index', 'error'}]}
+        """
+        if isinstance(accounts, str):
+            accounts = json.loads(accounts)
+
+        ids = []
+        errors = []
+
+        for start in range(0, len(accounts), REGISTER_BATCH_SIZE):
+            chunk = list(enumerate(accounts[start:start + REGISTER_BATCH_SIZE], start))
+
+            # a failed chunk reports every record once with the failure, not also what was checked before it
+            chunk_errors = []
+
+            try:
+                self._register_chunk(chunk, ids, chunk_errors)
+            except Exception as e:
+                self.db.rollback()
+                logger.error(f'{datetime.datetime.utcnow()}: Unable to register accounts {start} to '
+                             f'{start + len(chunk) - 1}: {e}')
+                chunk_errors = [{'index': index, 'error': str(e)} for index, _ in chunk]
+
+            errors.extend(chunk_errors)
+
+        return {'ids': ids, 'errors': errors}
+
+    def _register_chunk(self, chunk, ids, errors):
+        valid = []
+        user_names = set()
+        emails = set()
+
+        for index, data in chunk:
+            try:
+                if not isinstance(data, dict):
+                    raise ValueError('Account must be an object')
+
+                missing = [field for field in REQUIRED_ACCOUNT_FIELDS if not data.get(field)]
+                if missing:
+                    raise ValueError(f'Missing required fields: {", ".join(missing)}')
+
+                if not isinstance(data['user_name'], str) or not isinstance(data['email'], str):
+                    raise ValueError('user_name and email must be strings')
+
+                if data['user_name'] in user_names or data['email'] in emails:
+                    raise ValueError('Duplicate user_name or email in request')
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+                continue
+
+            user_names.add(data['user_name'])
+            emails.add(data['email'])
+            valid.append((index, data))
+
+        if not valid:
+            return
+
+        now = datetime.datetime.utcnow()
+
+        # rows that hit the unique user_name/email constraints are skipped rather than failing the chunk
+        account_rows = self.db.execute(
+            insert(Account.__table__)
+            .values([{'user_name': data['user_name'],
+                      'email': data['email'],
+                      'password_hash': data['password_hash'],
+                      'created_at': now,
+                      'updated_at': now} for _, data in valid])
+            .on_conflict_do_nothing()
+            .returning(Account.id, Account.user_name)
+        ).fetchall()
+
+        account_ids = {row.user_name: row.id for row in account_rows}
+
+        registered = []
+        for index, data in valid:
+            if data['user_name'] in account_ids:
+                registered.append((index, data, account_ids[data['user_name']]))
+            else:
+                errors.append({'index': index, 'error': 'user_name or email is already registered'})
+
+        if not registered:
+            self.db.rollback()
+            return
+
+        customer_rows = self.db.execute(
+            insert(Customer.__table__)
+            .values([{'name': data['name'],
+                      'last_name': data['last_name'],
+                      'full_name': f'{data["name"]} {data["last_name"]}',
+                      'phone': data.get('phone', ''),
+                      'email': data['email'],
+                      'street_1': data['street_1'],
+                      'street_2': data.get('street_2'),
+                      'city': data['city'],
+                      'state': data['state'],
+                      'country': data['country'],
+                      'zip_code': data['zip_code'],
+                      'account_id': account_id,
+                      'version': 1,
+                      'created_at': now,
+                      'updated_at': now} for _, data, account_id in registered])
+            .returning(Customer.id, Customer.account_id)
+        ).fetchall()
+
+        customer_ids = {row.account_id: row.id for row in customer_rows}
+        replicated = []
+
+        for index, data, account_id in registered:
+            replicated.append({
+                'id': customer_ids[account_id],
+                'account_id': account_id,
+                'full_name': f'{data["name"]} {data["last_name"]}',
+                'name': data['name'],
+                'last_name': data['last_name'],
+                'phone': data.get('phone', ''),
+                'email': data['email'],
+                'street_1': data['street_1'],
+                'street_2': data.get('street_2'),
+                'city': data['city'],
+                'state': data['state'],
+                'country': data['country'],
+                'zip_code': data['zip_code'],
+                'version': 1,
+                'created_at': now,
+                'updated_at': now
+            })
+
+        self.fire_replicate_db_event(replicated)
+        self.db.commit()
+
+        ids.extend({'index': index, 'account_id': account_id, 'customer_id': customer_ids[account_id]}
+                   for index, _, account_id in registered)
+
     @rpc
     def update_password(self, id, password_hash):
 
@@ -91,14 +283,16 @@ class Command:
 
         customer.full_name = f'{customer.name} {customer.last_name}'
 
-        self._save_to_db(customer)
+        self.db.add(customer)
+        self.db.flush()
 
         data['id'] = customer.id
         data['full_name'] = customer.full_name
         data['created_at'] = customer.created_at
         data['updated_at'] = customer.updated_at
 
-        self.fire_replicate_db_event(data)
+        self.fire_replicate_db_event(self._customer_document(customer))
+        self.db.commit()
 
         return data
 
@@ -123,87 +317,60 @@ class Command:
 
         customer.full_name = f'{customer.name} {customer.last_name}'
 
-        self._save_to_db(customer)
+        self.db.add(customer)
+        self.db.flush()
 
         data['full_name'] = customer.full_name
         data['created_at'] = customer.created_at
         data['updated_at'] = customer.updated_at
 
-        self.fire_replicate_db_event(data)
+        self.fire_replicate_db_event(self._customer_document(customer))
+        self.db.commit()
 
         return data
 
 
 class Query:
     name = QUERY_SERVICE
-
-    @event_handler(COMMAND_SERVICE, REPLICATE_DB_EVENT)
-    def normalize_db(self, data):
-        """ with the incoming payload:
-        check to see if the record already exists in the query database
-        if so, updated it with the new replicated values, otherwise add
-        the record to the query database"""
-
-        if isinstance(data, str):
-            data = json.loads(data)
-
+    metrics = Metrics()
+
+    @http('GET', '/metrics')
+    def get_metrics(self, request):
+        """ latency, error and worker saturation metrics of every service in this process """
+        return metrics_response()
+
+    @batch_event_handler(COMMAND_SERVICE, REPLICATE_DB_EVENT)
+    def normalize_db(self, payloads):
+        """ with a batch of incoming payloads:
+        upsert every replicated customer into the query database with one bulk
+        write, bulk registrations replicate a whole chunk of customers with one event.
+        Raising requeues the batch"""
         try:
-            customer = QueryCustomersModel.objects.get(
-                id=data['id']
-            )
-
-            customer.update(
-                name=data.get('name', customer.name),
-                phone=data.get('phone', customer.phone),
-                email=data.get('email', customer.email),
-                full_name=data.get('full_name', customer.full_name),
-                last_name=data.get('last_name', customer.last_name),
-                state=data.get('state', customer.state),
-                street_2=data.get('street_2', customer.street_2),
-                street_1=data.get('street_1', customer.street_1),
-                city=data.get('city', customer.city),
-                country=data.get('country', customer.country),
-                zip_code=data.get('zip_code', customer.zip_code),
-                created_at=data.get('created_at', customer.created_at),
-                updated_at=data.get('updated_at', customer.updated_at),
-                account_id=data.get('account_id', customer.account_id)
-            )
-            customer.reload()
-        except DoesNotExist:
-            QueryCustomersModel(
-                id=data['id'],
-                full_name=data['full_name'],
-                name=data['name'],
-                phone=data['phone'],
-                email=data['email'],
-                last_name=data['last_name'],
-                state=data['state'],
-                street_2=data.get('street_2', ''),
-                street_1=data['street_1'],
-                city=data['city'],
-                country=data['country'],
-                zip_code=data['zip_code'],
-                created_at=data['created_at'],
-                updated_at=data['updated_at'],
-                account_id=data['account_id']
-            ).save()
+            apply_batch(QueryCustomersModel, payloads, self._projection)
         except Exception as e:
             logger.error('{}: There was a problem replicating {}'.format(datetime.datetime.utcnow(), e))
-            return e
+            raise
+
+    @staticmethod
+    def _projection(data):
+        return Projection({name: data[name] for name in CUSTOMER_FIELDS if name in data}, on_insert={'street_2': ''},
+                          version=data.get('version'))
 
     @rpc
-    def list(self, num_page=1, limit=0):
-        """ returns all of the customers"""
+    def list(self, after=None, limit=None):
+        """ returns a page of customers, pass the next_cursor of a page as after to get the next one"""
         try:
-            if not num_page:
-                num_page = 1
-            offset = (num_page - 1) * limit
-            customers = QueryCustomersModel.objects \
-                # .skip(offset).limit(limit)
-            return customers.to_json()
+            return keyset_page(QueryCustomersModel.objects, after, limit)
+        except InvalidCursor:
+            raise
         except Exception as e:
             return e
 
+    @rpc
+    def list_ndjson(self, after=None, limit=None):
+        """ returns a chunk of customers as ndjson rows, used by the gateway to stream the collection"""
+        return ndjson_page(QueryCustomersModel.objects, after, limit)
+
     @rpc
     def get(self, id):
         """ returns a single customer based on the ID"""
@@ -215,6 +382,11 @@ class Query:
         except Exception as e:
             return e
 
+    @rpc
+    def get_many(self, ids):
+        """ returns every customer in ids with one query, missing ids are skipped"""
+        return get_by_ids(QueryCustomersModel.objects, ids)
+
 #
 # class CustomersService:
 #     name = "customers_service"
@@ -2,6 +2,7 @@ import logging
 
 from flask import jsonify
 from flask_restplus import Api
+from nameko.exceptions import RemoteError
 
 from .brand_ns import api as brand_ns
 from .products_ns import api as product_ns
@@ -9,6 +10,7 @@ from .customers_ns import api as customer_ns
 from .basket_ns import api as basket_ns
 from .orders_ns import api as orders_ns
 from .warehouse_ns import api as warehouse_ns
+from .gateway_ns import api as gateway_ns
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +19,18 @@ api = Api(version='1.0',
           description='Collection of APIs which mimic an ecom environment')
 
 
+@api.errorhandler(RemoteError)
+def remote_error_handler(e):
+    # a malformed after cursor is the client's mistake, everything else raised by a service is ours
+    if e.exc_type == 'InvalidCursor':
+        return {'message': e.value}, 400
+
+    message = 'An unhandled exception occured'
+    logger.exception(message)
+
+    return {'message': message}, 500
+
+
 @api.errorhandler
 def default_error_handler(e):
     message = 'An unhandled exception occured'
@@ -31,3 +45,4 @@ api.add_namespace(product_ns)
 api.add_namespace(basket_ns)
 api.add_namespace(orders_ns)
 api.add_namespace(warehouse_ns)
+api.add_namespace(gateway_ns)
@@ -3,22 +3,14 @@ import logging
 import os
 from flask import request, jsonify, Response
 from flask_restplus import Resource, Namespace, fields
-from nameko.standalone.rpc import ClusterRpcProxy
 import json
 
+from .rpc_pool import rpc_proxy
+
 logger = logging.getLogger(__name__)
 
 api = Namespace('basket', description='Customer Basket/Checkout System')
 
-RABBIT_USER = os.getenv('RABBIT_USER', 'guest')
-RABBIT_PASSWORD = os.getenv('RABBIT_PASSWORD', 'guest')
-RABBIT_HOST = os.getenv('RABBIT_HOST', '127.0.0.1')
-RABBIT_PORT = os.getenv('RABBIT_PORT', '5672')
-
-amqp_uri = 'amqp://{}:{}@{}:{}'.format(RABBIT_USER, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
-
-CONFIG_RPC = {'AMQP_URI': amqp_uri}
-
 basket_item = api.model('Basket Item',
                         dict(
                             product_id=fields.Integer(required=True),
@@ -62,7 +54,7 @@ class BasketsCollection(Resource):
         :return:
         """
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.basket_service.update_basket(data)
 
 
@@ -78,7 +70,7 @@ class BasketItem(Resource):
         :param id:
         :return:
         """
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.basket_service.get_basket_by_id(id)
 
         return Response(response=json.dumps(response_data),
@@ -93,7 +85,7 @@ class BasketActions(Resource):
     def put(self):
         data = request.json
 
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             rpc.basket_service.checkout(data)
 
         return {'message':'submitted'}, 204
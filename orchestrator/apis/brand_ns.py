@@ -3,22 +3,16 @@ import logging
 import os
 from flask import request, jsonify, Response
 from flask_restplus import Resource, Namespace, fields
-from nameko.standalone.rpc import ClusterRpcProxy
 import json
 
+from .read_cache import read_cache
+from .rpc_pool import rpc_proxy
+from .single_flight import coalesced
+
 logger = logging.getLogger(__name__)
 
 api = Namespace('brands', description='Brands which products are obtained from')
 
-RABBIT_USER = os.getenv('RABBIT_USER', 'guest')
-RABBIT_PASSWORD = os.getenv('RABBIT_PASSWORD', 'guest')
-RABBIT_HOST = os.getenv('RABBIT_HOST', '127.0.0.1')
-RABBIT_PORT = os.getenv('RABBIT_PORT', '5672')
-
-amqp_uri = 'amqp://{}:{}@{}:{}'.format(RABBIT_USER, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
-
-CONFIG_RPC = {'AMQP_URI': amqp_uri}
-
 brand = api.model('Brand',
                   dict(
                       _id=fields.Integer(readOnly=True, description="Unique identifier for the brand category"),
@@ -32,10 +26,15 @@ brand = api.model('Brand',
 class BrandsCollection(Resource):
 
     #@api.marshal_list_with(brand)
-    def get(self, num_page=5, limit=5):
-        """ returns a list of brands """
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_brands.list(num_page, limit)
+    @api.param('after', 'next_cursor returned by the previous page')
+    @api.param('limit', 'Page size, capped by the query service')
+    def get(self):
+        """ returns a page of brands """
+        after = request.args.get('after')
+        limit = request.args.get('limit', type=int)
+
+        with rpc_proxy() as rpc:
+            response_data = rpc.query_brands.list(after, limit)
             return Response(response=response_data,
                             status=200,
                             mimetype='application/json')
@@ -45,7 +44,7 @@ class BrandsCollection(Resource):
     def post(self):
         """ creates a new brand"""
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.command_brands.add(data)
             return response_data, 201
 
@@ -55,16 +54,20 @@ class BrandsItem(Resource):
     #@api.marshal_with(brand)
     def get(self, id):
         """ returns a single brand item"""
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_brands.get(id)
-            return Response(response=response_data,
-                            status=200,
-                            mimetype='application/json')#json.loads(response_data)
+        def load():
+            with rpc_proxy() as rpc:
+                return rpc.query_brands.get(id)
+
+        response_data = read_cache().get_or_load('brands', id,
+                                                 lambda: coalesced('brands', id, load))
+        return Response(response=response_data,
+                        status=200,
+                        mimetype='application/json')#json.loads(response_data)
 
     @api.expect(brand)
     @api.response(204, 'Brand successfully updated')
     def put(self, id):
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.command_brands.update(id, data)
             return response_data, 204
@@ -3,23 +3,19 @@ import logging
 import os
 from flask import request, jsonify, Response
 from flask_restplus import Resource, Namespace, fields
-from nameko.standalone.rpc import ClusterRpcProxy
 import json
 
+from .params import requested_ids
+from .read_cache import read_cache
+from .rpc_pool import rpc_proxy
+from .single_flight import coalesced
+from .streaming import wants_ndjson, ndjson_response
+
 logger = logging.getLogger(__name__)
 
 api = Namespace('customers')
 
 MIME_TYPE = 'application/json'
-RABBIT_USER = os.getenv('RABBIT_USER', 'guest')
-RABBIT_PASSWORD = os.getenv('RABBIT_PASSWORD', 'guest')
-RABBIT_HOST = os.getenv('RABBIT_HOST', '127.0.0.1')
-RABBIT_PORT = os.getenv('RABBIT_PORT', '5672')
-
-amqp_uri = 'amqp://{}:{}@{}:{}'.format(RABBIT_USER, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
-
-CONFIG_RPC = {'AMQP_URI': amqp_uri}
-
 account = api.model('Account',
                     dict(
                         user_name=fields.String(required=True),
@@ -60,15 +56,32 @@ customer = api.model('Customer',
 class CustomersCollection(Resource):
 
     # @api.marshal_with(customer, as_list=True, envelope='customers')
-    def get(self, num_pages=5, limit=100):
+    @api.param('after', 'next_cursor returned by the previous page')
+    @api.param('limit', 'Page size, capped by the query service')
+    @api.param('ids', 'Comma separated customer ids, returns just those customers in one call')
+    def get(self):
         """
-        returns a list of customers
-        :param num_pages:
-        :param limits:
+        returns a page of customers, follow next_cursor for the next page.
+
+        With Accept: application/x-ndjson every customer is streamed instead, one per line
         :return:
         """
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_customers.list(num_pages, limit)
+        ids = requested_ids()
+        if ids is not None:
+            with rpc_proxy() as rpc:
+                response_data = rpc.query_customers.get_many(ids)
+                return Response(response=response_data,
+                                status=200,
+                                mimetype=MIME_TYPE)
+
+        if wants_ndjson():
+            return ndjson_response('query_customers')
+
+        after = request.args.get('after')
+        limit = request.args.get('limit', type=int)
+
+        with rpc_proxy() as rpc:
+            response_data = rpc.query_customers.list(after, limit)
             return Response(response=response_data,
                             status=200,
                             mimetype=MIME_TYPE)
@@ -77,7 +90,7 @@ class CustomersCollection(Resource):
     @api.response(201, 'Customer Created')
     def post(self):
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.command_customers.add_customer(data)
             return Response(response=response_data,
                             status=201,
@@ -91,13 +104,32 @@ class RegisterAction(Resource):
     @api.response(201, 'Account Created')
     def post(self):
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.command_customers.register(data)
             return Response(response=json.dumps(response_data),
                             status=201,
                             mimetype=MIME_TYPE)
 
 
+@api.route('/register/bulk')
+class BulkRegisterAction(Resource):
+
+    @api.expect([account])
+    @api.response(201, 'Accounts Created')
+    def post(self):
+        """
+        Registers a list of accounts in one call, returns the new ids and any
+        records which were rejected, by their position in the request
+        :return:
+        """
+        data = request.json
+        with rpc_proxy() as rpc:
+            response_data = rpc.command_customers.register_many(data)
+            return Response(response=json.dumps(response_data),
+                            status=201,
+                            mimetype=MIME_TYPE)
+
+
 @api.route('/<int:id>')
 @api.param('id', 'Customer identifier')
 @api.response(404, 'Customer not found')
@@ -110,14 +142,18 @@ class CustomersItem(Resource):
         :param id:
         :return:
         """
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_customers.get(id)
+        def load():
+            with rpc_proxy() as rpc:
+                return rpc.query_customers.get(id)
 
-            logger.info('Found customer: {}'.format(response_data))
+        response_data = read_cache().get_or_load('customers', id,
+                                                 lambda: coalesced('customers', id, load))
 
-            return Response(response=response_data,
-                            status=200,
-                            mimetype=MIME_TYPE)
+        logger.info('Found customer: {}'.format(response_data))
+
+        return Response(response=response_data,
+                        status=200,
+                        mimetype=MIME_TYPE)
 
     @api.expect(customer)
     @api.response(204, 'Customer successfully updated')
@@ -128,7 +164,7 @@ class CustomersItem(Resource):
         :return:
         """
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.command_customers.update(id, data)
             return Response(response=response_data,
                             status=204,
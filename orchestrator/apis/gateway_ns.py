@@ -0,0 +1,24 @@
+# ./orchestrator/apis/gateway_ns.py
+import logging
+from flask import current_app
+from flask_restplus import Resource, Namespace
+
+from .read_cache import read_cache
+from .single_flight import SINGLE_FLIGHT_EXTENSION_KEY
+
+logger = logging.getLogger(__name__)
+
+api = Namespace('gateway', description='Statistics about the gateway itself')
+
+
+@api.route('/stats')
+class GatewayStats(Resource):
+
+    def get(self):
+        """
+        returns the read cache counters, used to size the cache, and how many
+        concurrent identical reads were merged into a single rpc
+        :return:
+        """
+        return {'read_cache': read_cache().stats(),
+                'single_flight': current_app.extensions[SINGLE_FLIGHT_EXTENSION_KEY].stats()}, 200
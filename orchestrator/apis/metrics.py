@@ -0,0 +1,121 @@
+# ./orchestrator/apis/metrics.py
+import threading
+import time
+
+from flask import Response, g, request
+
+from .read_cache import CACHE_EXTENSION_KEY
+from .rpc_pool import POOL_EXTENSION_KEY
+from .single_flight import SINGLE_FLIGHT_EXTENSION_KEY
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry(object):
+    """
+    Request latency histograms of the gateway, rendered in the prometheus text exposition format
+    together with the counters of the rpc pool, read cache and single flight group.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = list(labels) + sorted(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render(self, gauges=None):
+        lines = [f'{name} {value}' for name, value in sorted((gauges or {}).items())]
+
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                # counts are already cumulative, observe() increments every bucket the value fits in
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{self._labels(labels, le=bound)} {count}')
+                lines.append(f'{name}_bucket{self._labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _extension_gauges(flask_app):
+    gauges = {}
+
+    for prefix, key in (('gateway_rpc_pool', POOL_EXTENSION_KEY),
+                        ('gateway_read_cache', CACHE_EXTENSION_KEY),
+                        ('gateway_single_flight', SINGLE_FLIGHT_EXTENSION_KEY)):
+        extension = flask_app.extensions.get(key)
+        if extension is None:
+            continue
+
+        for name, value in extension.stats().items():
+            gauges[f'{prefix}_{name}'] = value
+
+    return gauges
+
+
+def init_metrics(flask_app, registry=REGISTRY):
+    """
+    Times every request by route template, method and status and exposes the results on /metrics
+    :param flask_app:
+    :param registry:
+    :return:
+    """
+
+    @flask_app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @flask_app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+
+        if started is not None:
+            # the route template keeps the label set bounded, /api/products/<int:id> not /api/products/42
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            registry.observe('gateway_request_duration_seconds', time.perf_counter() - started,
+                             route=route, method=request.method, status=response.status_code)
+
+        return response
+
+    @flask_app.route('/metrics')
+    def metrics():
+        return Response(registry.render(_extension_gauges(flask_app)),
+                        status=200,
+                        content_type=CONTENT_TYPE)
+
+    return registry
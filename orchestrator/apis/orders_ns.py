@@ -3,22 +3,16 @@ import logging
 import os
 from flask import request, jsonify, Response
 from flask_restplus import Resource, Namespace, fields
-from nameko.standalone.rpc import ClusterRpcProxy
 import json
 
+from .params import requested_ids
+from .rpc_pool import rpc_proxy
+from .single_flight import coalesced
+
 logger = logging.getLogger(__name__)
 
 api = Namespace('orders', description='Api for querying orders.')
 
-RABBIT_USER = os.getenv('RABBIT_USER', 'guest')
-RABBIT_PASSWORD = os.getenv('RABBIT_PASSWORD', 'guest')
-RABBIT_HOST = os.getenv('RABBIT_HOST', '127.0.0.1')
-RABBIT_PORT = os.getenv('RABBIT_PORT', '5672')
-
-amqp_uri = 'amqp://{}:{}@{}:{}'.format(RABBIT_USER, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
-
-CONFIG_RPC = {'AMQP_URI': amqp_uri}
-
 order = api.model('Order',
                   dict(
                       _id=fields.Integer(),
@@ -26,15 +20,77 @@ order = api.model('Order',
                       customer_id=fields.Integer()
                   ))
 
+@api.route('')
+class OrdersCollection(Resource):
+
+    @api.param('ids', 'Comma separated order ids')
+    def get(self):
+        """
+        returns the requested orders with a single call, e.g. ?ids=1,2,3
+        :return:
+        """
+        ids = requested_ids()
+        if not ids:
+            return {'message': 'ids is required'}, 400
+
+        with rpc_proxy() as rpc:
+            response_data = rpc.query_orders.get_many(ids)
+            return Response(response=response_data,
+                            status=200,
+                            mimetype='application/json')
+
+
 @api.route('/<int:id>')
 class OrderItem(Resource):
     def get(self, id):
+        def load():
+            with rpc_proxy() as rpc:
+                return rpc.query_orders.get(None, id)
+
         try:
-            with ClusterRpcProxy(CONFIG_RPC) as rpc:
-                response_data = rpc.query_orders.get(None, id)
-                return Response(response=response_data,
-                                status=200,
-                                mimetype='application/json')
+            response_data = coalesced('orders', id, load)
+            return Response(response=response_data,
+                            status=200,
+                            mimetype='application/json')
         except Exception as e:
             return e
 
+
+@api.route('/buyer/<int:buyer_id>')
+class BuyerOrders(Resource):
+
+    @api.param('after', 'next_cursor returned by the previous page')
+    @api.param('limit', 'Page size, capped by the query service')
+    def get(self, buyer_id):
+        """
+        returns a page of the orders placed by a buyer
+        :param buyer_id:
+        :return:
+        """
+        after = request.args.get('after')
+        limit = request.args.get('limit', type=int)
+
+        with rpc_proxy() as rpc:
+            response_data = rpc.query_orders.get_by_buyer_id(buyer_id, after, limit)
+            return Response(response=response_data,
+                            status=200,
+                            mimetype='application/json')
+
+
+
+@api.route('/saga/latency')
+class SagaLatency(Resource):
+
+    @api.param('window', 'Minutes of created orders the percentiles cover, default 60')
+    @api.param('slowest', 'Number of in-flight orders listed, default 10')
+    def get(self):
+        """
+        returns the checkout-to-paid SLO report: p50/p95/p99 seconds per saga stage and the
+        slowest orders still in flight
+        :return:
+        """
+        window = request.args.get('window', 60, type=int)
+        slowest = request.args.get('slowest', 10, type=int)
+
+        with rpc_proxy() as rpc:
+            return rpc.command_orders.saga_latency(window, slowest)
@@ -0,0 +1,31 @@
+# ./orchestrator/apis/params.py
+import os
+
+from flask import request
+from flask_restplus import abort
+
+# the most ids the query services return in one call, their MAX_PAGE_SIZE
+MAX_IDS = int(os.getenv('MAX_PAGE_SIZE', 500))
+
+
+def requested_ids(arg='ids', max_ids=MAX_IDS):
+    """
+    Parses a comma separated list of ids from the query string, e.g. ?ids=1,2,3
+    :param arg:
+    :param max_ids: more ids than this are rejected with a 400
+    :return: list of ints, or None when the argument was not supplied
+    """
+    value = request.args.get(arg)
+
+    if value is None:
+        return None
+
+    try:
+        ids = [int(id) for id in value.split(',') if id.strip()]
+    except ValueError:
+        abort(400, f'{arg} must be a comma separated list of integers')
+
+    if len(ids) > max_ids:
+        abort(400, f'{arg} accepts at most {max_ids} ids, {len(ids)} were requested')
+
+    return ids
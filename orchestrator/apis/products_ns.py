@@ -1,23 +1,25 @@
 # ./orchestrator/orchestrator/api/catalog/products_ns.py
+import csv
+import io
 import logging
 import os
+import time
 from flask import request, jsonify, Response
 from flask_restplus import Resource, Namespace, fields
-from nameko.standalone.rpc import ClusterRpcProxy
 import json
 
+from .params import requested_ids
+from .read_cache import read_cache
+from .rpc_pool import rpc_proxy
+from .single_flight import coalesced
+from .streaming import wants_ndjson, ndjson_response
+
 logger = logging.getLogger(__name__)
 
 api = Namespace('products')
 
-RABBIT_USER = os.getenv('RABBIT_USER', 'guest')
-RABBIT_PASSWORD = os.getenv('RABBIT_PASSWORD', 'guest')
-RABBIT_HOST = os.getenv('RABBIT_HOST', '127.0.0.1')
-RABBIT_PORT = os.getenv('RABBIT_PORT', '5672')
-
-amqp_uri = 'amqp://{}:{}@{}:{}'.format(RABBIT_USER, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
-
-CONFIG_RPC = {'AMQP_URI': amqp_uri}
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+IMPORT_COLUMNS = ('name', 'description', 'price', 'sku', 'product_brand_id', 'attributes')
 
 shipping_details = api.model('Shipping Details',
                              dict(
@@ -49,10 +51,27 @@ product = api.model('Product',
 @api.route('')
 class ProductsCollection(Resource):
     #@api.marshal_with(product, code=200, description='Success', as_list=True)
-    def get(self, num_page=5, limit=5):
-        """ returns a list of products """
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_products.list(num_page, limit)
+    @api.param('after', 'next_cursor returned by the previous page')
+    @api.param('limit', 'Page size, capped by the query service')
+    @api.param('ids', 'Comma separated product ids, returns just those products in one call')
+    def get(self):
+        """ returns a page of products, or streams all of them for Accept: application/x-ndjson """
+        ids = requested_ids()
+        if ids is not None:
+            with rpc_proxy() as rpc:
+                response_data = rpc.query_products.get_many(ids)
+                return Response(response=response_data,
+                                status=200,
+                                mimetype='application/json')
+
+        if wants_ndjson():
+            return ndjson_response('query_products')
+
+        after = request.args.get('after')
+        limit = request.args.get('limit', type=int)
+
+        with rpc_proxy() as rpc:
+            response_data = rpc.query_products.list(after, limit)
             return Response(response=response_data,
                             status=200,
                             mimetype='application/json')
@@ -62,27 +81,115 @@ class ProductsCollection(Resource):
     def post(self):
         """ creates a new brand"""
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.command_products.add_product(data)
             return response_data['id'], 201
 
 
+def _read_csv_rows(stream):
+    """ yields (row number, product) from a csv upload, columns that are not product fields become attributes """
+    for number, row in enumerate(csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8')), 1):
+        try:
+            product = {key: value for key, value in row.items() if key in IMPORT_COLUMNS}
+            product['price'] = float(product['price'])
+            product['product_brand_id'] = int(product['product_brand_id'])
+
+            attributes = json.loads(product['attributes']) if product.get('attributes') else {}
+            attributes.update({key: value for key, value in row.items()
+                               if key not in IMPORT_COLUMNS and value not in (None, '')})
+            product['attributes'] = attributes
+
+            yield number, product, None
+        except (KeyError, TypeError, ValueError) as e:
+            yield number, None, f'Unable to parse row: {e}'
+
+
+def _read_ndjson_rows(stream):
+    """ yields (line number, product) from a json lines upload """
+    for number, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8'), 1):
+        if not line.strip():
+            continue
+
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, f'Unable to parse row: {e}'
+
+
+@api.route('/import')
+class ProductImport(Resource):
+
+    @api.response(201, 'Products imported')
+    def post(self):
+        """
+        Bulk loads products from a json lines (default) or csv (Content-Type: text/csv) upload.
+
+        The upload is read as a stream and sent to the catalog in batches, the response reports
+        how many products were imported, the rows that were rejected and the throughput.
+        :return:
+        """
+        if request.mimetype == 'text/csv':
+            rows = _read_csv_rows(request.stream)
+        else:
+            rows = _read_ndjson_rows(request.stream)
+
+        started = time.perf_counter()
+        imported = 0
+        rejected = []
+        batch = []
+
+        def flush(batch):
+            with rpc_proxy() as rpc:
+                result = rpc.command_products.import_products([product for _, product in batch])
+
+            rejected.extend({'row': batch[error['index']][0], 'error': error['error']}
+                            for error in result['errors'])
+            return len(result['ids'])
+
+        for number, product, error in rows:
+            if error is not None:
+                rejected.append({'row': number, 'error': error})
+                continue
+
+            batch.append((number, product))
+
+            if len(batch) == IMPORT_BATCH_SIZE:
+                imported += flush(batch)
+                batch = []
+
+        if batch:
+            imported += flush(batch)
+
+        elapsed = time.perf_counter() - started
+
+        logger.info(f'Imported {imported} products in {elapsed:.2f}s, {len(rejected)} rows rejected')
+
+        return {'imported': imported,
+                'rejected': sorted(rejected, key=lambda x: x['row']),
+                'elapsed_seconds': round(elapsed, 3),
+                'rows_per_second': round(imported / elapsed, 1) if elapsed else None}, 201
+
+
 @api.route('/<int:id>')
 class ProductItem(Resource):
     #@api.marshal_with(product)
     def get(self, id):
         """ returns a single product item"""
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_products.get(id)
-            return Response(response=response_data,
-                            status=200,
-                            mimetype='application/json')
+        def load():
+            with rpc_proxy() as rpc:
+                return rpc.query_products.get(id)
+
+        response_data = read_cache().get_or_load('products', id,
+                                                 lambda: coalesced('products', id, load))
+        return Response(response=response_data,
+                        status=200,
+                        mimetype='application/json')
 
     @api.expect(product)
     @api.response(204, 'Product successfully updated')
     def put(self, id):
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             data['id'] = id
             response_data = rpc.command_products.update_product(data)
             return response_data, 204
@@ -0,0 +1,246 @@
+# ./orchestrator/apis/read_cache.py
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import current_app
+from kombu import Connection, Queue
+from kombu.mixins import ConsumerMixin
+from nameko.events import get_event_exchange
+
+from .rpc_pool import amqp_uri
+
+logger = logging.getLogger(__name__)
+
+READ_CACHE_SIZE = int(os.getenv('READ_CACHE_SIZE', 10000))
+READ_CACHE_TTL = float(os.getenv('READ_CACHE_TTL', 60))
+
+CACHE_EXTENSION_KEY = 'read_cache'
+REPLICATE_EVENT = 'replicate_db_event'
+
+# command service whose replication events invalidate a cached resource
+INVALIDATION_SOURCES = {
+    'command_products': 'products',
+    'command_brands': 'brands',
+    'command_site': 'sites',
+    'command_customers': 'customers'
+}
+
+
+class ReadCache(object):
+    """
+    Thread-safe LRU cache with a TTL for single record reads, keyed by (resource, id).
+
+    Entries are evicted when the matching replicate_db_event is broadcast by the command
+    service, the TTL only bounds staleness when an event is missed.
+
+    The broadcast reaches the gateway as soon as the query service, so a read can still return
+    the previous document after the eviction. Every invalidation is remembered with the version
+    it announced, a loaded document older than that version, or loaded while an unversioned
+    invalidation arrived, is returned but not cached.
+    """
+
+    def __init__(self, max_size=READ_CACHE_SIZE, ttl=READ_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # (resource, id) -> (generation, version) of its latest invalidation, bounded like the entries
+        self._changed = OrderedDict()
+        self._generation = 0
+        self._cleared_at = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_loads = 0
+
+    def get(self, resource, id):
+        key = (resource, id)
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, resource, id, value):
+        with self._lock:
+            self._set((resource, id), value)
+
+    def _set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, resource, id, version=None):
+        """
+        Evicts a record and remembers the change, so a load racing it isn't cached
+        :param resource:
+        :param id:
+        :param version: version announced by the replication event, when it carries one
+        :return:
+        """
+        key = (resource, id)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+            self._generation += 1
+            self._changed[key] = (self._generation, version)
+            self._changed.move_to_end(key)
+
+            while len(self._changed) > self.max_size:
+                self._changed.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+            # loads in flight may return documents changed by the events that were missed
+            self._generation += 1
+            self._cleared_at = self._generation
+
+    @staticmethod
+    def _version_of(value):
+        try:
+            return json.loads(value).get('version')
+        except (ValueError, AttributeError):
+            return None
+
+    def _stale(self, key, value, started):
+        """ whether a document loaded since generation started may predate an invalidation """
+        if self._cleared_at > started:
+            return True
+
+        changed = self._changed.get(key)
+        if changed is None:
+            return False
+
+        generation, version = changed
+        if version is None:
+            return generation > started
+
+        loaded = self._version_of(value)
+        return loaded is None or loaded < version
+
+    def get_or_load(self, resource, id, loader):
+        """
+        Returns the cached value, on a miss the loader is called and its result cached
+        :param resource:
+        :param id:
+        :param loader: callable returning the serialized record
+        :return:
+        """
+        value = self.get(resource, id)
+
+        if value is None:
+            with self._lock:
+                started = self._generation
+
+            value = loader()
+
+            # query services hand back exceptions instead of raising, never cache those
+            if isinstance(value, str):
+                key = (resource, id)
+                with self._lock:
+                    if self._stale(key, value, started):
+                        self.stale_loads += 1
+                    else:
+                        self._set(key, value)
+
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale_loads': self.stale_loads
+            }
+
+
+class ReplicationListener(ConsumerMixin):
+    """
+    Subscribes to the replicate_db_event broadcasts of the command services and evicts
+    the changed records from the read cache.
+    """
+
+    def __init__(self, connection, cache, sources=INVALIDATION_SOURCES):
+        self.connection = connection
+        self.cache = cache
+        self.resources = {get_event_exchange(source).name: resource
+                          for source, resource in sources.items()}
+        self.queue_suffix = uuid.uuid4().hex
+        self.sources = sources
+
+    def get_consumers(self, Consumer, channel):
+        queues = [Queue(name=f'gateway-cache-{source}-{self.queue_suffix}',
+                        exchange=get_event_exchange(source),
+                        routing_key=REPLICATE_EVENT,
+                        auto_delete=True,
+                        exclusive=True)
+                  for source in self.sources]
+
+        return [Consumer(queues=queues, callbacks=[self.on_message], accept=['json'])]
+
+    def on_connection_revived(self):
+        # events may have been missed while disconnected
+        self.cache.clear()
+
+    def on_message(self, body, message):
+        try:
+            resource = self.resources.get(message.delivery_info.get('exchange'))
+
+            if isinstance(body, str):
+                body = json.loads(body)
+
+            for record in (body if isinstance(body, list) else [body]):
+                self.cache.invalidate(resource, record['id'], record.get('version'))
+        except Exception as e:
+            logger.error(f'Unable to invalidate read cache entry: {e}')
+        finally:
+            message.ack()
+
+
+def init_read_cache(flask_app, uri=amqp_uri):
+    """
+    Creates the read cache and starts the background listener which keeps it fresh
+    :param flask_app:
+    :param uri:
+    :return:
+    """
+    cache = ReadCache()
+    listener = ReplicationListener(Connection(uri), cache)
+
+    thread = threading.Thread(target=listener.run, name='read-cache-invalidation', daemon=True)
+    thread.start()
+
+    flask_app.extensions[CACHE_EXTENSION_KEY] = cache
+    return cache, listener
+
+
+def read_cache():
+    return current_app.extensions[CACHE_EXTENSION_KEY]
@@ -0,0 +1,187 @@
+# ./orchestrator/apis/rpc_pool.py
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from amqp.exceptions import AMQPError
+from flask import current_app
+from kombu.exceptions import KombuError
+from nameko.exceptions import RpcTimeout
+from nameko.standalone.rpc import ClusterRpcProxy
+
+logger = logging.getLogger(__name__)
+
+RABBIT_USER = os.getenv('RABBIT_USER', 'guest')
+RABBIT_PASSWORD = os.getenv('RABBIT_PASSWORD', 'guest')
+RABBIT_HOST = os.getenv('RABBIT_HOST', '127.0.0.1')
+RABBIT_PORT = os.getenv('RABBIT_PORT', '5672')
+
+amqp_uri = 'amqp://{}:{}@{}:{}'.format(RABBIT_USER, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
+
+CONFIG_RPC = {'AMQP_URI': amqp_uri}
+
+RPC_POOL_SIZE = int(os.getenv('RPC_POOL_SIZE', 20))
+RPC_TIMEOUT = float(os.getenv('RPC_TIMEOUT', 30))
+RPC_POOL_ACQUIRE_TIMEOUT = float(os.getenv('RPC_POOL_ACQUIRE_TIMEOUT', 10))
+RPC_POOL_MAX_IDLE = float(os.getenv('RPC_POOL_MAX_IDLE', 300))
+
+POOL_EXTENSION_KEY = 'rpc_pool'
+
+# errors after which a proxy can no longer be trusted, either because the broker
+# connection is gone or because a late reply may still arrive on its reply queue
+BROKER_ERRORS = (OSError, RpcTimeout, KombuError, AMQPError)
+
+
+class RpcPoolExhausted(Exception):
+    pass
+
+
+class _PooledProxy(object):
+
+    def __init__(self, config, timeout):
+        self.cluster_proxy = ClusterRpcProxy(config, timeout=timeout)
+        self.rpc = self.cluster_proxy.start()
+        self.last_used = time.monotonic()
+
+    def is_healthy(self, max_idle):
+        """
+        Checks the proxy can be handed out again, a proxy that sat idle for too long
+        is recycled since the broker (or anything in between) may have dropped the connection
+        :param max_idle:
+        :return:
+        """
+        if time.monotonic() - self.last_used > max_idle:
+            return False
+
+        try:
+            connection = self.cluster_proxy._reply_listener.queue_consumer.connection
+            return connection.connected
+        except AttributeError:
+            return True
+
+    def close(self):
+        try:
+            self.cluster_proxy.stop()
+        except Exception as e:
+            logger.warning(f'Unable to cleanly stop rpc proxy: {e}')
+
+
+class RpcProxyPool(object):
+    """
+    Thread-safe pool of long-lived nameko cluster proxies.
+
+    A ClusterRpcProxy is not safe to share between threads, so each request borrows one
+    exclusively for the duration of its calls and hands it back afterwards. Proxies are created
+    lazily up to max_size, checked on the way out of the pool and thrown away (and later
+    re-created) when a call fails with a broker level error.
+    """
+
+    def __init__(self, config, max_size=RPC_POOL_SIZE, timeout=RPC_TIMEOUT,
+                 acquire_timeout=RPC_POOL_ACQUIRE_TIMEOUT, max_idle=RPC_POOL_MAX_IDLE):
+        self.config = config
+        self.max_size = max_size
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+        self.max_idle = max_idle
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+
+        self._lock = threading.Lock()
+        self.in_use = 0
+
+    def _checkout(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise RpcPoolExhausted(f'No rpc proxy became available within {self.acquire_timeout} seconds')
+
+        try:
+            while True:
+                try:
+                    proxy = self._idle.get_nowait()
+                except queue.Empty:
+                    return _PooledProxy(self.config, self.timeout)
+
+                if proxy.is_healthy(self.max_idle):
+                    return proxy
+
+                logger.info('Discarding stale rpc proxy')
+                proxy.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, proxy, discard=False):
+        with self._lock:
+            self.in_use -= 1
+
+        try:
+            if discard or self._closed:
+                proxy.close()
+            else:
+                proxy.last_used = time.monotonic()
+                self._idle.put(proxy)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {
+            'max_size': self.max_size,
+            'in_use': self.in_use,
+            'idle': self._idle.qsize()
+        }
+
+    @contextmanager
+    def get(self):
+        """
+        Borrows a proxy from the pool, usage mirrors ClusterRpcProxy:
+
+            with pool.get() as rpc:
+                rpc.query_products.get(id)
+        :return:
+        """
+        proxy = self._checkout()
+        with self._lock:
+            self.in_use += 1
+        try:
+            yield proxy.rpc
+        except BROKER_ERRORS:
+            logger.warning('Broker error during rpc call, the proxy will be reconnected')
+            self._checkin(proxy, discard=True)
+            raise
+        except BaseException:
+            self._checkin(proxy)
+            raise
+        else:
+            self._checkin(proxy)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def init_rpc_pool(flask_app, config=None):
+    """
+    Creates the pool and attaches it to the flask app, namespaces then borrow from it through rpc_proxy()
+    :param flask_app:
+    :param config:
+    :return:
+    """
+    pool = RpcProxyPool(config or CONFIG_RPC)
+    flask_app.extensions[POOL_EXTENSION_KEY] = pool
+    return pool
+
+
+def rpc_proxy():
+    """
+    Borrows a proxy from the current app's pool
+    :return:
+    """
+    return current_app.extensions[POOL_EXTENSION_KEY].get()
@@ -0,0 +1,84 @@
+# ./orchestrator/apis/single_flight.py
+import threading
+
+from flask import current_app
+
+SINGLE_FLIGHT_EXTENSION_KEY = 'single_flight'
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent reads: the first request for a key runs the loader, requests
+    for the same key arriving while it is in flight wait for and share its result (or error)
+    instead of issuing their own rpc.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.executed = 0
+        self.merged = 0
+
+    def do(self, key, loader):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.merged += 1
+
+        if not leader:
+            # the leader's rpc has a timeout, so this wait is bounded as well
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = loader()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'executed': self.executed,
+                'merged': self.merged
+            }
+
+
+def init_single_flight(flask_app):
+    group = SingleFlight()
+    flask_app.extensions[SINGLE_FLIGHT_EXTENSION_KEY] = group
+    return group
+
+
+def coalesced(resource, id, loader):
+    """
+    Runs the loader for (resource, id) unless an identical read is already in flight
+    :param resource:
+    :param id:
+    :param loader:
+    :return:
+    """
+    return current_app.extensions[SINGLE_FLIGHT_EXTENSION_KEY].do((resource, id), loader)
@@ -0,0 +1,52 @@
+# ./orchestrator/apis/streaming.py
+import os
+
+from flask import request, Response, stream_with_context
+
+from .rpc_pool import rpc_proxy
+
+JSON_MIME_TYPE = 'application/json'
+NDJSON_MIME_TYPE = 'application/x-ndjson'
+
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 500))
+
+
+def wants_ndjson():
+    """ True when the client asked for a streamed collection with Accept: application/x-ndjson """
+    return request.accept_mimetypes.best_match([JSON_MIME_TYPE, NDJSON_MIME_TYPE]) == NDJSON_MIME_TYPE
+
+
+def ndjson_response(service_name, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Streams a whole collection as newline delimited json.
+
+    The query service is asked for one chunk at a time with its list_ndjson rpc, and each chunk
+    is written to the client before the next one is requested, so memory stays flat regardless of
+    the size of the collection. A proxy is only borrowed for the duration of a single chunk so a
+    slow client does not hold on to the pool.
+    :param service_name: query service exposing list_ndjson(after, limit)
+    :param chunk_size:
+    :return:
+    """
+    def read(after):
+        with rpc_proxy() as rpc:
+            return getattr(rpc, service_name).list_ndjson(after, chunk_size)
+
+    def generate(chunk):
+        while True:
+            if chunk['rows']:
+                yield chunk['rows']
+
+            if chunk['next_cursor'] is None:
+                return
+
+            chunk = read(chunk['next_cursor'])
+
+    # read before the response starts, so a malformed after cursor is still answered with a 400
+    first = read(request.args.get('after'))
+
+    # X-Accel-Buffering stops the nginx proxy from buffering the whole stream
+    return Response(stream_with_context(generate(first)),
+                    status=200,
+                    mimetype=NDJSON_MIME_TYPE,
+                    headers={'X-Accel-Buffering': 'no'})
@@ -3,22 +3,17 @@ import logging
 import os
 from flask import request, jsonify, Response
 from flask_restplus import Resource, Namespace, fields
-from nameko.standalone.rpc import ClusterRpcProxy
 import json
 
+from .read_cache import read_cache
+from .rpc_pool import rpc_proxy
+from .single_flight import coalesced
+from .streaming import wants_ndjson, ndjson_response
+
 logger = logging.getLogger(__name__)
 
 api = Namespace('warehouse')
 
-RABBIT_USER = os.getenv('RABBIT_USER', 'guest')
-RABBIT_PASSWORD = os.getenv('RABBIT_PASSWORD', 'guest')
-RABBIT_HOST = os.getenv('RABBIT_HOST', '127.0.0.1')
-RABBIT_PORT = os.getenv('RABBIT_PORT', '5672')
-
-amqp_uri = 'amqp://{}:{}@{}:{}'.format(RABBIT_USER, RABBIT_PASSWORD, RABBIT_HOST, RABBIT_PORT)
-
-CONFIG_RPC = {'AMQP_URI': amqp_uri}
-
 site = api.model('Warehouse Site',
                  dict(
                      _id=fields.Integer(),
@@ -34,16 +29,21 @@ site = api.model('Warehouse Site',
 @api.route('/sites')
 class SitesCollection(Resource):
 
-    def get(self, num_pages=5, limit=10):
+    @api.param('after', 'next_cursor returned by the previous page')
+    @api.param('limit', 'Page size, capped by the query service')
+    def get(self):
         """
-        returns a list of the shipping sites
-        :param num_pages:
-        :param limit:
+        returns a page of the shipping sites, or streams all of them for Accept: application/x-ndjson
         :return:
         """
+        if wants_ndjson():
+            return ndjson_response('query_site')
 
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_site.list(num_pages, limit)
+        after = request.args.get('after')
+        limit = request.args.get('limit', type=int)
+
+        with rpc_proxy() as rpc:
+            response_data = rpc.query_site.list(after, limit)
             return Response(response_data,
                             status=200,
                             mimetype='application/json')
@@ -52,7 +52,7 @@ class SitesCollection(Resource):
     @api.response(201, 'Site created')
     def post(self):
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.command_site.add(data)
             return response_data['id'], 201
 
@@ -66,17 +66,21 @@ class SitesItem(Resource):
         :param id:
         :return:
         """
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_site.get(id)
-            return Response(response_data,
-                            status=200,
-                            mimetype='application/json')
+        def load():
+            with rpc_proxy() as rpc:
+                return rpc.query_site.get(id)
+
+        response_data = read_cache().get_or_load('sites', id,
+                                                 lambda: coalesced('sites', id, load))
+        return Response(response_data,
+                        status=200,
+                        mimetype='application/json')
 
     @api.expect(site)
     @api.response(204, 'Site updated successfully')
     def put(self, id):
         data = request.json
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             data['id'] = id
             response_data = rpc.command_site.update(id, data)
             return response_data, 204
@@ -84,21 +88,15 @@ class SitesItem(Resource):
 
 @api.route('/site/<int:id>/inventory')
 class SiteInventory(Resource):
-    def get(self, id):
-
-        args = request.args.to_dict()
-        num_page=None
-        limit=None
-
-        if 'num_page' in args:
-            num_page = int(args['num_page'])
-
-        if 'limit' in args:
-            limit = int(args['limit'])
 
+    @api.param('after', 'next_cursor returned by the previous page')
+    @api.param('limit', 'Page size, capped by the query service')
+    def get(self, id):
+        after = request.args.get('after')
+        limit = request.args.get('limit', type=int)
 
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
-            response_data = rpc.query_inventory.get_by_site_id(id, num_page, limit)
+        with rpc_proxy() as rpc:
+            response_data = rpc.query_inventory.get_by_site_id(id, after, limit)
             return Response(response_data,
                             status=200,
                             mimetype='application/json')
@@ -113,7 +111,7 @@ class InventoryItems(Resource):
         :param product_id:
         :return:
         """
-        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+        with rpc_proxy() as rpc:
             response_data = rpc.query_inventory.get_by_product_id(product_id)
             return Response(response_data,
                             status=200,
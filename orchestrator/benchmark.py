@@ -0,0 +1,94 @@
+"""
+Compares gateway latency and throughput for GET /api/products/<id> with a new
+ClusterRpcProxy per request (the old behaviour) against the pooled proxies.
+
+Needs a local RabbitMQ and the catalog service running, e.g.:
+
+    RABBIT_HOST=localhost python -m benchmark --product-id 1 --requests 2000 --concurrency 16
+"""
+import argparse
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+from nameko.standalone.rpc import ClusterRpcProxy
+
+from apis.rpc_pool import CONFIG_RPC, POOL_EXTENSION_KEY
+from service import app, initialize_app
+
+
+class UnpooledRpc(object):
+    """ stand-in for the pool which opens a fresh proxy on every borrow """
+
+    @contextmanager
+    def get(self):
+        with ClusterRpcProxy(CONFIG_RPC) as rpc:
+            yield rpc
+
+    def close(self):
+        pass
+
+
+def run(url, total, concurrency):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = total // concurrency
+
+    def worker():
+        client = app.test_client()
+        for _ in range(per_thread):
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'rps': len(latencies) / wall
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--product-id', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    initialize_app(app)
+    url = f'/api/products/{args.product_id}'
+    pool = app.extensions[POOL_EXTENSION_KEY]
+
+    app.extensions[POOL_EXTENSION_KEY] = UnpooledRpc()
+    before = run(url, args.requests, args.concurrency)
+
+    app.extensions[POOL_EXTENSION_KEY] = pool
+    run(url, args.concurrency, args.concurrency)  # warm up the pool
+    after = run(url, args.requests, args.concurrency)
+    pool.close()
+
+    print(f'{"mode":<12}{"requests":>10}{"errors":>8}{"p50 ms":>10}{"p99 ms":>10}{"req/s":>10}')
+    for mode, result in (('per-request', before), ('pooled', after)):
+        print(f'{mode:<12}{result["requests"]:>10}{result["errors"]:>8}'
+              f'{result["p50_ms"]:>10.2f}{result["p99_ms"]:>10.2f}{result["rps"]:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
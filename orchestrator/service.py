@@ -1,6 +1,11 @@
 from flask import Flask, Blueprint
 from apis import api
+from apis.metrics import init_metrics
+from apis.read_cache import init_read_cache
+from apis.rpc_pool import init_rpc_pool
+from apis.single_flight import init_single_flight
 
+import atexit
 import os
 
 # instantiate the app
@@ -32,6 +37,20 @@ def initialize_app(flask_app):
     blueprint = Blueprint('api', __name__, url_prefix='/api')
     api.init_app(blueprint)
 
+    # long-lived rpc proxies shared by every request instead of one broker connection per call
+    pool = init_rpc_pool(flask_app)
+    atexit.register(pool.close)
+
+    # hot catalog/customer reads are served in-process, replication events evict changed records
+    cache, listener = init_read_cache(flask_app)
+    atexit.register(setattr, listener, 'should_stop', True)
+
+    # concurrent misses for the same record share one rpc
+    init_single_flight(flask_app)
+
+    # per route latency plus the pool/cache counters above, scraped from /metrics
+    init_metrics(flask_app)
+
     # register blueprints
     # flask_app.register_blueprint(views.customers)
     flask_app.register_blueprint(blueprint)
@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from apis.read_cache import ReadCache  # noqa: E402
+
+
+def document(id, version):
+    return json.dumps({'_id': id, 'name': f'product {id}', 'version': version})
+
+
+def test_miss_is_loaded_and_cached():
+    cache = ReadCache()
+
+    assert cache.get_or_load('products', 1, lambda: document(1, 1)) == document(1, 1)
+    assert cache.get('products', 1) == document(1, 1)
+
+
+def test_invalidation_during_load_is_not_overwritten():
+    cache = ReadCache()
+
+    def load():
+        # the replication event arrives while the query service is still answering
+        cache.invalidate('products', 1, version=2)
+        return document(1, 1)
+
+    assert cache.get_or_load('products', 1, load) == document(1, 1)
+    assert cache.get('products', 1) is None
+    assert cache.stats()['stale_loads'] == 1
+
+
+def test_unversioned_invalidation_during_load_is_not_overwritten():
+    cache = ReadCache()
+
+    def load():
+        cache.invalidate('products', 1)
+        return document(1, 1)
+
+    cache.get_or_load('products', 1, load)
+    assert cache.get('products', 1) is None
+
+
+def test_load_before_projection_is_written_is_not_cached():
+    cache = ReadCache()
+
+    # the gateway saw the event before the query service applied it
+    cache.invalidate('products', 1, version=2)
+    cache.get_or_load('products', 1, lambda: document(1, 1))
+    assert cache.get('products', 1) is None
+
+    cache.get_or_load('products', 1, lambda: document(1, 2))
+    assert cache.get('products', 1) == document(1, 2)
+
+
+def test_clear_during_load_is_not_overwritten():
+    cache = ReadCache()
+
+    def load():
+        cache.clear()
+        return document(1, 1)
+
+    cache.get_or_load('products', 1, load)
+    assert cache.get('products', 1) is None
+
+
+def test_invalidation_of_another_record_does_not_block_caching():
+    cache = ReadCache()
+
+    def load():
+        cache.invalidate('products', 2, version=5)
+        return document(1, 1)
+
+    cache.get_or_load('products', 1, load)
+    assert cache.get('products', 1) == document(1, 1)
@@ -0,0 +1,165 @@
+import json
+import logging
+from datetime import datetime as dt
+from functools import partial
+
+import eventlet
+from nameko.events import EventHandler
+from nameko.exceptions import ContainerBeingKilled
+from nameko.messaging import QueueConsumer
+
+from .projection import bulk_upsert, upsert_operations
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_CONFIG_KEY = 'PROJECTION_BATCH_SIZE'
+BATCH_WINDOW_CONFIG_KEY = 'PROJECTION_BATCH_WINDOW'
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_WINDOW = 0.05
+
+
+class BatchQueueConsumer(QueueConsumer):
+    """
+    Separate broker connection for batch handlers. The stock consumer prefetches max_workers
+    messages, which would cap every batch at max_workers events.
+    """
+
+    @property
+    def prefetch_count(self):
+        batch_size = max((provider.batch_size for provider in self._providers), default=1)
+
+        # room for one batch being written while the next one fills up
+        return max(self.container.max_workers, 2 * batch_size)
+
+
+class BatchEventHandler(EventHandler):
+    """
+    Event handler which hands the service method a list of event payloads instead of one.
+
+    Events are buffered until batch_size have arrived or batch_window seconds have passed since
+    the first one, whichever comes first. The messages are acked once the worker returns and
+    requeued when it raises, so nothing is acknowledged before the batch has been written.
+    Both limits default to PROJECTION_BATCH_SIZE and PROJECTION_BATCH_WINDOW from the service config.
+    """
+
+    queue_consumer = BatchQueueConsumer()
+
+    def __init__(self, source_service, event_type, batch_size=None, batch_window=None,
+                 requeue_on_error=True, **kwargs):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+
+        self._bodies = []
+        self._messages = []
+        self._timer = None
+
+        super(BatchEventHandler, self).__init__(source_service, event_type,
+                                                requeue_on_error=requeue_on_error, **kwargs)
+
+    def setup(self):
+        config = self.container.config
+
+        if self.batch_size is None:
+            self.batch_size = int(config.get(BATCH_SIZE_CONFIG_KEY, DEFAULT_BATCH_SIZE))
+        if self.batch_window is None:
+            self.batch_window = float(config.get(BATCH_WINDOW_CONFIG_KEY, DEFAULT_BATCH_WINDOW))
+
+        super(BatchEventHandler, self).setup()
+
+    def stop(self):
+        # buffered messages haven't reached a worker yet, give them back to the broker
+        for message in self._messages:
+            self.queue_consumer.requeue_message(message)
+        self._bodies, self._messages = [], []
+
+        super(BatchEventHandler, self).stop()
+
+    def handle_message(self, body, message):
+        self._bodies.append(body)
+        self._messages.append(message)
+
+        if len(self._bodies) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.container.spawn_managed_thread(
+                self._flush_after_window, identifier=f'{type(self).__name__}.flush[{self.method_name}]')
+
+    def _flush_after_window(self):
+        eventlet.sleep(self.batch_window)
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        bodies, messages = self._bodies, self._messages
+        self._bodies, self._messages = [], []
+
+        if not bodies:
+            return
+
+        handle_result = partial(self.handle_batch_result, messages)
+        try:
+            self.container.spawn_worker(self, (bodies,), {},
+                                        context_data=self.unpack_message_headers(messages[-1]),
+                                        handle_result=handle_result)
+        except ContainerBeingKilled:
+            for message in messages:
+                self.queue_consumer.requeue_message(message)
+
+    def handle_batch_result(self, messages, worker_ctx, result=None, exc_info=None):
+        for message in messages:
+            self.handle_message_processed(message, result, exc_info)
+        return result, exc_info
+
+
+batch_event_handler = BatchEventHandler.decorator
+
+
+def latest_by_id(payloads):
+    """
+    Flattens a batch of replication payloads into one record per id. Records for the same id are
+    merged in version order, or arrival order when unversioned, so the latest value of every field wins
+    :param payloads: event bodies, each a record, a list of records or their json
+    :return:
+    """
+    changes = {}
+
+    for payload in payloads:
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+
+        for record in (payload if isinstance(payload, list) else [payload]):
+            changes.setdefault(record['id'], []).append(record)
+
+    records = []
+
+    for versions in changes.values():
+        merged = {}
+        for record in sorted(versions, key=lambda record: record.get('version') or 0):
+            merged.update(record)
+        records.append(merged)
+
+    return records
+
+
+def apply_batch(model, payloads, projection):
+    """
+    Writes a batch of replication payloads to the query model with a single bulk upsert,
+    records the projection can't be built for are logged and skipped
+    :param model: mongoengine document class
+    :param payloads:
+    :param projection: callable returning the Projection of a record
+    :return: number of records written
+    """
+    operations = []
+    count = 0
+
+    for record in latest_by_id(payloads):
+        try:
+            operations.extend(upsert_operations(model, record['id'], projection(record)))
+            count += 1
+        except Exception as e:
+            logger.error(f'{dt.utcnow()}: Skipping replicated {model.__name__} {record.get("id")}: {e}')
+
+    bulk_upsert(model, operations)
+    return count
@@ -1,5 +1,6 @@
 import os
 from .models import DeclarativeBase
+from .outbox import OutboxMessage  # registers the outbox table with DeclarativeBase
 from sqlalchemy import create_engine
 
 
@@ -16,6 +17,31 @@ def create_db():
     db.execute('CREATE SEQUENCE IF NOT EXISTS orders_id_seq START 1;')
     DeclarativeBase.metadata.create_all(db)
 
+    # create_all doesn't alter existing tables
+    db.execute('ALTER TABLE orders ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;')
+    for column in ('awaiting_validation_at', 'payment_requested_at', 'stock_confirmed_at', 'stock_rejected_at',
+                   'payment_authorized_at', 'paid_at', 'shipped_at', 'cancelled_at'):
+        db.execute(f'ALTER TABLE orders ADD COLUMN IF NOT EXISTS {column} TIMESTAMP WITHOUT TIME ZONE;')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_orders_created_at ON orders (created_at);')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_orders_in_flight ON orders (created_at) '
+               'WHERE order_status_id IN (1, 2, 3);')
+
+    # buyers were created without a unique user_id before, merge every user's buyers into the oldest
+    with db.begin() as connection:
+        for table in ('orders', 'payment_methods'):
+            connection.execute(f'UPDATE {table} t SET buyer_id = b.survivor '
+                               f'FROM (SELECT id, min(id) OVER (PARTITION BY user_id) AS survivor FROM buyers) b '
+                               f'WHERE t.buyer_id = b.id AND b.id <> b.survivor;')
+        connection.execute('DELETE FROM buyers b WHERE EXISTS '
+                           '(SELECT 1 FROM buyers o WHERE o.user_id = b.user_id AND o.id < b.id);')
+        connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_buyers_user_id ON buyers (user_id);')
+
+    db.execute('ALTER TABLE payment_methods ADD COLUMN IF NOT EXISTS fingerprint VARCHAR(32);')
+    db.execute("UPDATE payment_methods SET fingerprint = md5(card_type_id || ':' || card_number || ':' || expiration) "
+               "WHERE fingerprint IS NULL;")
+    db.execute('CREATE INDEX IF NOT EXISTS ix_payment_methods_buyer_fingerprint '
+               'ON payment_methods (buyer_id, fingerprint);')
+
 
 if __name__ == '__main__':
     print('creating databases')
@@ -5,3 +5,7 @@ class OrderingException(Exception):
 
     def __init__(self, message):
         self.message = message
+
+
+class InvalidCursor(Exception):
+    pass
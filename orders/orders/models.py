@@ -1,16 +1,18 @@
 import datetime
+import hashlib
 import os
 from enum import IntEnum
 
 from mongoengine import *
 from py_linq import Enumerable
 from sqlalchemy import (
-    Column, DateTime, ForeignKey, Integer, String, Boolean, Float, BigInteger
+    Column, DateTime, ForeignKey, Integer, String, Boolean, Float, BigInteger, Index, text
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 from .exceptions import OrderingException
+from .metrics import instrument_sqlalchemy, instrument_pymongo
 
 
 class Base(object):
@@ -84,7 +86,32 @@ class Order(DeclarativeBase):
     is_draft = Column(Boolean, default=False)
     description = Column(String, nullable=True)
 
-    order_items = []
+    # when each saga transition happened, the stage latencies are computed from these.
+    # payment_requested_at is only set when stock and payment are validated in parallel
+    awaiting_validation_at = Column(DateTime, nullable=True)
+    payment_requested_at = Column(DateTime, nullable=True)
+    stock_confirmed_at = Column(DateTime, nullable=True)
+    stock_rejected_at = Column(DateTime, nullable=True)
+    payment_authorized_at = Column(DateTime, nullable=True)
+    paid_at = Column(DateTime, nullable=True)
+    shipped_at = Column(DateTime, nullable=True)
+    cancelled_at = Column(DateTime, nullable=True)
+
+    # bumped by every update of the order row, replication events carry it so the query side
+    # can drop changes older than the ones it already holds
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    __table_args__ = (
+        Index('ix_orders_created_at', 'created_at'),
+        # orders still in the saga, submitted, awaiting validation or stock confirmed
+        Index('ix_orders_in_flight', 'created_at', postgresql_where=text('order_status_id IN (1, 2, 3)')),
+    )
+
+    # declared here rather than as a backref so Order.order_items can be eager loaded
+    # before the OrderItem mapper has been configured
+    order_items = relationship('OrderItem', back_populates='order')
 
     def __init__(self, customer_id, address):
         self.order_status_id = OrderStatus.Submitted.value
@@ -121,7 +148,7 @@ class Order(DeclarativeBase):
     def set_awaiting_validation_status(self):
         if self.order_status_id == OrderStatus.Submitted.value:
             self.order_status_id = OrderStatus.AwaitingValidation.value
-            self.updated_at = datetime.datetime.utcnow()
+            self.awaiting_validation_at = self.updated_at = datetime.datetime.utcnow()
 
     def set_cancelled_status(self):
         if self.order_status_id == OrderStatus.Paid.value or self.order_status_id == OrderStatus.Shipped.value:
@@ -129,7 +156,7 @@ class Order(DeclarativeBase):
 
         self.order_status_id = OrderStatus.Cancelled.value
         self.description = 'The order was cancelled'
-        self.updated_at = datetime.datetime.utcnow()
+        self.cancelled_at = self.updated_at = datetime.datetime.utcnow()
 
     def set_cancelled_status_when_stock_is_rejected(self, order_stock_rejected_items: []):
         if self.order_status_id == OrderStatus.AwaitingValidation.value:
@@ -143,24 +170,38 @@ class Order(DeclarativeBase):
 
             description = ",".join(ls)
             self.description = 'The product items do not have stock: ({})'.format(description)
+            self.stock_rejected_at = self.cancelled_at = self.updated_at = datetime.datetime.utcnow()
+
+    def set_cancelled_status_when_payment_failed(self):
+        if self.order_status_id in (OrderStatus.AwaitingValidation.value, OrderStatus.StockConfirmed.value):
+            self.order_status_id = OrderStatus.Cancelled.value
+            self.description = 'The payment for this order was declined'
+            self.cancelled_at = self.updated_at = datetime.datetime.utcnow()
 
     def set_stock_confirmed_status(self):
         if self.order_status_id == OrderStatus.AwaitingValidation.value:
             self.order_status_id = OrderStatus.StockConfirmed.value
-            self.updated_at = datetime.datetime.utcnow()
+            self.stock_confirmed_at = self.updated_at = datetime.datetime.utcnow()
+
+    def set_payment_authorized(self):
+        self.payment_authorized_at = datetime.datetime.utcnow()
 
     def set_paid_status(self):
         if self.order_status_id == OrderStatus.StockConfirmed.value:
             self.order_status_id = OrderStatus.Paid.value
-            self.updated_at = datetime.datetime.utcnow()
+            self.paid_at = self.updated_at = datetime.datetime.utcnow()
             self.description = 'The payment for this order has been performed (simulated)'
 
+    @property
+    def validated_in_parallel(self):
+        return self.payment_requested_at is not None
+
     def set_shipped_status(self):
         if self.order_status_id != OrderStatus.Paid.value:
             self.status_change_error(OrderStatus.Shipped.name)
 
         self.order_status_id = OrderStatus.Shipped.value
-        self.updated_at = datetime.datetime.utcnow()
+        self.shipped_at = self.updated_at = datetime.datetime.utcnow()
         self.description = 'The order was shipped.'
 
     def get_total(self):
@@ -178,7 +219,7 @@ class OrderItem(DeclarativeBase):
 
     id = Column(BigInteger, primary_key=True)
     order_id = Column(BigInteger, ForeignKey('orders.id', name='fk_order_details_order'))
-    order = relationship(Order, backref='order_items')
+    order = relationship(Order, back_populates='order_items')
     product_id = Column(Integer)
     product_name = Column(String)
     unit_price = Column(Float)
@@ -210,7 +251,10 @@ class Buyer(DeclarativeBase):
     id = Column(BigInteger, primary_key=True)
     user_id = Column(BigInteger, nullable=False)
     name = Column(String, nullable=False)
-    payment_methods = []
+    payment_methods = relationship('PaymentMethod', back_populates='buyer')
+
+    # one buyer per user, checkouts resolve their buyer by user_id
+    __table_args__ = Index('ix_buyers_user_id', 'user_id', unique=True),
 
     def __init__(self, user_id, name):
         self.user_id = user_id
@@ -218,8 +262,10 @@ class Buyer(DeclarativeBase):
 
     def verify_or_add_payment_method(self, alias, card_number, security_number, card_type_id,
                                      cardholder_name, expiration):
+        fingerprint = PaymentMethod.fingerprint_of(card_type_id, card_number, expiration)
+
         existing_payment = Enumerable(self.payment_methods) \
-            .where(lambda x: x.is_equal_to(card_type_id, card_number, expiration)) \
+            .where(lambda x: x.fingerprint == fingerprint) \
             .first_or_default()
 
         if existing_payment is not None:
@@ -233,6 +279,7 @@ class Buyer(DeclarativeBase):
             payment.alias = alias
             payment.cardholder_name = cardholder_name
             payment.security_number = security_number
+            payment.fingerprint = fingerprint
 
             self.payment_methods.append(payment)
 
@@ -245,7 +292,7 @@ class PaymentMethod(DeclarativeBase):
     id = Column(BigInteger, primary_key=True)
     buyer_id = Column(BigInteger,
                       ForeignKey('buyers.id', name='fk_payment_methods_buyers'))
-    buyer = relationship(Buyer, backref='payment_methods')
+    buyer = relationship(Buyer, back_populates='payment_methods')
     card_type_id = Column(Integer)
     cardholder_name = Column(String)
     alias = Column(String)
@@ -253,6 +300,17 @@ class PaymentMethod(DeclarativeBase):
     expiration = Column(String)
     security_number = Column(String)
 
+    # md5 of card type, number and expiration, what is_equal_to compares, so a buyer's
+    # card can be looked up with the index instead of comparing every payment method
+    fingerprint = Column(String(32), nullable=True)
+
+    __table_args__ = Index('ix_payment_methods_buyer_fingerprint', 'buyer_id', 'fingerprint'),
+
+    @staticmethod
+    def fingerprint_of(card_type_id, card_number, expiration):
+        """ matches the md5(card_type_id || ':' || card_number || ':' || expiration) backfill in dbmigrate """
+        return hashlib.md5(f'{card_type_id}:{card_number}:{expiration}'.encode('utf-8')).hexdigest()
+
     def is_equal_to(self, card_type_id, card_number, expiration):
         return (
                 self.card_type_id == card_type_id and
@@ -261,6 +319,10 @@ class PaymentMethod(DeclarativeBase):
         )
 
 
+# listeners only attach to clients created afterwards, so instrument before connecting
+instrument_sqlalchemy()
+instrument_pymongo()
+
 connect(os.getenv('MONGO_DATABASE', 'orders'),
         host=os.getenv('MONGO_HOST', '127.0.0.1'),
         port=int(os.getenv('MONGO_PORT', 27017)))
@@ -311,3 +373,8 @@ class QueryOrderModel(Document):
     buyer = EmbeddedDocumentField(QueryBuyerModel)
     address = EmbeddedDocumentField(QueryAddressModel)
     payment_method = EmbeddedDocumentField(QueryPaymentMethod)
+    version = IntField()
+
+    meta = {
+        'indexes': [('buyer_id', 'id')]
+    }
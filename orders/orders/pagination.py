@@ -0,0 +1,94 @@
+import base64
+import json
+import os
+
+from bson import json_util
+
+from .exceptions import InvalidCursor
+
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 500))
+
+
+def encode_cursor(last_id):
+    """ opaque token for the last id returned on a page """
+    return base64.urlsafe_b64encode(json.dumps(last_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+
+
+def page_size(limit):
+    """ applies the default and the server side cap to the requested page size """
+    if not limit:
+        return DEFAULT_PAGE_SIZE
+
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def keyset_page(queryset, after=None, limit=None):
+    """
+    Returns one page of the queryset ordered by _id, starting after the id encoded in the cursor.
+
+    Filtering on _id > last_id instead of skipping means every page costs the same index seek,
+    no matter how deep the client has paged.
+    :param queryset:
+    :param after: cursor returned as next_cursor by the previous page
+    :param limit:
+    :return: json document {"items": [...], "next_cursor": <cursor or null>}
+    """
+    items, next_cursor = _fetch_page(queryset, after, limit)
+    return json_util.dumps({'items': items, 'next_cursor': next_cursor})
+
+
+def ndjson_page(queryset, after=None, limit=None):
+    """
+    Same paging as keyset_page, but the rows are serialized as newline delimited json so the
+    gateway can write them straight to a streaming response without parsing them again.
+    :param queryset:
+    :param after:
+    :param limit:
+    :return: dict {"rows": <ndjson text>, "next_cursor": <cursor or None>}
+    """
+    items, next_cursor = _fetch_page(queryset, after, limit)
+    rows = ''.join(json_util.dumps(item) + '\n' for item in items)
+    return {'rows': rows, 'next_cursor': next_cursor}
+
+
+def get_by_ids(queryset, ids):
+    """
+    Returns the documents matching any of the ids with a single $in query, ids that do not
+    exist are left out of the result.
+    :param queryset:
+    :param ids: at most MAX_PAGE_SIZE ids, more raise a ValueError instead of being dropped
+    :return: json array
+    """
+    ids = list(ids)
+    if len(ids) > MAX_PAGE_SIZE:
+        raise ValueError(f'at most {MAX_PAGE_SIZE} ids can be read at once, {len(ids)} were requested')
+    return json_util.dumps(list(queryset.filter(id__in=ids).as_pymongo()))
+
+
+def _fetch_page(queryset, after, limit):
+    limit = page_size(limit)
+    last_id = decode_cursor(after)
+
+    if last_id is not None:
+        queryset = queryset.filter(id__gt=last_id)
+
+    # read one extra row to know whether there is another page without a count()
+    items = list(queryset.order_by('id').limit(limit + 1).as_pymongo())
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1]['_id'])
+
+    return items, next_cursor
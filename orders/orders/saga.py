@@ -0,0 +1,94 @@
+import datetime
+
+from sqlalchemy import extract, func
+from sqlalchemy.dialects.postgresql import array
+
+from .models import Order, OrderStatus
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+IN_FLIGHT = (OrderStatus.Submitted.value, OrderStatus.AwaitingValidation.value, OrderStatus.StockConfirmed.value)
+
+# stage name -> (column the stage starts at, column it ends at), a stage the order never
+# reached has a NULL end and is left out of the aggregates
+STAGES = {
+    'buyer_verification': (Order.created_at, Order.awaiting_validation_at),
+    'stock_validation': (Order.awaiting_validation_at, func.coalesce(Order.stock_confirmed_at, Order.stock_rejected_at)),
+    # requested together with the stock check in parallel mode, after it otherwise
+    'payment': (func.coalesce(Order.payment_requested_at, Order.stock_confirmed_at), Order.payment_authorized_at),
+    'checkout_to_paid': (Order.created_at, Order.paid_at),
+    'shipping': (Order.paid_at, Order.shipped_at)
+}
+
+
+def _seconds(start, end):
+    return extract('epoch', end - start)
+
+
+def stage_latency(session, since):
+    """
+    Per stage count and p50/p95/p99 in seconds of the orders created since, computed by
+    postgres in a single pass over ix_orders_created_at
+    :param session:
+    :param since: utc datetime
+    :return: {stage: {'count': n, 'p50': s, 'p95': s, 'p99': s}}
+    """
+    columns = []
+    for start, end in STAGES.values():
+        duration = _seconds(start, end)
+        columns += [func.count(duration), func.percentile_cont(array(PERCENTILES)).within_group(duration)]
+
+    row = session.query(*columns).filter(Order.created_at >= since).one()
+
+    stages = {}
+    for n, name in enumerate(STAGES):
+        count, values = row[2 * n], row[2 * n + 1]
+        stages[name] = {'count': count}
+        for percentile, value in zip(PERCENTILES, values or [None] * len(PERCENTILES)):
+            stages[name][f'p{int(percentile * 100)}'] = value
+
+    return stages
+
+
+def _current_stage(order):
+    """ the stage an in-flight order is waiting in and when it entered it """
+    if order.order_status_id == OrderStatus.Submitted.value:
+        return 'buyer_verification', order.created_at
+
+    if order.order_status_id == OrderStatus.AwaitingValidation.value:
+        if order.payment_requested_at is not None and order.payment_authorized_at is None:
+            return 'stock_and_payment_validation', order.awaiting_validation_at
+        return 'stock_validation', order.awaiting_validation_at or order.created_at
+
+    return 'payment', order.payment_requested_at or order.stock_confirmed_at or order.created_at
+
+
+def slowest_in_flight(session, limit):
+    """
+    The oldest orders which are still in the saga, read from the partial ix_orders_in_flight index
+    :param session:
+    :param limit:
+    :return:
+    """
+    now = datetime.datetime.utcnow()
+
+    orders = session.query(Order.id, Order.order_status_id, Order.created_at, Order.awaiting_validation_at,
+                           Order.payment_requested_at, Order.stock_confirmed_at, Order.payment_authorized_at) \
+        .filter(Order.order_status_id.in_(IN_FLIGHT)) \
+        .order_by(Order.created_at) \
+        .limit(limit) \
+        .all()
+
+    slowest = []
+    for order in orders:
+        stage, entered_at = _current_stage(order)
+        slowest.append({
+            'order_id': order.id,
+            'order_status': OrderStatus(order.order_status_id).name,
+            'stage': stage,
+            'created_at': order.created_at.isoformat(),
+            'age_seconds': (now - order.created_at).total_seconds(),
+            'stage_seconds': (now - entered_at).total_seconds()
+        })
+
+    return slowest
@@ -8,10 +8,21 @@ from datetime import datetime as dt
 from nameko.events import event_handler, EventDispatcher
 from nameko_sqlalchemy import DatabaseSession
 from nameko.rpc import rpc
+from nameko.timer import timer
 from nameko.web.handlers import http
-
-from .exceptions import NotFound
+from sqlalchemy import and_, inspect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
+
+from .batching import batch_event_handler, apply_batch
+from .cache import LRUCache
+from .exceptions import InvalidCursor, NotFound
+from .metrics import Metrics, metrics_response
 from .models import *
+from .outbox import OUTBOX_RELAY_INTERVAL, Outbox, relay
+from .pagination import keyset_page, get_by_ids
+from .projection import Projection
+from .saga import stage_latency, slowest_in_flight
 
 import mongoengine
 
@@ -27,6 +38,15 @@ PRODUCTS_SERVICE = 'command_products'
 BASKET_SERVICE = 'basket_service'
 WAREHOUSE_COMMAND_SERVICE = 'command_item'
 
+# the only order fields which change after creation, every replication event carries all of them
+ORDER_STATUS_FIELDS = ('order_status_id', 'description', 'updated_at')
+
+# request payment authorization together with the stock check instead of after it
+PARALLEL_ORDER_VALIDATION = os.getenv('PARALLEL_ORDER_VALIDATION', 'false').lower() in ('1', 'true', 'yes')
+
+# user_id -> (buyer id, buyer name) of returning buyers, a buyer is never changed or removed once created
+BUYER_CACHE = LRUCache(int(os.getenv('BUYER_CACHE_SIZE', 10000)))
+
 
 class CommandOrders:
     """
@@ -35,36 +55,194 @@ class CommandOrders:
 
     name = ORDER_COMMAND_SERVICE
     dispatch = EventDispatcher()
+    outbox = Outbox()
     db = DatabaseSession(DeclarativeBase)
+    metrics = Metrics()
 
     def fire_replicated_db_event(self, data):
         """
-        Fires off a database replication event with an order payload
+        Adds a database replication event with an order payload to the outbox, it is published
+        once the transaction it was added in commits
         :param data:
         :return:
         """
-        self.dispatch(REPLICATE_DB_EVENT, json.dumps(data))
+        self.outbox(REPLICATE_DB_EVENT, data, aggregate_id=data['id'])
+
+    @timer(interval=OUTBOX_RELAY_INTERVAL)
+    def relay_outbox(self):
+        """ publishes the committed events the worker which wrote them failed to relay """
+        relay(self.db, self.name, self.dispatch)
 
-    def _get_order(self, order_id):
+    def _get_order(self, order_id, lock=False):
         """
         Returns an order based on the provided order id, this is an internal method only,
         orders cannot be created from external sources, only from integration event processing.
+
+        The address, items, buyer and payment method are joined into the same query, serializing
+        the order afterwards doesn't lazy load them one at a time.
         :param order_id:
+        :param lock: lock the order row until commit, for handlers racing on the same order
+        :return:
+        """
+        query = self.db.query(Order) \
+            .options(joinedload(Order.address),
+                     joinedload(Order.order_items),
+                     joinedload(Order.buyer),
+                     joinedload(Order.payment_method))
+
+        if lock:
+            # only the orders row, FOR UPDATE can't lock the nullable side of the outer joins
+            query = query.with_for_update(of=Order)
+
+        return query.get(order_id)
+
+    @staticmethod
+    def _order_stock_items(order):
+        return [{'product_id': item.product_id, 'units': item.units} for item in order.order_items]
+
+    def _set_paid(self, order):
+        """
+        Moves an order whose stock is confirmed and payment authorized to paid, the caller commits
+        :param order:
         :return:
         """
-        return self.db.query(Order).get(order_id)
+        order.set_paid_status()
+
+        self._save_order(order)
+
+        self.outbox('order_status_changed_to_paid',
+                    {'order_id': order.id, 'order_stock_items': self._order_stock_items(order)},
+                    aggregate_id=order.id)
+
+        self.metrics.observe('order_checkout_to_paid_seconds', (order.paid_at - order.created_at).total_seconds(),
+                             mode='parallel' if order.validated_in_parallel else 'sequential')
+
+    def _cancel(self, order, payload):
+        """
+        Publishes the cancellation of an order, and when its payment was already authorized while
+        the stock was being checked asks the payment service to void it. The caller commits
+        :param order: order already moved to cancelled
+        :param payload: cancellation event
+        :return:
+        """
+        self._save_order(order)
+
+        self.outbox('order_status_changed_to_cancelled', payload, aggregate_id=order.id)
+
+        if order.payment_authorized_at is not None:
+            self.outbox('order_payment_void_requested', {'order_id': order.id}, aggregate_id=order.id)
+
+    def _get_payment_method(self, payment_id):
+        """
+        Returns a payment method together with the buyer it belongs to, loaded with one query
+        :param payment_id:
+        :return:
+        """
+        return self.db.query(PaymentMethod) \
+            .options(joinedload(PaymentMethod.buyer)) \
+            .get(payment_id)
+
+    def _find_buyer_payment_method(self, user_id, fingerprint):
+        """
+        Resolves the buyer of a user and the buyer's payment method with the given fingerprint
+        with one indexed query, a cached buyer only needs its payment method looked up.
+        :param user_id:
+        :param fingerprint: PaymentMethod.fingerprint_of the card used
+        :return: (buyer id, buyer name, payment method), the ids are None for a new buyer
+        and the payment method is None for a card the buyer hasn't used before
+        """
+        cached = BUYER_CACHE.get(user_id)
+        self.metrics.inc('buyer_cache_lookups_total', result='hit' if cached is not None else 'miss')
+
+        if cached is not None:
+            buyer_id, buyer_name = cached
+            payment = self.db.query(PaymentMethod) \
+                .filter(PaymentMethod.buyer_id == buyer_id, PaymentMethod.fingerprint == fingerprint) \
+                .first()
+            return buyer_id, buyer_name, payment
+
+        row = self.db.query(Buyer.id, Buyer.name, PaymentMethod) \
+            .outerjoin(PaymentMethod, and_(PaymentMethod.buyer_id == Buyer.id,
+                                           PaymentMethod.fingerprint == fingerprint)) \
+            .filter(Buyer.user_id == user_id) \
+            .first()
+
+        if row is None:
+            return None, None, None
+
+        BUYER_CACHE.set(user_id, (row.id, row.name))
+        return row.id, row.name, row.PaymentMethod
+
+    def _add_buyer(self, user_id, name):
+        """
+        Creates the buyer of a user, or returns the existing one when a concurrent checkout of
+        the same user created it first
+        :param user_id:
+        :param name:
+        :return: (buyer id, buyer name)
+        """
+        row = self.db.execute(
+            insert(Buyer.__table__)
+            .values(user_id=user_id, name=name)
+            .on_conflict_do_nothing(index_elements=['user_id'])
+            .returning(Buyer.id, Buyer.name)
+        ).first()
+
+        if row is None:
+            row = self.db.query(Buyer.id, Buyer.name).filter(Buyer.user_id == user_id).one()
+
+        return row.id, row.name
 
     def _save_order(self, order):
         """
-        Saves an order to the command database, and kicks off a replication event.
+        Flushes an order to the command database and adds its replication event to the outbox,
+        the caller commits both together with the events it adds itself.
+
+        A new order is replicated in full, after that only the status fields, which every event
+        carries, and the buyer or payment method when they were just assigned. Every event carries
+        the order version so the query side can skip changes it has already seen.
         :param order:
         :return:
         """
+        state = inspect(order)
+        created = state.transient or state.pending
+        modified = created or self.db.is_modified(order)
+        changed_sections = [name for name in ('buyer', 'payment_method') if state.attrs[name].history.has_changes()]
+
         self.db.add(order)
-        self.db.commit()
+        self.db.flush()
+
+        if not modified:
+            return
+
+        if created:
+            data = self._order_document(order)
+        else:
+            data = self._order_delta(order, changed_sections)
+
+        self.fire_replicated_db_event(data)
 
+    def _order_delta(self, order, sections):
         data = {
             'id': order.id,
+            'version': order.version,
+            'order_status_id': order.order_status_id,
+            'description': order.description,
+            'updated_at': str(order.updated_at)
+        }
+
+        if 'buyer' in sections:
+            data.update(self._buyer_section(order))
+
+        if 'payment_method' in sections:
+            data.update(self._payment_method_section(order))
+
+        return data
+
+    def _order_document(self, order):
+        data = {
+            'id': order.id,
+            'version': order.version,
             'customer_id': order.customer_id,
             'address': {
                 'id': order.address.id,
@@ -89,28 +267,43 @@ class CommandOrders:
                             for item in order.order_items]
         }
 
-        """At this point a buyer may not exist due to domain processing, check to see if it 
+        data.update(self._buyer_section(order))
+        data.update(self._payment_method_section(order))
+
+        return data
+
+    @staticmethod
+    def _buyer_section(order):
+        """At this point a buyer may not exist due to domain processing, check to see if it
         exists before trying to add it to the dictionary"""
-        if order.buyer is not None:
-            data['buyer_id'] = order.buyer_id
-            data['buyer'] = {
+        if order.buyer is None:
+            return {}
+
+        return {
+            'buyer_id': order.buyer_id,
+            'buyer': {
                 'id': order.buyer.id,
                 'name': order.buyer.name
             }
+        }
 
+    @staticmethod
+    def _payment_method_section(order):
         """At this point a payment_method may not exist due to domain processing, check to see if it
         exists before trying to add it to the dictionary"""
-        if order.payment_method is not None:
-            data['payment_method_id'] = order.payment_method_id
-            data['payment_method'] = {
+        if order.payment_method is None:
+            return {}
+
+        return {
+            'payment_method_id': order.payment_method_id,
+            'payment_method': {
                 'id': order.payment_method.id,
                 'alias': order.payment_method.alias,
                 'cardholder_name': order.payment_method.cardholder_name,
                 'expiration': order.payment_method.expiration,
                 'card_number': order.payment_method.card_number[-4:]
             }
-
-        self.fire_replicated_db_event(data)
+        }
 
     @event_handler(ORDER_COMMAND_SERVICE, 'order_started')
     def validate_or_add_buyer_on_order_started(self, payload):
@@ -126,42 +319,52 @@ class CommandOrders:
         if isinstance(payload, str):
             payload = json.loads(payload)
 
-        buyer = self.db.query(Buyer).filter(Buyer.user_id == payload['user_id']).first()
-        buyer_originally_existed = buyer is not None
+        fingerprint = PaymentMethod.fingerprint_of(payload['card_type_id'], payload['card_number'],
+                                                   payload['expiration'])
 
-        if not buyer_originally_existed:
-            buyer = Buyer(payload['user_id'], payload['user_name'])
+        buyer_id, buyer_name, payment = self._find_buyer_payment_method(payload['user_id'], fingerprint)
 
-        payment = buyer.verify_or_add_payment_method(f'Payment Method on {datetime.datetime.utcnow()}',
-                                                     payload['card_number'],
-                                                     payload['security_number'],
-                                                     payload['card_type_id'],
-                                                     payload['cardholder_name'],
-                                                     payload['expiration'])
+        if buyer_id is None:
+            buyer_id, buyer_name = self._add_buyer(payload['user_id'], payload['user_name'])
 
-        self.db.add(buyer)
-        self.db.commit()
+        if payment is None:
+            payment = PaymentMethod(buyer_id=buyer_id,
+                                    alias=f'Payment Method on {datetime.datetime.utcnow()}',
+                                    card_number=payload['card_number'],
+                                    security_number=payload['security_number'],
+                                    card_type_id=payload['card_type_id'],
+                                    cardholder_name=payload['cardholder_name'],
+                                    expiration=payload['expiration'],
+                                    fingerprint=fingerprint)
+
+            self.db.add(payment)
+            self.db.flush()
 
         order_submitted_msg = dict(
             order_id=payload['order']['id'],
             order_status_id=payload['order']['order_status_id'],
-            buyer_name=buyer.name
+            buyer_name=buyer_name
         )
 
         buyer_msg = {
-            'buyer_id': buyer.id,
+            'buyer_id': buyer_id,
             'payment_id': payment.id,
             'order_id': payload['order']['id']
         }
 
         # fire message that the buyer/payment method were verified
-        self.dispatch('buyer_payment_verified', buyer_msg)
+        self.outbox('buyer_payment_verified', buyer_msg, aggregate_id=payload['order']['id'])
 
         # fire message that the order should be marked as submitted
-        self.dispatch('order_status_submitted', order_submitted_msg)
+        self.outbox('order_status_submitted', order_submitted_msg, aggregate_id=payload['order']['id'])
+
+        self.db.commit()
+
+        # only cached once committed, a rolled back buyer must not be handed to the next checkout
+        BUYER_CACHE.set(payload['user_id'], (buyer_id, buyer_name))
 
         logger.info(
-            f'{dt.utcnow()}: Buyer {buyer.id} and related payment method was validated for order_id: \
+            f'{dt.utcnow()}: Buyer {buyer_msg["buyer_id"]} and related payment method was validated for order_id: \
                 {payload["order"]["id"]}')
 
     @event_handler(ORDER_COMMAND_SERVICE, 'buyer_payment_verified')
@@ -173,30 +376,43 @@ class CommandOrders:
         """
         order_id = event_msg.get('order_id')
 
-        order = self.db.query(Order).get(order_id)
+        order = self._get_order(order_id, lock=True)
 
         if order is None:
             raise NotFound(f'No order found for id {order_id}.')
 
-        buyer = self.db.query(Buyer).get(event_msg.get('buyer_id'))
-        payment = self.db.query(PaymentMethod).get(event_msg.get('payment_id'))
+        payment = self._get_payment_method(event_msg.get('payment_id'))
+
+        if payment is None:
+            raise NotFound(f'No payment method found for id {event_msg.get("payment_id")}.')
 
-        order.buyer = buyer
+        order.buyer = payment.buyer
         order.payment_method = payment
 
         order.set_awaiting_validation_status()
 
+        if PARALLEL_ORDER_VALIDATION:
+            order.payment_requested_at = datetime.datetime.utcnow()
+
         self._save_order(order)
 
         payload = {
-            'order_id': order.id,
-            'order_stock_items': [{'product_id': od.product_id, 'units': od.units}
-                                  for od in order.order_items]
+            'order_id': order_id,
+            'order_stock_items': self._order_stock_items(order),
+            # the warehouse reserves the stock at the sites nearest the shipping address
+            'zip_code': order.address.zip_code
         }
 
-        self.dispatch('order_status_changed_to_awaiting_validation', payload)
+        self.outbox('order_status_changed_to_awaiting_validation', payload, aggregate_id=order_id)
 
-        logger.info(f'{dt.utcnow()}: order_id: {order.id} status set to Awaiting Validation')
+        if order.validated_in_parallel:
+            # the payment service authorizes while the warehouse checks stock, whichever reply
+            # comes second moves the order to paid
+            self.outbox('order_payment_requested', {'order_id': order_id}, aggregate_id=order_id)
+
+        self.db.commit()
+
+        logger.info(f'{dt.utcnow()}: order_id: {order_id} status set to Awaiting Validation')
 
     @event_handler(ORDER_COMMAND_SERVICE, 'order_status_changed_to_submitted')
     def order_submitted(self, payload):
@@ -226,7 +442,8 @@ class CommandOrders:
 
         self._save_order(order)
 
-        self.dispatch('order_status_changed_to_shipped', payload)
+        self.outbox('order_status_changed_to_shipped', payload, aggregate_id=order.id)
+        self.db.commit()
 
     @event_handler(BASKET_SERVICE, 'user_checkout_accepted')
     def create_order_from_basket(self, payload):
@@ -268,10 +485,12 @@ class CommandOrders:
             'order': {"id": order.id, "order_status_id": order.order_status_id}
         }
 
-        self.dispatch('order_status_changed_to_submitted', {'order_id': order.id})
-        self.dispatch('order_started', validate_buyer_payload)
+        self.outbox('order_status_changed_to_submitted', {'order_id': order.id}, aggregate_id=order.id)
+        self.outbox('order_started', validate_buyer_payload, aggregate_id=order.id)
+        self.db.commit()
 
-        logger.info(f'{dt.utcnow()}: order_id: {order.id} submitted for buyer_id: {payload["user_id"]}.')
+        logger.info(f'{dt.utcnow()}: order_id: {validate_buyer_payload["order"]["id"]} submitted for buyer_id: '
+                    f'{payload["user_id"]}.')
 
     @event_handler(WAREHOUSE_COMMAND_SERVICE, 'confirmed_order_stock')
     def order_stock_confirmed(self, payload):
@@ -279,7 +498,9 @@ class CommandOrders:
         integration event handler
 
         When the stock for an order is confirmed, update the order, and
-        trigger a order_stock_confirmed message
+        trigger a order_stock_confirmed message. When the payment was requested at the
+        same time the order moves straight to paid once it is authorized, there is nothing
+        to trigger
         :param payload:
         :return:
         """
@@ -289,19 +510,46 @@ class CommandOrders:
 
         order_id = payload['order_id']
 
-        order = self._get_order(order_id)
+        order = self._get_order(order_id, lock=True)
 
         if order is None:
             raise NotFound()
 
+        if order.order_status_id in (OrderStatus.StockConfirmed.value, OrderStatus.Paid.value,
+                                     OrderStatus.Shipped.value):
+            # a confirmation delivered again, the order already moved on
+            logger.info(f'{dt.utcnow()}: order_id: {order_id} stock already confirmed, redelivery ignored')
+            return
+
+        if not order.validated_in_parallel:
+            order.set_stock_confirmed_status()
+
+            self._save_order(order)
+
+            #time.sleep(5)
+            self.outbox('order_status_changed_to_stock_confirmed', {'order_id': order_id}, aggregate_id=order_id)
+            self.db.commit()
+
+            logger.info(f'{dt.utcnow()}: order_id: {order_id} status set to STOCK_CONFIRMED')
+            return
+
+        if order.order_status_id == OrderStatus.Cancelled.value:
+            # the payment was declined while the stock was checked, cancel again so the
+            # warehouse releases what it just confirmed
+            self.outbox('order_status_changed_to_cancelled', {'order_id': order_id}, aggregate_id=order_id)
+            self.db.commit()
+            return
+
         order.set_stock_confirmed_status()
 
-        self._save_order(order)
+        if order.payment_authorized_at is not None:
+            self._set_paid(order)
+        else:
+            self._save_order(order)
 
-        #time.sleep(5)
-        self.dispatch('order_status_changed_to_stock_confirmed', {'order_id': order_id})
+        self.db.commit()
 
-        logger.info(f'{dt.utcnow()}: order_id: {order.id} status set to STOCK_CONFIRMED')
+        logger.info(f'{dt.utcnow()}: order_id: {order_id} stock confirmed')
 
     @event_handler(WAREHOUSE_COMMAND_SERVICE, 'rejected_order_stock')
     def handle_rejected_order_stock(self, payload):
@@ -309,6 +557,7 @@ class CommandOrders:
         integration event handler
 
         When there is not enough inventory of one or more order_items the order is rejected due to insufficient stock.
+        A payment authorized in the meantime is voided
         :param payload:
         :return:
         """
@@ -318,7 +567,7 @@ class CommandOrders:
 
         order_id = payload['order_id']
 
-        order = self.db.query(Order).get(order_id)
+        order = self._get_order(order_id, lock=True)
 
         if order is None:
             raise NotFound(f'No order found for order_id: {order_id}')
@@ -326,9 +575,28 @@ class CommandOrders:
         rejected_stock = [item['product_id'] for item in payload['order_stock_items']]
         order.set_cancelled_status_when_stock_is_rejected(rejected_stock)
 
-        self._save_order(order)
+        self._cancel(order, payload)
+        self.db.commit()
+
+    @event_handler(WAREHOUSE_COMMAND_SERVICE, 'order_stock_shortfall')
+    def handle_order_stock_shortfall(self, payload):
+        """
+        integration event handler
+
+        A paid order whose reservation expired before the payment, and whose stock was sold
+        meanwhile, can't be shipped from stock. Paid orders can't be cancelled, so the order is
+        counted and logged for it to be restocked or refunded by hand
+        :param payload:
+        :return:
+        """
 
-        self.dispatch('order_status_changed_to_cancelled', payload)
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+
+        missing = {item['product_id']: item['missing'] for item in payload['order_stock_items'] if item['missing']}
+
+        self.metrics.inc('order_stock_shortfalls_total')
+        logger.error(f'{dt.utcnow()}: order_id: {payload["order_id"]} paid but short of stock: {missing}')
 
     @event_handler(PAYMENTS_SERVICE, 'order_payment_succeeded')
     def order_payment_succeeded(self, payload):
@@ -336,7 +604,9 @@ class CommandOrders:
         integration event handler
 
         Once the payment is validated update the order to indicated that the it is paid, then fire an event
-        with a collection of the order items, the products service will pick it up and decrement inventory
+        with a collection of the order items, the products service will pick it up and decrement inventory.
+        A payment requested together with the stock check can arrive first, the order then waits for
+        the stock confirmation, or it arrives for an order cancelled meanwhile and is voided
         :param payload:
         :return:
         """
@@ -346,26 +616,78 @@ class CommandOrders:
 
         order_id = payload['order_id']
 
-        order = self._get_order(order_id)
+        order = self._get_order(order_id, lock=True)
 
         if order is None:
             raise NotFound(f'No order found for order_id: {order_id}')
 
-        order.set_paid_status()
+        order.set_payment_authorized()
 
-        self._save_order(order)
+        if order.order_status_id == OrderStatus.StockConfirmed.value:
+            self._set_paid(order)
+            logger.info(f'{dt.utcnow()}: order_id: {order_id} status set to PAID.')
+        elif order.order_status_id == OrderStatus.Cancelled.value:
+            self._save_order(order)
+            self.outbox('order_payment_void_requested', {'order_id': order_id}, aggregate_id=order_id)
+        else:
+            self._save_order(order)
 
-        payload = {
-            'order_id': order_id,
-            'order_stock_items': [{'product_id': item.product_id,
-                                   'units': item.units}
-                                  for item in order.order_items]
+        #time.sleep(15)
+        self.db.commit()
+
+    @event_handler(PAYMENTS_SERVICE, 'order_payment_failed')
+    def order_payment_failed(self, payload):
+        """
+        integration event handler
+
+        A declined payment cancels the order, when the stock was confirmed in parallel the
+        cancellation lets the warehouse release it
+        :param payload:
+        :return:
+        """
+
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+
+        order_id = payload['order_id']
+
+        order = self._get_order(order_id, lock=True)
+
+        if order is None:
+            raise NotFound(f'No order found for order_id: {order_id}')
+
+        if order.order_status_id not in (OrderStatus.AwaitingValidation.value, OrderStatus.StockConfirmed.value):
+            return
+
+        order.set_cancelled_status_when_payment_failed()
+
+        self._cancel(order, {'order_id': order_id})
+        self.db.commit()
+
+        logger.info(f'{dt.utcnow()}: order_id: {order_id} cancelled, the payment was declined')
+
+    @rpc
+    def saga_latency(self, window_minutes=60, slowest=10):
+        """
+        checkout-to-paid SLO report, per stage p50/p95/p99 in seconds of the orders created in the
+        last window_minutes and the oldest orders still in the saga
+        :param window_minutes:
+        :param slowest: number of in-flight orders returned
+        :return:
+        """
+        since = datetime.datetime.utcnow() - datetime.timedelta(minutes=window_minutes)
+
+        report = {
+            'window_minutes': window_minutes,
+            'since': since.isoformat(),
+            'stages': stage_latency(self.db, since),
+            'slowest_in_flight': slowest_in_flight(self.db, slowest)
         }
 
-        #time.sleep(15)
-        self.dispatch('order_status_changed_to_paid', payload)
+        # read only, ends the transaction the queries opened
+        self.db.rollback()
 
-        logger.info(f'{dt.utcnow()}: order_id: {order.id} status set to PAID.')
+        return report
 
 
 class QueryOrders:
@@ -374,79 +696,74 @@ class QueryOrders:
     read-only service.
     """
     name = ORDER_QUERY_SERVICE
+    metrics = Metrics()
 
-    @event_handler(ORDER_COMMAND_SERVICE, REPLICATE_DB_EVENT)
-    def normalize_db(self, data):
-        """ used to write changes into the orders query db"""
-        if isinstance(data, str):
-            data = json.loads(data)
+    @http('GET', '/metrics')
+    def get_metrics(self, request):
+        """ latency, error and worker saturation metrics of every service in this process """
+        return metrics_response()
+
+    @batch_event_handler(ORDER_COMMAND_SERVICE, REPLICATE_DB_EVENT)
+    def normalize_db(self, payloads):
+        """
+        used to write changes into the orders query db, the snapshots of a batch are collapsed
+        to the latest one per order and written with one bulk upsert. Raising requeues the batch
+        """
         try:
-            buyer = None
-            payment_method = None
-            print('No Buyer' if data['buyer'] is None else data['buyer']['id'])
-            if data['buyer'] is not None:
-                buyer = QueryBuyerModel(
-                    id=data['buyer']['id'],
-                    name=data['buyer']['name']
-                )
-            if data['payment_method'] is not None:
-                payment_method = QueryPaymentMethod(
-                    id=data['payment_method']['id'],
-                    alias=data['payment_method']['alias'],
-                    cardholder_name=data['payment_method']['cardholder_name'],
-                    expiration=data['payment_method']['expiration'],
-                    card_number=data['payment_method']['card_number']
-                )
-
-            order = QueryOrderModel.objects.get(id=data['id'])
-            order.update(
-                customer_id=data.get('customer_id', order.customer_id),
-                order_status_id=data.get('order_status_id', order.order_status_id),
-                description=data.get('description', order.description),
-                updated_at=data.get('updated_at', order.updated_at),
-                created_at=data.get('created_at', order.created_at),
-                buyer_id=data.get('buyer_id', 0),
-                order_date=data.get('order_date', order.order_date),
-                buyer=buyer,
-                payment_method=payment_method
-            )
-            order.reload()
-
-
-            logger.info(f'{dt.utcnow()}: Order Id {data["id"]} has been updated in the query database.')
-        except mongoengine.DoesNotExist:
-            """ Create the order in the query database since it doesn't exist already"""
-            QueryOrderModel(
-                id=data['id'],
-                customer_id=data['customer_id'],
-                order_status_id=data['order_status_id'],
-                order_date=data['order_date'],
-                updated_at=data['updated_at'],
-                created_at=data['created_at'],
-                buyer_id=data.get('buyer_id',None),
-                order_items=[QueryOrderItemModel(
-                    id=item['id'],
-                    product_id=item['product_id'],
-                    product_name=item['product_name'],
-                    unit_price=item['unit_price'],
-                    discount=item['discount'],
-                    units=item['units']
-                )
-                    for item in data['order_items']],
-                address=QueryAddressModel(
-                    id=data['address']['id'],
-                    street_1=data['address']['street_1'],
-                    street_2=data['address']['street_2'],
-                    city=data['address']['city'],
-                    state=data['address']['state'],
-                    zip_code=data['address']['zip_code'],
-                    country=data['address']['country']
-                )
-            ).save()
-            logger.info(f'{dt.utcnow()}: Order Id {data["id"]} added to the query database.')
+            count = apply_batch(QueryOrderModel, payloads, self._projection)
+            logger.info(f'{dt.utcnow()}: {count} Orders have been replicated to the query database.')
         except Exception as e:
-            logger.error(f'{dt.utcnow()}: Unable to perform replication for order_id: {data["id"]}\n{e}')
-            return e
+            logger.error(f'{dt.utcnow()}: Unable to perform replication for a batch of orders\n{e}')
+            raise
+
+    @staticmethod
+    def _projection(data):
+        """
+        Status fields are applied only when the event is newer than the stored order, everything
+        else is set once, when the order is created or the buyer and payment method are assigned,
+        and applied as it arrives so an event which overtook the full document can't lose it
+        """
+        fields = {name: data[name] for name in ORDER_STATUS_FIELDS if name in data}
+        set_once = {name: data[name] for name in ('customer_id', 'order_date', 'created_at', 'buyer_id')
+                    if name in data}
+
+        if data.get('buyer') is not None:
+            set_once['buyer'] = QueryBuyerModel(
+                id=data['buyer']['id'],
+                name=data['buyer']['name']
+            )
+        if data.get('payment_method') is not None:
+            set_once['payment_method'] = QueryPaymentMethod(
+                id=data['payment_method']['id'],
+                alias=data['payment_method']['alias'],
+                cardholder_name=data['payment_method']['cardholder_name'],
+                expiration=data['payment_method']['expiration'],
+                card_number=data['payment_method']['card_number']
+            )
+
+        if 'order_items' in data:
+            set_once['order_items'] = [QueryOrderItemModel(
+                id=item['id'],
+                product_id=item['product_id'],
+                product_name=item['product_name'],
+                unit_price=item['unit_price'],
+                discount=item['discount'],
+                units=item['units']
+            )
+                for item in data['order_items']]
+
+        if 'address' in data:
+            set_once['address'] = QueryAddressModel(
+                id=data['address']['id'],
+                street_1=data['address']['street_1'],
+                street_2=data['address']['street_2'],
+                city=data['address']['city'],
+                state=data['address']['state'],
+                zip_code=data['address']['zip_code'],
+                country=data['address']['country']
+            )
+
+        return Projection(fields, set_once=set_once, version=data.get('version'))
 
     @rpc
     @http('GET', '/orders/<int:id>')
@@ -465,19 +782,27 @@ class QueryOrders:
             return e
 
     @rpc
-    def get_by_buyer_id(self, buyer_id, num_page = 1, limit = 10):
+    def get_many(self, ids):
         """
-        returns a collection of orders based on the provided buyer_id
-        :param num_page:
-        :param limit:
+        returns every order in ids with one query, missing ids are skipped
+        :param ids:
+        :return:
+        """
+        return get_by_ids(QueryOrderModel.objects, ids)
+
+    @rpc
+    def get_by_buyer_id(self, buyer_id, after=None, limit=None):
+        """
+        returns a page of orders based on the provided buyer_id
         :param buyer_id:
+        :param after: next_cursor of the previous page
+        :param limit:
         :return:
         """
         try:
-            offset = (num_page - 1) * limit
-            orders = QueryOrderModel.objects(buyer_id=buyer_id)\
-                .skip(offset).limit(limit)
-            return orders.to_json()
+            return keyset_page(QueryOrderModel.objects(buyer_id=buyer_id), after, limit)
+        except InvalidCursor:
+            raise
         except mongoengine.DoesNotExist as e:
             return e
         except Exception as e:
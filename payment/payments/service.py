@@ -6,8 +6,11 @@ import logging
 
 
 from nameko.events import EventDispatcher, event_handler
+from nameko.web.handlers import http
 from datetime import datetime as dt
 
+from .metrics import Metrics, metrics_response
+
 logger = logging.getLogger(__name__)
 
 COMMAND_SERVICE = 'command_payments'
@@ -17,6 +20,12 @@ ORDERS_SERVICE = 'command_orders'
 class Command:
     name = COMMAND_SERVICE
     dispatch = EventDispatcher()
+    metrics = Metrics()
+
+    @http('GET', '/metrics')
+    def get_metrics(self, request):
+        """ latency, error and worker saturation metrics of every service in this process """
+        return metrics_response()
 
     @event_handler(ORDERS_SERVICE, 'order_status_changed_to_stock_confirmed')
     def verify_payment(self, payload):
@@ -26,6 +35,32 @@ class Command:
         :param payload:
         :return:
         """
+        self._authorize(payload)
+
+    @event_handler(ORDERS_SERVICE, 'order_payment_requested')
+    def authorize_payment(self, payload):
+        """
+        Same as verify_payment for orders validated in parallel, the payment is requested
+        while the warehouse is still checking the stock
+        :param payload:
+        :return:
+        """
+        self._authorize(payload)
+
+    @event_handler(ORDERS_SERVICE, 'order_payment_void_requested')
+    def void_payment(self, payload):
+        """
+        Compensation for a payment authorized in parallel with a stock check which failed
+        :param payload:
+        :return:
+        """
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+
+        self.dispatch('order_payment_voided', {'order_id': payload['order_id']})
+        logger.info(f"{dt.utcnow()}: Payment Voided for order_id: {payload['order_id']}")
+
+    def _authorize(self, payload):
         if isinstance(payload, str):
             payload = json.loads(payload)
 
@@ -40,4 +75,4 @@ class Command:
             logger.info(f"{dt.utcnow()}: Payment Succeeded for order_id: {payload['order_id']}")
         else:
             self.dispatch('order_payment_failed', payload)
-            logger.info(f"{dt.utcnow()}: Payment Declined for order_id: {payload['order_id']}")
\ No newline at end of file
+            logger.info(f"{dt.utcnow()}: Payment Declined for order_id: {payload['order_id']}")
@@ -0,0 +1,88 @@
+"""
+Times the warehouse's nearest-site allocation on its own: --sites random sites and --orders
+random orders of --lines products each, shipped to random zip codes of the centroid table,
+with every product stocked at a random share of the sites. Reports the microseconds per
+order and the average number of shipments and distance per shipment. Needs the table built by
+warehouse/build_zip_centroids.py:
+
+    python benchmark_allocation.py --sites 12 --orders 20000 --lines 6
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'warehouse'))
+
+from warehouse.allocation import SiteAllocator, load_centroids  # noqa: E402
+from warehouse.stock import _allocate  # noqa: E402
+
+EARTH_RADIUS_KM = 6371
+
+
+def km(a, b):
+    chord = math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b)))
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def stock(rng, sites, products):
+    """ InventoryStock stand-ins, every product at 1 to all sites """
+    rows = []
+    for product_id in range(1, products + 1):
+        for site_id in rng.sample(sorted(sites), rng.randint(1, len(sites))):
+            rows.append(SimpleNamespace(product_id=product_id, site_id=site_id, free_stock=rng.randint(0, 20)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sites', type=int, default=12)
+    parser.add_argument('--products', type=int, default=555)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--lines', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    centroids = load_centroids()
+    if not centroids:
+        sys.exit('build the centroid table with warehouse/build_zip_centroids.py first')
+
+    zip_codes = sorted(centroids)
+    sites = {site_id: rng.choice(zip_codes) for site_id in range(1, args.sites + 1)}
+
+    allocator = SiteAllocator(centroids)
+    session = SimpleNamespace(query=lambda *columns: SimpleNamespace(all=lambda: list(sites.items())))
+
+    by_product = {}
+    for row in stock(rng, sites, args.products):
+        by_product.setdefault(row.product_id, []).append(row)
+
+    orders = []
+    for _ in range(args.orders):
+        products = rng.sample(sorted(by_product), args.lines)
+        orders.append((rng.choice(zip_codes), {product_id: rng.randint(1, 3) for product_id in products},
+                       [row for product_id in products for row in by_product[product_id]]))
+
+    shipments = distance = 0
+    started = time.perf_counter()
+    for zip_code, units, rows in orders:
+        ordered = allocator.for_order(session, zip_code)(rows, units)
+        allocation, _ = _allocate(ordered, units)
+
+        shipped = {row.site_id for row, _ in allocation}
+        shipments += len(shipped)
+        distance += sum(km(centroids[zip_code], centroids[sites[site_id]]) for site_id in shipped)
+    elapsed = time.perf_counter() - started
+
+    print(f'{args.orders} orders, {args.lines} lines each, {args.sites} sites')
+    print(f'{elapsed / args.orders * 1e6:.1f} us per order (distance reporting included)')
+    print(f'{shipments / args.orders:.2f} shipments per order, {distance / max(shipments, 1):.0f} km per shipment')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Replays replicate_db_event payloads through the query services' normalize_db handlers and
+reports events/sec for the old get/update/reload path, a single upsert per event (batches of one)
+and micro-batches of --batch-size events written with one bulk upsert.
+
+Every id is created by its first event and then updated by the rest, the same mix the command
+services produce. Runs against a local Mongo, or mongomock when it is installed:
+
+    MONGO_HOST=localhost python benchmark_projection.py --service orders --ids 500 --updates 5
+    MONGO_HOST=mongomock://localhost python benchmark_projection.py --service catalog
+
+Only one service is imported per run, each service package connects to mongo on import.
+"""
+import argparse
+import importlib
+import os
+import sys
+import time
+
+from mongoengine import DoesNotExist
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# service directory, package, {handler class: (query model, event factory name)}
+SERVICES = {
+    'catalog': ('catalog', {'QueryBrands': ('QueryBrandModel', 'brand_event'),
+                            'QueryProducts': ('QueryProductsModel', 'product_event')}),
+    'customers': ('customers', {'Query': ('QueryCustomersModel', 'customer_event')}),
+    'warehouse': ('warehouse', {'QuerySite': ('SiteQueryModel', 'site_event'),
+                                'QueryInventoryItems': ('InventoryItemQueryModel', 'inventory_event')}),
+    'orders': ('orders', {'QueryOrders': ('QueryOrderModel', 'order_event')})
+}
+
+NOW = '2019-01-01T00:00:00'
+
+
+def brand_event(id, revision):
+    return {'id': id, 'version': revision + 1, 'name': f'brand {id} r{revision}',
+            'created_at': NOW, 'updated_at': NOW}
+
+
+def product_event(id, revision):
+    return {'id': id, 'version': revision + 1, 'name': f'product {id}', 'description': f'revision {revision}',
+            'price': 9.99 + revision,
+            'product_brand_id': 1, 'sku': 100000 + id, 'discontinued': False, 'attributes': {'color': 'red'},
+            'created_at': NOW, 'updated_at': NOW}
+
+
+def customer_event(id, revision):
+    return {'id': id, 'version': revision + 1, 'full_name': f'Jane Doe {revision}', 'name': 'Jane', 'last_name': 'Doe',
+            'phone': '555-0100', 'email': f'jane{id}@example.com', 'street_1': f'{revision} Main St',
+            'street_2': '', 'city': 'Cary', 'state': 'NC', 'zip_code': '27513', 'country': 'US',
+            'account_id': id, 'created_at': NOW, 'updated_at': NOW}
+
+
+def site_event(id, revision):
+    return {'id': id, 'version': revision + 1, 'name': f'site {id} r{revision}', 'zip_code': '27513', 'type_id': 1,
+            'created_at': NOW, 'updated_at': NOW}
+
+
+def inventory_event(id, revision):
+    return {'id': id, 'version': revision + 1, 'product_id': id, 'site_id': 1, 'available_stock': 100 - revision,
+            'max_stock_threshold': 200, 'restock_threshold': 10, 'committed_stock': revision,
+            'on_reorder': False, 'created_at': NOW, 'updated_at': NOW}
+
+
+def order_event(id, revision):
+    return {'id': id, 'version': revision + 1, 'customer_id': 1, 'order_status_id': revision + 1, 'order_date': NOW,
+            'description': None, 'created_at': NOW, 'updated_at': NOW, 'buyer_id': 1,
+            'buyer': {'id': 1, 'name': 'Jane Doe'} if revision else None,
+            'payment_method': None,
+            'order_items': [{'id': id * 10 + n, 'product_id': n, 'product_name': f'product {n}',
+                             'unit_price': 9.99, 'discount': 0, 'units': 1} for n in range(3)],
+            'address': {'id': id, 'street_1': '1 Main St', 'street_2': '', 'city': 'Cary',
+                        'state': 'NC', 'zip_code': '27513', 'country': 'US'}}
+
+
+def legacy_replicate(model, data):
+    """ the previous handler shape: fetch, update, reload and create on DoesNotExist """
+    values = {name: model._fields[name].to_python(value) if value is not None else None
+              for name, value in data.items() if name in model._fields and name != 'id'}
+
+    try:
+        record = model.objects.get(id=data['id'])
+        record.update(**values)
+        record.reload()
+    except DoesNotExist:
+        model(id=data['id'], **values).save()
+
+
+def events(factory, ids, updates):
+    return [factory(id, revision) for revision in range(updates + 1) for id in range(1, ids + 1)]
+
+
+def measure(apply, payloads):
+    started = time.perf_counter()
+    for payload in payloads:
+        apply(payload)
+    return len(payloads) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--service', choices=sorted(SERVICES), required=True)
+    parser.add_argument('--ids', type=int, default=500)
+    parser.add_argument('--updates', type=int, default=4, help='updates replayed per id after its creation')
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ.setdefault('MONGO_DATABASE', 'projection_benchmark')
+    package, handlers = SERVICES[args.service]
+    sys.path.insert(0, os.path.join(HERE, '..', args.service))
+
+    models = importlib.import_module(f'{package}.models')
+    service = importlib.import_module(f'{package}.service')
+
+    print(f'{"handler":<22}{"events":>8}{"get/update/reload ev/s":>25}{"upsert ev/s":>14}{"bulk ev/s":>12}')
+    for handler_name, (model_name, factory_name) in handlers.items():
+        model = getattr(models, model_name)
+        handler = getattr(service, handler_name)()
+        payloads = events(globals()[factory_name], args.ids, args.updates)
+
+        model.drop_collection()
+        before = measure(lambda payload: legacy_replicate(model, payload), payloads)
+
+        model.drop_collection()
+        single = measure(lambda payload: handler.normalize_db([payload]), payloads)
+
+        model.drop_collection()
+        batches = [payloads[i:i + args.batch_size] for i in range(0, len(payloads), args.batch_size)]
+        bulk = measure(handler.normalize_db, batches) * len(payloads) / len(batches)
+
+        model.drop_collection()
+        print(f'{handler_name:<22}{len(payloads):>8}{before:>25.1f}{single:>14.1f}{bulk:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
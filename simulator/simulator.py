@@ -48,21 +48,40 @@ customers_uri = "{}/customers".format(uri)
 register_uri = f"{customers_uri}/register"
 sites_uri = f'{uri}/warehouse/sites'
 
+
+def get_all(collection_uri, limit=500):
+    """ follows the next_cursor of a paged collection and returns every row """
+    rows = []
+    params = {'limit': limit}
+
+    while True:
+        page = requests.get(collection_uri, params=params).json()
+        rows.extend(page['items'])
+
+        if page.get('next_cursor') is None:
+            return rows
+
+        params['after'] = page['next_cursor']
+
+
 brand_count = 13
 product_count = 555
 customer_count = 45000
+register_batch_size = 500
 site_count = 12
 order_count = 50000
 
 print('Checking on customers, creating if necessary')
 
-customers = requests.get(customers_uri)
+customers = get_all(customers_uri)
 
-if customers.json() is None or len(customers.json()) < customer_count:
-    max_range = customer_count - len(customers.json())
+if len(customers) < customer_count:
+    max_range = customer_count - len(customers)
 
     print(f'Creating {max_range} Customers')
 
+    accounts = []
+
     for i in range(0, max_range):
         profile = fake.profile()
         person = {
@@ -97,18 +116,21 @@ if customers.json() is None or len(customers.json()) < customer_count:
             'phone': phone
         }
 
-        # request_data = json.dumps(account)
-        requests.post(register_uri, json=account)
+        accounts.append(account)
 
-print("Checking on sites, creating if necessary")
-sites = requests.get(sites_uri)
+        if len(accounts) == register_batch_size or i == max_range - 1:
+            response = requests.post(f'{register_uri}/bulk', json=accounts).json()
 
-if sites.json() is None or len(sites.json()) < site_count:
+            for error in response['errors']:
+                print(f'Account {accounts[error["index"]]["user_name"]} was rejected: {error["error"]}')
 
-    if len(sites.json()) == 0:
-        max_range = site_count
-    else:
-        max_range = site_count - len(sites.json())
+            accounts = []
+
+print("Checking on sites, creating if necessary")
+sites = get_all(sites_uri)
+
+if len(sites) < site_count:
+    max_range = site_count - len(sites)
 
     for i in range(0, max_range):
         zip_info = get_random_city_zip()
@@ -118,14 +140,10 @@ if sites.json() is None or len(sites.json()) < site_count:
         requests.post(sites_uri, json=site)
 
 print("Checking on brands, creating if necessary")
-brands = requests.get(brand_uri)
+brands = get_all(brand_uri)
 
-if brands.json() is None or len(brands.json()) < brand_count:
-
-    if brands.json() is None:
-        max_range = brand_count
-    else:
-        max_range = brand_count - len(brands.json())
+if len(brands) < brand_count:
+    max_range = brand_count - len(brands)
 
     print(f'Creating {max_range} brands.')
 
@@ -135,27 +153,24 @@ if brands.json() is None or len(brands.json()) < brand_count:
         request_data = json.dumps(brand)
         response = requests.post(brand_uri, json=brand)
 
-    brands = requests.get(brand_uri)
-
-brands = brands.json()
+    brands = get_all(brand_uri)
 
 print('Checking on products, creating if necessary')
-products = requests.get(products_uri)
+products = get_all(products_uri)
 
-if products.json() is None or len(products.json()) < 300:
+if len(products) < 300:
 
     colors = ['white', 'black', 'red', 'blue', 'yellow', 'titanium', 'steel-grey',
               'grey', 'green', 'light-blue', 'pink', 'orange']
 
     types = ['kitchen', 'outdoor', 'indoor', 'bedroom', 'living room']
 
-    if products.json() is None or len(products.json()) == 0:
+    if len(products) == 0:
         max_product_id = 0
         max_range = 300
     else:
-        products = Enumerable(products.json())
-        max_product_id = products.max(lambda x: x['_id']) + 1
-        max_range = 300 - len(products.json())
+        max_product_id = Enumerable(products).max(lambda x: x['_id']) + 1
+        max_range = 300 - len(products)
 
     print(f'Creating {max_range} products.')
 
@@ -190,8 +205,7 @@ if products.json() is None or len(products.json()) < 300:
         request_data = json.dumps(product)
         response = requests.post(products_uri, json=request_data)
 
-customers = requests.get(customers_uri)
-customers = customers.json()
+customers = get_all(customers_uri)
 card_types = [{'id': 1, 'value': 'discover'},
               {'id': 2, 'value': 'visa16'},
               {'id': 3, 'value': 'amex'},
@@ -205,8 +219,7 @@ for customer in customers:
     customer['card_number'] = fake.credit_card_number(card_type=customer['card_provider'])
     customer['security_number'] = fake.credit_card_security_code(card_type=customer['card_provider'])
 
-products = requests.get(products_uri)
-products = products.json()
+products = get_all(products_uri)
 
 print(f'Creating {order_count} orders now, this may take a while...')
 for i in range(0, order_count):
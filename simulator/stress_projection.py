@@ -0,0 +1,146 @@
+"""
+Checks that the query projections end up in the same state whatever order replication events
+arrive in. Every id gets a stream of versioned events, which is first replayed in version order
+one event at a time to get the expected documents. The streams are then shuffled together,
+some events are delivered twice, as the broker does after a requeue, and the result is cut into
+random batches applied by --workers concurrent handlers. Any document differing from the in
+order replay is reported and the script exits non-zero.
+
+Orders replay what the command service sends: the full document on creation followed by status
+deltas, one of which assigns the buyer. Runs against a local Mongo, or mongomock when installed:
+
+    MONGO_HOST=localhost python stress_projection.py --service orders --ids 200 --updates 8
+    MONGO_HOST=mongomock://localhost python stress_projection.py --service warehouse --rounds 5
+
+Only one service is imported per run, each service package connects to mongo on import.
+"""
+import argparse
+import importlib
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark_projection import HERE, NOW, SERVICES, order_event
+import benchmark_projection
+
+
+def order_stream(id, updates):
+    """ the full order on creation, the buyer assigned by the first status change, then status deltas """
+    stream = [order_event(id, 0)]
+
+    for revision in range(1, updates + 1):
+        delta = {'id': id, 'version': revision + 1, 'order_status_id': revision + 1,
+                 'description': f'status {revision + 1}', 'updated_at': f'{NOW}.{revision:06d}'}
+        if revision == 1:
+            delta.update({'buyer_id': 1, 'buyer': {'id': 1, 'name': 'Jane Doe'}})
+        stream.append(delta)
+
+    return stream
+
+
+def snapshot_stream(factory):
+    return lambda id, updates: [factory(id, revision) for revision in range(updates + 1)]
+
+
+def streams(factory_name, ids, updates):
+    stream = order_stream if factory_name == 'order_event' else \
+        snapshot_stream(getattr(benchmark_projection, factory_name))
+    return {id: stream(id, updates) for id in range(1, ids + 1)}
+
+
+def documents(model):
+    return {document['_id']: document for document in model._get_collection().find()}
+
+
+def expected_state(model, handler, by_id):
+    """ replays every stream in version order, one event per batch """
+    model.drop_collection()
+
+    for stream in by_id.values():
+        for event in stream:
+            handler.normalize_db([event])
+
+    return documents(model)
+
+
+def shuffled_batches(rng, by_id, batch_size, duplicates):
+    events = [event for stream in by_id.values() for event in stream]
+    events += rng.sample(events, int(len(events) * duplicates))
+    rng.shuffle(events)
+
+    batches = []
+    while events:
+        size = rng.randint(1, batch_size)
+        batches.append(events[:size])
+        events = events[size:]
+
+    return batches
+
+
+def replay(model, handler, batches, workers):
+    model.drop_collection()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() surfaces the first exception raised by a handler
+        list(pool.map(handler.normalize_db, batches))
+
+    return documents(model)
+
+
+def differences(expected, actual):
+    for id in sorted(set(expected) | set(actual)):
+        if expected.get(id) != actual.get(id):
+            yield id, expected.get(id), actual.get(id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--service', choices=sorted(SERVICES), required=True)
+    parser.add_argument('--ids', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=6, help='changes replayed per id after its creation')
+    parser.add_argument('--batch-size', type=int, default=50, help='largest batch, batches are 1 to this size')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duplicates', type=float, default=0.1, help='share of events delivered twice')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    os.environ.setdefault('MONGO_DATABASE', 'projection_stress')
+    package, handlers = SERVICES[args.service]
+    sys.path.insert(0, os.path.join(HERE, '..', args.service))
+
+    models = importlib.import_module(f'{package}.models')
+    service = importlib.import_module(f'{package}.service')
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    print(f'seed {seed}')
+
+    failed = False
+    for handler_name, (model_name, factory_name) in handlers.items():
+        model = getattr(models, model_name)
+        handler = getattr(service, handler_name)()
+        by_id = streams(factory_name, args.ids, args.updates)
+
+        expected = expected_state(model, handler, by_id)
+
+        for attempt in range(1, args.rounds + 1):
+            batches = shuffled_batches(rng, by_id, args.batch_size, args.duplicates)
+            mismatches = list(differences(expected, replay(model, handler, batches, args.workers)))
+
+            print(f'{handler_name:<22} round {attempt}: {sum(len(batch) for batch in batches)} events in '
+                  f'{len(batches)} batches, {len(mismatches)} of {len(expected)} documents differ')
+
+            for id, want, got in mismatches[:5]:
+                print(f'    {id} expected: {want}\n    {id} got:      {got}')
+
+            failed = failed or bool(mismatches)
+
+        model.drop_collection()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
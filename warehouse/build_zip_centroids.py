@@ -0,0 +1,41 @@
+"""
+Builds the zip code centroid table the warehouse allocates stock with, from the same uszipcode
+database the simulator picks customer and site addresses from. The warehouse image runs it while
+it is built, to build the table for a local run:
+
+    python build_zip_centroids.py --output warehouse/zip_centroids.csv
+"""
+import argparse
+import csv
+import os
+
+from uszipcode import SearchEngine, SimpleZipcode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default=os.path.join(HERE, 'warehouse', 'zip_centroids.csv'))
+    args = parser.parse_args()
+
+    zip_search = SearchEngine(simple_zipcode=True)
+
+    zip_codes = zip_search.ses.query(SimpleZipcode) \
+        .filter(SimpleZipcode.lat.isnot(None), SimpleZipcode.lng.isnot(None)) \
+        .order_by(SimpleZipcode.zipcode)
+
+    count = 0
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['zip_code', 'lat', 'lng'])
+
+        for zip_code in zip_codes:
+            writer.writerow([zip_code.zipcode, round(zip_code.lat, 4), round(zip_code.lng, 4)])
+            count += 1
+
+    print(f'{count} zip code centroids written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
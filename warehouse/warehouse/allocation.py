@@ -0,0 +1,191 @@
+import csv
+import heapq
+import logging
+import math
+import os
+import threading
+from datetime import datetime as dt
+
+from .models import Site
+from .stock import by_free_stock
+
+logger = logging.getLogger(__name__)
+
+# zip code centroids built with the image by build_zip_centroids.py
+ZIP_CENTROIDS_PATH = os.getenv('ZIP_CENTROIDS_PATH', os.path.join(os.path.dirname(__file__), 'zip_centroids.csv'))
+
+
+def load_centroids(path=ZIP_CENTROIDS_PATH):
+    """
+    :param path: csv of zip_code,lat,lng
+    :return: {zip_code: point}, empty when the file was not built
+    """
+    if not os.path.exists(path):
+        logger.warning(f'{dt.utcnow()}: no zip centroids at {path}, stock is allocated by free stock only')
+        return {}
+
+    with open(path, newline='') as f:
+        return {row['zip_code']: to_point(float(row['lat']), float(row['lng'])) for row in csv.DictReader(f)}
+
+
+def to_point(lat, lng):
+    """
+    Position on the unit sphere, the straight line distance between two points grows with the
+    great circle distance so nearest neighbours can be searched with plain euclidean distance
+    """
+    lat, lng = math.radians(lat), math.radians(lng)
+    return math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat)
+
+
+def _distance(a, b):
+    return sum((x - y) ** 2 for x, y in zip(a, b))
+
+
+class KDTree(object):
+    """ static 3-d tree over (point, value) pairs """
+
+    def __init__(self, entries):
+        self.root = self._build(list(entries), 0)
+
+    def _build(self, entries, depth):
+        if not entries:
+            return None
+
+        axis = depth % 3
+        entries.sort(key=lambda entry: entry[0][axis])
+        middle = len(entries) // 2
+
+        point, value = entries[middle]
+        return (point, value, axis,
+                self._build(entries[:middle], depth + 1),
+                self._build(entries[middle + 1:], depth + 1))
+
+    def nearest(self, point):
+        """
+        Yields the values nearest first, exploring only as much of the tree as the caller consumes
+        """
+        if self.root is None:
+            return
+
+        # (lower bound of the squared distance, tie breaker, is a value, node or value)
+        heap = [(0.0, 0, False, self.root)]
+        counter = 1
+
+        while heap:
+            bound, _, is_value, item = heapq.heappop(heap)
+
+            if is_value:
+                yield item
+                continue
+
+            node_point, value, axis, left, right = item
+            heapq.heappush(heap, (_distance(point, node_point), counter, True, value))
+            counter += 1
+
+            offset = point[axis] - node_point[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+
+            for child, child_bound in ((near, bound), (far, max(bound, offset ** 2))):
+                if child is not None:
+                    heapq.heappush(heap, (child_bound, counter, False, child))
+                    counter += 1
+
+
+class SiteAllocator(object):
+    """
+    Splits an order across sites using as few shipments as possible, each from the sites
+    nearest the shipping zip code. Sites are kept in a kd-tree of their zip code centroids,
+    loaded when a site the allocator does not know holds stock.
+    """
+
+    def __init__(self, centroids):
+        self.centroids = centroids
+
+        self._sites = None
+        self._tree = KDTree([])
+        self._lock = threading.Lock()
+
+    def _load_sites(self, session):
+        sites = session.query(Site.id, Site.zip_code).all()
+
+        with self._lock:
+            self._sites = {id for id, _ in sites}
+            self._tree = KDTree([(self.centroids[zip_code], id) for id, zip_code in sites
+                                 if zip_code in self.centroids])
+
+    def _sites_by_distance(self, session, zip_code, site_ids):
+        """ the sites in site_ids nearest first, sites without a centroid last """
+        if self._sites is None or not site_ids <= self._sites:
+            self._load_sites(session)
+
+        ordered = []
+        for site_id in self._tree.nearest(self.centroids[zip_code]):
+            if site_id in site_ids:
+                ordered.append(site_id)
+                if len(ordered) == len(site_ids):
+                    break
+
+        return ordered + sorted(site_ids - set(ordered))
+
+    def for_order(self, session, zip_code):
+        """
+        The allocation strategy handed to stock.reserve for an order shipping to zip_code
+        :param session:
+        :param zip_code:
+        :return: callable(stocks, units) returning the stock rows in the order to take units from,
+        those of the chosen shipments first then those of every other site
+        """
+        if zip_code not in self.centroids:
+            return by_free_stock
+
+        def nearest_sites(stocks, units):
+            by_site = {}
+            for stock in stocks:
+                if stock.free_stock > 0:
+                    by_site.setdefault(stock.site_id, {})[stock.product_id] = stock
+
+            sites = self._sites_by_distance(session, zip_code, set(by_site))
+            shipments = self._shipments(sites, by_site, units)
+
+            # the other sites follow nearest first, reserve moves on to them past rows other orders hold
+            ordered = shipments + [site_id for site_id in sites if site_id not in shipments]
+            return [stock for site_id in ordered for stock in by_site[site_id].values()]
+
+        return nearest_sites
+
+    @staticmethod
+    def _shipments(sites, by_site, units):
+        """
+        Picks the sites to ship from: the nearest site holding everything still missing when
+        there is one, otherwise the one covering the most missing units, the nearer on ties
+        :param sites: site ids nearest first
+        :param by_site: {site_id: {product_id: stock}}
+        :param units: {product_id: units}
+        :return: site ids in the order their stock is taken
+        """
+        remaining = dict(units)
+        chosen = []
+        candidates = list(sites)
+
+        def covered(site_id):
+            return sum(min(wanted, by_site[site_id][product_id].free_stock)
+                       for product_id, wanted in remaining.items()
+                       if wanted > 0 and product_id in by_site[site_id])
+
+        while candidates and any(wanted > 0 for wanted in remaining.values()):
+            missing = sum(wanted for wanted in remaining.values() if wanted > 0)
+
+            site_id = next((site_id for site_id in candidates if covered(site_id) == missing), None)
+            if site_id is None:
+                site_id = max(candidates, key=lambda site_id: (covered(site_id), -candidates.index(site_id)))
+                if covered(site_id) == 0:
+                    break
+
+            for product_id, stock in by_site[site_id].items():
+                if remaining.get(product_id, 0) > 0:
+                    remaining[product_id] -= min(remaining[product_id], stock.free_stock)
+
+            chosen.append(site_id)
+            candidates.remove(site_id)
+
+        return chosen
@@ -1,6 +1,9 @@
 import os
+from datetime import datetime as dt, timedelta
 from .models import *
-from sqlalchemy import create_engine
+from .outbox import OutboxMessage  # registers the outbox table with DeclarativeBase
+from .stock import RESERVATION_TTL_SECONDS
+from sqlalchemy import create_engine, text
 
 def create_db():
     db_user = os.getenv("DB_USER",'postgres')
@@ -11,9 +14,40 @@ def create_db():
     db_url = 'postgresql://{}:{}@{}:{}/warehouse'.format(db_user, db_password, db_host, db_port)
 
     db = create_engine(db_url)
-    db.execute('CREATE SEQUENCE IF NOT EXISTS inventory_items_id_seq START 1;')
+    db.execute(f'CREATE SEQUENCE IF NOT EXISTS inventory_items_id_seq START 1 INCREMENT BY {INVENTORY_ID_BLOCK_SIZE};')
     DeclarativeBase.metadata.create_all(db)
 
+    # create_all doesn't alter existing tables
+    db.execute('ALTER TABLE sites ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;')
+    # the next value after the alter is past every id handed out one at a time before
+    db.execute(f'ALTER SEQUENCE inventory_items_id_seq INCREMENT BY {INVENTORY_ID_BLOCK_SIZE};')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_inventory_items_product_site_version '
+               'ON inventory_items (product_id, site_id, version DESC);')
+    # current stock of the items created before inventory_stock existed
+    db.execute('INSERT INTO inventory_stock (product_id, site_id, inventory_item_id, version, on_reorder, '
+               'restock_threshold, max_stock_threshold, available_stock, committed_stock, created_at, updated_at) '
+               'SELECT DISTINCT ON (product_id, site_id) product_id, site_id, id, version, on_reorder, '
+               'restock_threshold, max_stock_threshold, available_stock, committed_stock, created_at, updated_at '
+               'FROM inventory_items ORDER BY product_id, site_id, version DESC '
+               'ON CONFLICT (product_id, site_id) DO NOTHING;')
+    # the columns stock_reservations had before they were added below
+    reservation_columns = {name for name, in db.execute("SELECT column_name FROM information_schema.columns "
+                                                        "WHERE table_name = 'stock_reservations';")}
+    db.execute('ALTER TABLE stock_reservations ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP WITHOUT TIME ZONE;')
+    db.execute('ALTER TABLE stock_reservations ADD COLUMN IF NOT EXISTS paid_at TIMESTAMP WITHOUT TIME ZONE;')
+    if 'expires_at' in reservation_columns and 'paid_at' not in reservation_columns:
+        # paid reservations were marked by clearing expires_at before paid_at existed
+        db.execute('UPDATE stock_reservations SET paid_at = updated_at WHERE expires_at IS NULL;')
+    # unpaid reservations made before expires_at existed are held for the configured time from now
+    db.execute(text('UPDATE stock_reservations SET expires_at = :expires_at '
+                    'WHERE expires_at IS NULL AND paid_at IS NULL;'),
+               expires_at=dt.utcnow() + timedelta(seconds=RESERVATION_TTL_SECONDS))
+    db.execute('DROP INDEX IF EXISTS ix_stock_reservations_expires_at;')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_stock_reservations_unpaid_expires_at ON stock_reservations (expires_at) '
+               'WHERE paid_at IS NULL;')
+    db.execute('CREATE INDEX IF NOT EXISTS ix_stock_reservations_paid_at ON stock_reservations (paid_at) '
+               'WHERE paid_at IS NOT NULL;')
+
 
 if __name__ == '__main__':
     print('creating databases')
@@ -1,2 +1,6 @@
 class NotFound(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvalidCursor(Exception):
+    pass
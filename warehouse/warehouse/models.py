@@ -5,10 +5,11 @@ from sqlalchemy.dialects import postgresql
 import random
 
 from sqlalchemy import (
-   Index, DECIMAL, Column, DateTime, ForeignKey, BigInteger, String, Boolean, Integer
+   Index, DECIMAL, Column, DateTime, ForeignKey, BigInteger, String, Boolean, Integer, text
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
+from .metrics import instrument_sqlalchemy, instrument_pymongo
 
 
 class Base(object):
@@ -26,6 +27,9 @@ class Base(object):
 
 DeclarativeBase = declarative_base(cls=Base)
 
+# inventory item ids are handed out in blocks, inventory_items_id_seq increments by a whole block
+INVENTORY_ID_BLOCK_SIZE = 50
+
 SiteTypes = { 1: 'Distribution Center',
               2: 'Store',
               3: 'Forward Shipping'}
@@ -38,6 +42,12 @@ class Site(DeclarativeBase):
     zip_code = Column(String(12), nullable=False)
     type_id = Column(Integer, nullable=False)  # 1 DC 2 Store
 
+    # bumped by every update of the row, replication events carry it so the query side
+    # can drop changes older than the ones it already holds
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
 
 class InventoryItem(DeclarativeBase):
     __tablename__ = 'inventory_items'
@@ -51,7 +61,11 @@ class InventoryItem(DeclarativeBase):
     available_stock = Column(Integer, nullable=False, default=0)
     committed_stock = Column(Integer, nullable=False, default=0)
 
-    __table_args__ = Index('index', 'id', 'version'),
+    __table_args__ = (
+        Index('index', 'id', 'version'),
+        # latest version of every (product, site) row, read by the stock check
+        Index('ix_inventory_items_product_site_version', 'product_id', 'site_id', version.desc()),
+    )
 
     def __init__(self, product_id, site_id):
         max_stock_threshold = random.randint(105, 1050)
@@ -103,6 +117,70 @@ class InventoryItem(DeclarativeBase):
         return self.available_stock - original
 
 
+class InventoryStock(DeclarativeBase):
+    """
+    Current state of every (product, site), the latest inventory_items version of it. Written in
+    the transaction which adds the version, so stock reads are primary key lookups
+    """
+    __tablename__ = 'inventory_stock'
+    product_id = Column(BigInteger, primary_key=True)
+    site_id = Column(BigInteger, ForeignKey('sites.id', name='fk_inventory_stock_site'), primary_key=True)
+    inventory_item_id = Column(BigInteger, nullable=False)
+    version = Column(BigInteger, nullable=False)
+    on_reorder = Column(Boolean, default=False)
+    restock_threshold = Column(Integer, nullable=False, default=0)
+    max_stock_threshold = Column(Integer, nullable=False, default=0)
+    available_stock = Column(Integer, nullable=False, default=0)
+    committed_stock = Column(Integer, nullable=False, default=0)
+
+    @property
+    def free_stock(self):
+        """ stock which is neither sold nor reserved by an order """
+        return self.available_stock - self.committed_stock
+
+    def next_version(self):
+        """ a new inventory_items version of this product at this site, with the current stock """
+        item = InventoryItem(product_id=self.product_id, site_id=self.site_id)
+
+        item.id = self.inventory_item_id
+        item.version = self.version + 1
+        item.on_reorder = self.on_reorder
+        item.restock_threshold = self.restock_threshold
+        item.max_stock_threshold = self.max_stock_threshold
+        item.available_stock = self.available_stock
+        item.committed_stock = self.committed_stock
+
+        return item
+
+
+class StockReservation(DeclarativeBase):
+    """
+    units of a product held at a site for an order, from stock validation until it is paid or
+    cancelled, or until expires_at when it is neither. A paid reservation is marked with
+    paid_at and kept for the retention window, so a paid event delivered twice finds it
+    """
+    __tablename__ = 'stock_reservations'
+    id = Column(BigInteger, autoincrement=True, primary_key=True)
+    order_id = Column(BigInteger, nullable=False)
+    product_id = Column(BigInteger, nullable=False)
+    site_id = Column(BigInteger, nullable=False)
+    units = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=True)
+    paid_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_stock_reservations_order_id', 'order_id'),
+        # the expiry sweep reads only the unpaid reservations which are due
+        Index('ix_stock_reservations_unpaid_expires_at', 'expires_at', postgresql_where=text('paid_at IS NULL')),
+        # and the pruning only the paid ones past the retention window
+        Index('ix_stock_reservations_paid_at', 'paid_at', postgresql_where=text('paid_at IS NOT NULL')),
+    )
+
+
+# listeners only attach to clients created afterwards, so instrument before connecting
+instrument_sqlalchemy()
+instrument_pymongo()
+
 connect(os.getenv('MONGO_DATABASE', 'warehouse'),
         host=os.environ.get('MONGO_HOST', '127.0.0.1'),
         port=int(os.environ.get('MONGO_PORT', 27017)))
@@ -116,6 +194,7 @@ class SiteQueryModel(Document):
     type = StringField()
     created_at = StringField()
     updated_at = StringField()
+    version = IntField()
 
 
 class InventoryItemQueryModel(Document):
@@ -130,3 +209,7 @@ class InventoryItemQueryModel(Document):
     created_at = StringField()
     updated_at = StringField()
     committed_stock = IntField()
+
+    meta = {
+        'indexes': [('site_id', 'id'), 'product_id']
+    }
@@ -5,20 +5,30 @@ import logging
 
 from nameko.events import event_handler, EventDispatcher
 from nameko.rpc import rpc
+from nameko.timer import timer
 from nameko.web.handlers import http
 from nameko_sqlalchemy import DatabaseSession
-from sqlalchemy import Sequence, func, join
+from sqlalchemy import func, join
 from datetime import datetime as dt
 
 from .models import *
 from .exceptions import *
+from .hilo import HiLoSequence
+from .allocation import SiteAllocator, load_centroids
+from .batching import batch_event_handler, apply_batch
+from .metrics import Metrics, metrics_response
+from .outbox import OUTBOX_RELAY_INTERVAL, Outbox, relay
+from .pagination import keyset_page, ndjson_page
+from .projection import Projection
+from .stock_index import STOCK_INDEX_CHECK_INTERVAL, StockIndex, check_consistency
+from .stock import (
+    INVENTORY_COMPACTION_INTERVAL, RESERVATION_SWEEP_INTERVAL, compact, commit_reservations, expire_reservations,
+    prune_paid_reservations, record_versions, release_reservations, reservations_of, reserve, reserved
+)
 
 from mongoengine import DoesNotExist, QuerySet
 from mongoengine.queryset.visitor import Q
 
-import logging
-from py_linq import Enumerable
-
 logger = logging.getLogger(__name__)
 
 REPLICATE_EVENT = 'replicate_db_event'
@@ -31,17 +41,47 @@ PRODUCTS_COMMAND = 'command_products'
 ORDER_COMMAND = 'command_orders'
 ORDER_STATUS_CHANGED_TO_PAID = 'order_status_changed_to_paid'
 ORDER_STATUS_CHANGED_TO_AWAITING_VERIFICATION = 'order_status_changed_to_awaiting_validation'
+ORDER_STATUS_CHANGED_TO_CANCELLED = 'order_status_changed_to_cancelled'
+
+# replicated inventory item fields written to the projection when the event's version is newer
+INVENTORY_FIELDS = ('product_id', 'site_id', 'available_stock', 'max_stock_threshold',
+                    'restock_threshold', 'committed_stock', 'on_reorder', 'updated_at')
+
+INVENTORY_ITEM_IDS = HiLoSequence('inventory_items_id_seq', INVENTORY_ID_BLOCK_SIZE)
+
+SITE_ALLOCATOR = SiteAllocator(load_centroids())
 
 
 class CommandSite:
     name = SITE_COMMAND
     dispatch = EventDispatcher()
+    outbox = Outbox()
     db = DatabaseSession(DeclarativeBase)
+    metrics = Metrics()
 
     def _save_to_db(self, item):
+        """ saves a site together with its replication event, which is published once committed """
         self.db.add(item)
+        self.db.flush()
+        self.outbox(REPLICATE_EVENT, self._site_document(item), aggregate_id=item.id)
         self.db.commit()
 
+    @timer(interval=OUTBOX_RELAY_INTERVAL)
+    def relay_outbox(self):
+        """ publishes the committed events the worker which wrote them failed to relay """
+        relay(self.db, self.name, self.dispatch)
+
+    @staticmethod
+    def _site_document(site):
+        """ the whole site as replicated, every event carries all fields so they can be applied in any order """
+        return {'id': site.id,
+                'version': site.version,
+                'name': site.name,
+                'zip_code': site.zip_code,
+                'type_id': site.type_id,
+                'created_at': site.created_at,
+                'updated_at': site.updated_at}
+
     @rpc
     def add(self, payload):
 
@@ -60,8 +100,6 @@ class CommandSite:
         payload['created_at'] = site.created_at
         payload['updated_at'] = site.updated_at
 
-        self.dispatch(REPLICATE_EVENT, payload)
-
         return payload
 
     @rpc
@@ -85,63 +123,43 @@ class CommandSite:
         payload['id'] = site.id
         payload['updated_at'] = site.updated_at
 
-        self.dispatch(REPLICATE_EVENT, payload)
-
 
 class QuerySite:
     name = SITE_QUERY
+    metrics = Metrics()
 
-    @event_handler(SITE_COMMAND, REPLICATE_EVENT)
-    def normalize_db(self, data):
-
-        if isinstance(data, str):
-            data = json.loads(data)
-
-        site_type = SiteTypes[data['type_id']]
-
+    @batch_event_handler(SITE_COMMAND, REPLICATE_EVENT)
+    def normalize_db(self, payloads):
+        """ writes a batch of replicated sites with one bulk upsert, raising requeues the batch """
         try:
-            site = SiteQueryModel.objects.get(id=data['id'])
-            site.update(
-                name=data.get('name', site.name),
-                zip_code=data.get('zip_code', site.zip_code),
-                type_id=data.get('type_id', site.type_id),
-                type=data.get('type', site_type),
-                updated_at=data.get('updated_at', site.updated_at)
-            )
-            site.reload()
-            logger.info(f'{datetime.datetime.utcnow()}: Replicated site update')
-        except DoesNotExist:
-            logger.info(f'{datetime.datetime.utcnow()}: Creating new site now')
-
-            try:
-                SiteQueryModel(
-                    id=data['id'],
-                    name=data['name'],
-                    zip_code=data['zip_code'],
-                    type_id=data['type_id'],
-                    type=site_type,
-                    created_at=data['created_at'],
-                    updated_at=data['updated_at']
-                ).save()
-
-                logger.info(f'{datetime.datetime.utcnow()}: Replicated site creation')
-            except Exception as e:
-                logger.error(f'{datetime.datetime.utcnow()}: There was an error in replication: {e}')
+            count = apply_batch(SiteQueryModel, payloads, self._projection)
+            logger.info(f'{datetime.datetime.utcnow()}: Replicated {count} sites')
         except Exception as e:
             logger.error(f'{datetime.datetime.utcnow()}: There was an error in replication: {e}')
-            return e
+            raise
+
+    @staticmethod
+    def _projection(data):
+        fields = {name: data[name] for name in ('name', 'zip_code', 'type_id', 'updated_at') if name in data}
+        fields['type'] = data.get('type', SiteTypes[data['type_id']])
+
+        return Projection(fields, on_insert={'created_at': data.get('created_at')}, version=data.get('version'))
 
     @rpc
-    def list(self, num_page, limit):
+    def list(self, after=None, limit=None):
+        """ returns a page of sites, pass the next_cursor of a page as after to get the next one"""
         try:
-            if not num_page:
-                num_page = 1
-            offset = (num_page - 1) * limit
-            sites = SiteQueryModel.objects  # .skip(offset).limit(limit)
-            return sites.to_json()
+            return keyset_page(SiteQueryModel.objects, after, limit)
+        except InvalidCursor:
+            raise
         except Exception as e:
             return e
 
+    @rpc
+    def list_ndjson(self, after=None, limit=None):
+        """ returns a chunk of sites as ndjson rows, used by the gateway to stream the collection"""
+        return ndjson_page(SiteQueryModel.objects, after, limit)
+
     @rpc
     def get(self, id):
         try:
@@ -158,6 +176,61 @@ class CommandInventoryItem:
 
     db = DatabaseSession(DeclarativeBase)
     dispatch = EventDispatcher()
+    outbox = Outbox()
+    metrics = Metrics()
+    stock_index = StockIndex()
+
+    @timer(interval=OUTBOX_RELAY_INTERVAL)
+    def relay_outbox(self):
+        """ publishes the committed events the worker which wrote them failed to relay """
+        relay(self.db, self.name, self.dispatch)
+
+    @timer(interval=STOCK_INDEX_CHECK_INTERVAL)
+    def check_stock_index(self):
+        """ compares the in-memory stock index with the database, reports and repairs drift """
+        self.metrics.inc('stock_index_drifted_products_total', check_consistency(self.stock_index))
+        self.db.rollback()
+
+    @timer(interval=INVENTORY_COMPACTION_INTERVAL)
+    def compact_inventory_versions(self):
+        """ prunes inventory item versions superseded, and reservations paid, longer than the retention window """
+        with self.metrics.timed('inventory_compaction_seconds'):
+            pruned = compact(self.db)
+            paid = prune_paid_reservations(self.db)
+
+        self.metrics.inc('inventory_versions_pruned_total', pruned)
+        self.metrics.inc('stock_reservations_pruned_total', paid)
+
+    @timer(interval=RESERVATION_SWEEP_INTERVAL)
+    def expire_stock_reservations(self):
+        """ returns the stock of orders which weren't paid before their reservation expired """
+        released = expire_reservations(self.db)
+
+        self.stock_index.released(released)
+        self.metrics.inc('stock_reserved_units_expired_total', sum(released.values()))
+
+    @staticmethod
+    def _item_document(item):
+        """ an inventory item version as replicated, every version is a complete snapshot """
+        return {'id': item.id,
+                'product_id': item.product_id,
+                'site_id': item.site_id,
+                'available_stock': item.available_stock,
+                'restock_threshold': item.restock_threshold,
+                'version': item.version,
+                'max_stock_threshold': item.max_stock_threshold,
+                'on_reorder': item.on_reorder,
+                'created_at': item.created_at,
+                'committed_stock': item.committed_stock,
+                'updated_at': item.updated_at}
+
+    @staticmethod
+    def _order_units(data):
+        """ units ordered per product, lines of the same product added up """
+        units = {}
+        for i in data['order_stock_items']:
+            units[i['product_id']] = units.get(i['product_id'], 0) + i['units']
+        return units
 
     @event_handler(PRODUCTS_COMMAND, 'product_added')
     def add_inventory_item(self, data):
@@ -165,44 +238,53 @@ class CommandInventoryItem:
             1. The product being added will be added to a random count of sites' inventory
             2. Initial stock numbers are going to be generated randomly
             3. All sites are able to inventory an item (this may change)
+
+            Every item of the event is written with one multi-row insert, ids come from
+            blocks of the sequence, and replicated with a single event
         """
         if isinstance(data, str):
             data = json.loads(data)
 
+        # bulk catalog imports announce a whole chunk of products at once
+        product_ids = data.get('product_ids') or [data['product_id']]
+
         # get the sites
         sites = self.db.query(Site).all()
+        stocked = [(product_id, site) for product_id in product_ids
+                   for site in random.sample(sites, random.randint(1, len(sites)))]
+
+        now = datetime.datetime.utcnow()
         items = []
-        for site in random.sample(sites, random.randint(1, len(sites))):
-            item = InventoryItem(product_id=data['product_id'], site_id=site.id)
-
-            version = 1
-            if data.get('version'):
-                version = (data.get('version') + 1)
-            if data.get('id'):
-                id = data.get('id')
-            else:
-                id = self.db.execute(Sequence('inventory_items_id_seq'))
+        for id, (product_id, site) in zip(INVENTORY_ITEM_IDS.take(self.db, len(stocked)), stocked):
+            item = InventoryItem(product_id=product_id, site_id=site.id)
 
             item.id = id
-            item.version = version
-
-            self.db.add(item)
-            self.db.commit()
+            item.version = 1
+            item.on_reorder = False
+            item.committed_stock = 0
+            item.created_at = item.updated_at = now
 
             items.append(item)
 
-        for item_data in [{'id': i.id,
-                           'product_id': i.product_id,
-                           'site_id': i.site_id,
-                           'available_stock': i.available_stock,
-                           'restock_threshold': i.restock_threshold,
-                           'version': i.version,
-                           'max_stock_threshold': i.max_stock_threshold,
-                           'on_reorder': i.on_reorder,
-                           'created_at': i.created_at,
-                           'committed_stock': i.committed_stock,
-                           'updated_at': i.updated_at} for i in items]:
-            self.dispatch(REPLICATE_EVENT, item_data)
+        if not items:
+            return
+
+        documents = [self._item_document(item) for item in items]
+
+        self.db.execute(InventoryItem.__table__.insert().values(documents))
+        record_versions(self.db, items)
+
+        added = {}
+        for item in items:
+            added[item.product_id] = added.get(item.product_id, 0) + item.available_stock
+        self.stock_index.added(added)
+
+        # one event for the whole batch, like catalog imports, the query side flattens it
+        self.outbox(REPLICATE_EVENT, documents)
+
+        self.db.commit()
+
+        logger.info(f'{dt.utcnow()}: {len(items)} inventory items added for {len(product_ids)} products')
 
     @event_handler(None, 'add_item_stock')
     def add_item_stock(self, data):
@@ -211,17 +293,88 @@ class CommandInventoryItem:
 
     @event_handler(ORDER_COMMAND, ORDER_STATUS_CHANGED_TO_PAID)
     def remove_stock_on_order_paid(self, data):
+        """
+        Removes the stock reserved for the order from the sites holding it, every site's new
+        stock is a new inventory item version replicated to the query side. An order paid after
+        its reservation expired reserves again, when the stock was sold meanwhile nothing is
+        removed and order_stock_shortfall tells the orders service what is missing
+        :param data:
+        :return:
+        """
         if isinstance(data, str):
             data = json.loads(data)
 
-        items = data['order_stock_items']
+        order_id = data['order_id']
+
+        # decided from the reservations once locked, the expiry sweep may release them until then
+        versions, removed = commit_reservations(self.db, order_id)
+
+        if not removed and not reserved(self.db, order_id):
+            # validated before reservations existed, or the reservation expired before the payment.
+            # Nothing was written yet, reserve starts over from a clean transaction
+            self.db.rollback()
+
+            units = self._order_units(data)
+            shortages, conflicts = reserve(self.db, order_id, units)
+            self.metrics.inc('stock_reservation_conflicts_total', conflicts)
+
+            if shortages:
+                # sold meanwhile, nothing is removed and the orders service is told what is missing
+                self.metrics.inc('stock_reservations_total', result='paid_short', source='database')
+                logger.warning(f'{dt.utcnow()}: order_id: {order_id} paid without reserved stock, short: {shortages}')
+
+                payload = {'order_id': order_id,
+                           'order_stock_items': [{'product_id': product_id, 'units': units[product_id],
+                                                  'missing': shortages.get(product_id, 0)}
+                                                 for product_id in units]}
+                self.outbox('order_stock_shortfall', payload, aggregate_id=order_id)
+                self.db.commit()
+                return
+
+            self.stock_index.reserved(units)
+            versions, removed = commit_reservations(self.db, order_id)
+
+        self.stock_index.removed(removed)
+
+        for item in versions:
+            self.outbox(REPLICATE_EVENT, self._item_document(item), aggregate_id=item.id)
+
+        self.db.commit()
+
+        logger.info(f'{dt.utcnow()}: order_id: {order_id} stock removed from {len(versions)} inventory items')
+
+    @event_handler(ORDER_COMMAND, ORDER_STATUS_CHANGED_TO_CANCELLED)
+    def release_stock_on_order_cancelled(self, data):
+        """
+        Returns the stock reserved for a cancelled order. When the payment is declined while
+        the stock is checked the orders service cancels again after the confirmation, the
+        second delivery releases what the first could not find yet
+        :param data:
+        :return:
+        """
+        if isinstance(data, str):
+            data = json.loads(data)
+
+        released = release_reservations(self.db, data['order_id'])
+        self.db.commit()
+
+        self.stock_index.released(released)
+
+        if released:
+            logger.info(f'{dt.utcnow()}: order_id: {data["order_id"]} released {sum(released.values())} reserved units')
 
     @event_handler(ORDER_COMMAND, ORDER_STATUS_CHANGED_TO_AWAITING_VERIFICATION)
     def verify_order_item_availability(self, data):
         """
         This method will verify stock across all sites, it will not reject an order
         just because one site does not have the inventory to meet the order's needs,
-        shipping fulfillment will cover the multiple warehouses shipping
+        shipping fulfillment will cover the multiple warehouses shipping.
+
+        The stock of a confirmed order is reserved until the order is paid or cancelled, at the
+        sites nearest its shipping zip code using as few shipments as possible. The sites chosen
+        are sent with confirmed_order_stock. Orders the stock index shows short by more than its
+        drift margin are rejected without reading the stock rows, borderline ones are left to
+        the database
         :param data:
         :return:
         """
@@ -229,83 +382,64 @@ class CommandInventoryItem:
         if isinstance(data, str):
             data = json.loads(data)
 
-        confirmed_order_stock_items = []
+        units = self._order_units(data)
 
-        for i in data['order_stock_items']:
-            subqry = self.db.query(InventoryItem.site_id,
-                                   func.max(InventoryItem.version).label('maxversion')) \
-                .filter(InventoryItem.product_id == i['product_id']) \
-                .group_by(InventoryItem.site_id).subquery('t2')
+        if reserved(self.db, data['order_id']):
+            # delivered again, the stock was reserved by the first delivery
+            shortages = {}
+        else:
+            answers = self.stock_index.check(units)
+            shortages = {product_id: units[product_id] for product_id, in_stock in answers.items()
+                         if in_stock is False}
 
-            inventory_items = self.db.query(InventoryItem) \
-                .filter(InventoryItem.product_id == i['product_id']) \
-                .join(subqry,
-                      (InventoryItem.site_id == subqry.c.site_id) &
-                      (InventoryItem.version == subqry.c.maxversion)) \
-                .all()
+            if shortages:
+                # short by more than the index can have drifted, the stock rows aren't read
+                source = 'index'
+            else:
+                source = 'database'
+                strategy = SITE_ALLOCATOR.for_order(self.db, data.get('zip_code'))
+                shortages, conflicts = reserve(self.db, data['order_id'], units, strategy=strategy)
+                self.metrics.inc('stock_reservation_conflicts_total', conflicts)
 
-            inventory_items = Enumerable(inventory_items)
-            inventory_count = inventory_items.sum(lambda x: x.available_stock)
+                if not shortages:
+                    self.stock_index.reserved(units)
 
-            has_stock = inventory_count >= i['units']
-            confirmed_order_stock_items.append({'product_id': i['product_id'],
-                                                'has_stock': has_stock})
+            self.metrics.inc('stock_reservations_total', result='rejected' if shortages else 'reserved', source=source)
 
-        rejected = all(item['has_stock'] for item in confirmed_order_stock_items)
+        confirmed_order_stock_items = [{'product_id': product_id, 'has_stock': product_id not in shortages}
+                                       for product_id in units]
 
-        if not rejected:
+        if shortages:
             payload = {'order_id': data['order_id'],
                        'order_stock_items': confirmed_order_stock_items}
-            self.dispatch('rejected_order_stock', payload)
+            self.outbox('rejected_order_stock', payload, aggregate_id=data['order_id'])
         else:
-            self.dispatch('confirmed_order_stock', {'order_id': data['order_id']})
+            payload = {'order_id': data['order_id'],
+                       'allocation': reservations_of(self.db, data['order_id'])}
+            self.outbox('confirmed_order_stock', payload, aggregate_id=data['order_id'])
+
+        self.db.commit()
 
 
 class QueryInventoryItems:
     name = ITEM_QUERY
+    metrics = Metrics()
 
-    @event_handler(ITEM_COMMAND, REPLICATE_EVENT)
-    def normalize_db(self, data):
-        if isinstance(data, str):
-            data = json.loads(data)
-
+    @batch_event_handler(ITEM_COMMAND, REPLICATE_EVENT)
+    def normalize_db(self, payloads):
+        """ writes a batch of replicated inventory items with one bulk upsert, raising requeues the batch """
         try:
-            item = InventoryItemQueryModel.objects.get(id=data['id'])
-
-            item.update(
-                version=data['version'],
-                product_id=data['product_id'],
-                site_id=data['site_id'],
-                available_stock=data['available_stock'],
-                max_stock_threshold=data['max_stock_threshold'],
-                restock_threshold=data['restock_threshold'],
-                committed_stock=data['committed_stock'],
-                on_reorder=data['on_reorder'],
-                updated_at=data['updated_at']
-            )
-
-            item.reload()
-            logger.info(f'{dt.utcnow()}: Inventory Item {data["id"]} updated to Version {data["version"]} in queryDB')
-        except DoesNotExist:  # mongoengine.DoesNotExist
-            logger.info(
-                f'{dt.utcnow()}: Inventory Item {data["id"]} did not exist for site {data["site_id"]}, creating now.')
-            InventoryItemQueryModel(
-                id=data['id'],
-                version=data['version'],
-                product_id=data['product_id'],
-                site_id=data['site_id'],
-                available_stock=data['available_stock'],
-                max_stock_threshold=data['max_stock_threshold'],
-                restock_threshold=data['restock_threshold'],
-                committed_stock=data['committed_stock'],
-                on_reorder=data['on_reorder'],
-                created_at=data['created_at'],
-                updated_at=data['updated_at']
-            ).save()
-            logger.info(f'{dt.utcnow()}: Inventory Item {data["id"]} added to queryDB for site {data["site_id"]}.')
+            count = apply_batch(InventoryItemQueryModel, payloads, self._projection)
+            logger.info(f'{dt.utcnow()}: {count} Inventory Items replicated in queryDB')
         except Exception as e:
             logger.info(f'{dt.utcnow()}: There was a problem replicating to the Query DB: {e}')
-            return e
+            raise
+
+    @staticmethod
+    def _projection(data):
+        # every stock change appends a new row version, so each event is a complete snapshot of the item
+        return Projection({name: data[name] for name in INVENTORY_FIELDS}, on_insert={'created_at': data['created_at']},
+                          version=data['version'])
 
     @rpc
     def get_by_product_id(self, product_id):
@@ -313,19 +447,19 @@ class QueryInventoryItems:
         return items.to_json()
 
     @rpc
-    def get_by_site_id(self, site_id, num_page=1, limit=10):
-        if not num_page:
-            num_page = 1
-        offset = (num_page - 1) * limit
-
-        items = (InventoryItemQueryModel.objects(site_id=site_id)
-                 .skip(offset)
-                 .limit(limit))
-        return items.to_json()
+    def get_by_site_id(self, site_id, after=None, limit=None):
+        """ returns a page of the inventory held at a site """
+        return keyset_page(InventoryItemQueryModel.objects(site_id=site_id), after, limit)
 
 
 class InventoryApi:
     name = 'inventory_api'
+    metrics = Metrics()
+
+    @http('GET', '/metrics')
+    def get_metrics(self, request):
+        """ latency, error and worker saturation metrics of every service in this process """
+        return metrics_response()
 
     @http('GET', '/inventory/<int:product_id>')
     def get_inventory_items_by_product_id(self, request, product_id):
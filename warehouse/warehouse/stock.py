@@ -0,0 +1,441 @@
+import logging
+import os
+import random
+import time
+from datetime import datetime as dt, timedelta
+
+from sqlalchemy import func, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import InventoryStock, StockReservation
+
+logger = logging.getLogger(__name__)
+
+# superseded inventory item versions are kept this long before compaction prunes them
+INVENTORY_RETENTION_HOURS = float(os.getenv('INVENTORY_RETENTION_HOURS', 24 * 7))
+INVENTORY_COMPACTION_INTERVAL = float(os.getenv('INVENTORY_COMPACTION_INTERVAL', 300))
+INVENTORY_COMPACTION_BATCH_SIZE = int(os.getenv('INVENTORY_COMPACTION_BATCH_SIZE', 5000))
+
+# a reservation skipping rows locked by other orders retries this many times, the last attempt waits for the locks
+RESERVATION_ATTEMPTS = int(os.getenv('RESERVATION_ATTEMPTS', 4))
+RESERVATION_BACKOFF = float(os.getenv('RESERVATION_BACKOFF', 0.005))
+
+# stock reserved for an order which is not paid by then goes back to the sites
+RESERVATION_TTL_SECONDS = float(os.getenv('RESERVATION_TTL_SECONDS', 900))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv('RESERVATION_SWEEP_INTERVAL', 5))
+RESERVATION_SWEEP_BATCH_SIZE = int(os.getenv('RESERVATION_SWEEP_BATCH_SIZE', 500))
+
+STOCK_FIELDS = ('version', 'on_reorder', 'restock_threshold', 'max_stock_threshold', 'available_stock',
+                'committed_stock', 'updated_at')
+
+_PRUNE_SUPERSEDED = text("""
+    DELETE FROM inventory_items WHERE ctid IN (
+        SELECT i.ctid
+        FROM inventory_items i
+        JOIN inventory_stock s ON s.product_id = i.product_id AND s.site_id = i.site_id
+        WHERE i.version < s.version AND i.updated_at < :cutoff
+        LIMIT :batch_size
+        FOR UPDATE OF i SKIP LOCKED)
+""")
+
+_PRUNE_PAID_RESERVATIONS = text("""
+    DELETE FROM stock_reservations WHERE id IN (
+        SELECT id
+        FROM stock_reservations
+        WHERE paid_at < :cutoff
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED)
+""")
+
+
+def record_versions(session, items):
+    """
+    Makes the inventory items the current stock of their (product, site), in the caller's
+    transaction. A version older than the one already current is ignored, so concurrent
+    writers can't move the stock backwards
+    :param session:
+    :param items: flushed InventoryItem versions
+    :return:
+    """
+    if not items:
+        return
+
+    rows = [{'product_id': item.product_id,
+             'site_id': item.site_id,
+             'inventory_item_id': item.id,
+             'version': item.version,
+             'on_reorder': item.on_reorder,
+             'restock_threshold': item.restock_threshold,
+             'max_stock_threshold': item.max_stock_threshold,
+             'available_stock': item.available_stock,
+             'committed_stock': item.committed_stock,
+             'created_at': item.created_at,
+             'updated_at': item.updated_at} for item in items]
+
+    statement = insert(InventoryStock).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[InventoryStock.product_id, InventoryStock.site_id],
+        set_={name: statement.excluded[name] for name in STOCK_FIELDS + ('inventory_item_id',)},
+        where=InventoryStock.version < statement.excluded.version)
+
+    session.execute(statement)
+
+
+def available_stock(session, product_ids):
+    """
+    Stock neither sold nor reserved across all sites for every product in product_ids, one
+    statement over the primary key of inventory_stock
+    :param session:
+    :param product_ids:
+    :return: {product_id: free stock}, products without inventory are missing
+    """
+    return dict(session.query(InventoryStock.product_id,
+                              func.sum(InventoryStock.available_stock - InventoryStock.committed_stock))
+                .filter(InventoryStock.product_id.in_(product_ids))
+                .group_by(InventoryStock.product_id))
+
+
+def _allocate(stocks, units):
+    """
+    Takes the units of every product from its sites in the order given
+    :param stocks: stock rows by product, the preferred site first
+    :param units: {product_id: units}
+    :return: ([(stock, units taken)], {product_id: units missing})
+    """
+    allocation = []
+    remaining = dict(units)
+
+    for stock in stocks:
+        wanted = remaining.get(stock.product_id, 0)
+        taken = min(wanted, stock.free_stock)
+
+        if taken > 0:
+            allocation.append((stock, taken))
+            remaining[stock.product_id] = wanted - taken
+
+    return allocation, {product_id: missing for product_id, missing in remaining.items() if missing > 0}
+
+
+def by_free_stock(stocks, units):
+    """ takes every product from the sites with the most free stock first """
+    return sorted(stocks, key=lambda stock: (stock.product_id, -stock.free_stock))
+
+
+def reserved(session, order_id):
+    """ whether stock was reserved for the order, the reservation may since have been paid """
+    return session.query(StockReservation.id).filter(StockReservation.order_id == order_id).first() is not None
+
+
+def _candidates(session, units, strategy):
+    """
+    The stock rows with free units of the products, read without locking them, in the order
+    strategy takes units from them. Rows are (product_id, site_id, free_stock) tuples
+    """
+    free = InventoryStock.available_stock - InventoryStock.committed_stock
+
+    stocks = session.query(InventoryStock.product_id, InventoryStock.site_id, free.label('free_stock')) \
+        .filter(InventoryStock.product_id.in_(list(units)), free > 0) \
+        .order_by(InventoryStock.product_id, InventoryStock.site_id) \
+        .all()
+
+    return strategy(stocks, units)
+
+
+def _lock_stock(session, product_id, site_id):
+    """ the stock row of a product at a site when it has units free and no other order holds it, locked """
+    return session.query(InventoryStock) \
+        .filter(InventoryStock.product_id == product_id, InventoryStock.site_id == site_id,
+                InventoryStock.available_stock - InventoryStock.committed_stock > 0) \
+        .populate_existing() \
+        .with_for_update(skip_locked=True) \
+        .first()
+
+
+def _lock_stocks(session, keys):
+    """ the stock rows of [(product_id, site_id)], locked in key order waiting for other orders """
+    if not keys:
+        return {}
+
+    return {(stock.product_id, stock.site_id): stock for stock in
+            session.query(InventoryStock)
+            .filter(tuple_(InventoryStock.product_id, InventoryStock.site_id).in_(sorted(keys)))
+            .order_by(InventoryStock.product_id, InventoryStock.site_id)
+            .populate_existing()
+            .with_for_update()}
+
+
+def _take_unlocked(session, candidates, units):
+    """
+    Takes the units from the candidates in order, locking one row at a time and passing over
+    the rows other orders hold. Never waits for a lock, so the order the rows are locked in
+    can't deadlock
+    :return: ([(stock, units taken)], {product_id: units missing})
+    """
+    allocation = []
+    remaining = dict(units)
+
+    for candidate in candidates:
+        wanted = remaining.get(candidate.product_id, 0)
+        if wanted <= 0:
+            continue
+
+        stock = _lock_stock(session, candidate.product_id, candidate.site_id)
+        if stock is None:
+            continue
+
+        taken = min(wanted, stock.free_stock)
+        allocation.append((stock, taken))
+        remaining[candidate.product_id] = wanted - taken
+
+    return allocation, {product_id: missing for product_id, missing in remaining.items() if missing > 0}
+
+
+def _take_waiting(session, candidates, units):
+    """
+    Takes the units from the candidates in order, waiting for the rows other orders hold, from
+    the stock the rows have once locked. The rows the candidates were planned on are locked
+    first, when what they have now falls short the transaction starts over locking every
+    candidate. Either way the rows are locked in key order from a fresh transaction, so it
+    can't deadlock, and the order is short only when all the locked rows are
+    :return: ([(stock, units taken)], {product_id: units missing})
+    """
+    planned, shortages = _allocate(candidates, units)
+    keys = [(candidate.product_id, candidate.site_id) for candidate in candidates]
+
+    if not shortages:
+        locked = _lock_stocks(session, {(candidate.product_id, candidate.site_id) for candidate, _ in planned})
+        allocation, shortages = _allocate([locked[key] for key in keys if key in locked], units)
+        if not shortages:
+            return allocation, {}
+
+        session.rollback()
+
+    locked = _lock_stocks(session, set(keys))
+    return _allocate([locked[key] for key in keys if key in locked], units)
+
+
+def reserve(session, order_id, units, attempts=RESERVATION_ATTEMPTS, ttl=RESERVATION_TTL_SECONDS,
+            strategy=by_free_stock):
+    """
+    Reserves the units of every product for an order, across as many sites as needed, or
+    nothing when a product is short. The sites are chosen from the stock read without locks,
+    then only the rows units are taken from are locked, one at a time with SKIP LOCKED, so
+    orders of the same product take different sites instead of queueing on one row, and
+    orders of other products never wait on it. When rows another order holds are needed the
+    transaction is rolled back and retried after a short backoff, the last attempt waits for
+    the rows, in key order so it can't deadlock, and takes the units from what they hold once
+    locked. Must be called before the caller writes anything, retries roll the session back
+    :param session:
+    :param order_id:
+    :param units: {product_id: units}
+    :param attempts:
+    :param ttl: seconds the reservation is held for when the order is not paid
+    :param strategy: callable(stocks, units) returning the stock rows in the order units are taken from them
+    :return: ({product_id: units missing}, empty when reserved, number of retries)
+    """
+    conflicts = 0
+
+    for attempt in range(1, attempts + 1):
+        candidates = _candidates(session, units, strategy)
+
+        if attempt < attempts:
+            allocation, shortages = _take_unlocked(session, candidates, units)
+        else:
+            allocation, shortages = _take_waiting(session, candidates, units)
+
+        if not shortages:
+            expires_at = dt.utcnow() + timedelta(seconds=ttl)
+            for stock, taken in allocation:
+                stock.committed_stock += taken
+                session.add(StockReservation(order_id=order_id, product_id=stock.product_id,
+                                             site_id=stock.site_id, units=taken, expires_at=expires_at))
+            session.flush()
+            return {}, conflicts
+
+        session.rollback()
+
+        # short even counting the rows other orders hold, waiting for them won't help
+        total = available_stock(session, list(shortages))
+        if attempt == attempts or any(total.get(product_id, 0) < units[product_id] for product_id in shortages):
+            session.rollback()
+            return shortages, conflicts
+
+        conflicts += 1
+        time.sleep(random.uniform(0, RESERVATION_BACKOFF * attempt))
+
+
+def reservations_of(session, order_id):
+    """ the sites an order's stock is reserved at, [{'product_id', 'site_id', 'units'}] """
+    return [{'product_id': product_id, 'site_id': site_id, 'units': units}
+            for product_id, site_id, units in
+            session.query(StockReservation.product_id, StockReservation.site_id, StockReservation.units)
+            .filter(StockReservation.order_id == order_id)
+            .order_by(StockReservation.id)]
+
+
+def _lock_reservations(session, order_id):
+    """ the unpaid reservations of an order and the stock rows they hold, locked """
+    reservations = session.query(StockReservation) \
+        .filter(StockReservation.order_id == order_id, StockReservation.paid_at.is_(None)) \
+        .order_by(StockReservation.id) \
+        .with_for_update() \
+        .all()
+
+    units = {}
+    for reservation in reservations:
+        key = (reservation.product_id, reservation.site_id)
+        units[key] = units.get(key, 0) + reservation.units
+
+    stocks = []
+    if units:
+        stocks = session.query(InventoryStock) \
+            .filter(tuple_(InventoryStock.product_id, InventoryStock.site_id).in_(list(units))) \
+            .order_by(InventoryStock.product_id, InventoryStock.site_id) \
+            .with_for_update() \
+            .all()
+
+    return reservations, units, stocks
+
+
+def _by_product(units):
+    """ adds up {(product_id, site_id): units} per product """
+    products = {}
+    for (product_id, _), count in units.items():
+        products[product_id] = products.get(product_id, 0) + count
+    return products
+
+
+def commit_reservations(session, order_id):
+    """
+    Removes the stock reserved for a paid order. Every stock row changed gets a new
+    inventory_items version, which becomes its current stock. The reservations are marked
+    paid and kept as the record that the order's stock was removed, so a paid event delivered
+    again finds no unpaid reservations and changes nothing
+    :param session:
+    :param order_id:
+    :return: (the new InventoryItem versions, {product_id: units removed})
+    """
+    reservations, units, stocks = _lock_reservations(session, order_id)
+
+    versions = []
+    for stock in stocks:
+        reserved_units = units[(stock.product_id, stock.site_id)]
+
+        item = stock.next_version()
+        item.committed_stock -= reserved_units
+        item.remove_stock(reserved_units)
+
+        session.add(item)
+        versions.append(item)
+
+    paid_at = dt.utcnow()
+    for reservation in reservations:
+        reservation.paid_at = paid_at
+        reservation.updated_at = paid_at
+
+    session.flush()
+    record_versions(session, versions)
+
+    return versions, _by_product(units)
+
+
+def release_reservations(session, order_id):
+    """
+    Returns the stock reserved for a cancelled order, a cancellation delivered again
+    finds nothing left to release
+    :param session:
+    :param order_id:
+    :return: {product_id: units released}
+    """
+    reservations, units, stocks = _lock_reservations(session, order_id)
+
+    for stock in stocks:
+        stock.committed_stock -= units[(stock.product_id, stock.site_id)]
+
+    for reservation in reservations:
+        session.delete(reservation)
+
+    session.flush()
+
+    return _by_product(units)
+
+
+def expire_reservations(session, batch_size=RESERVATION_SWEEP_BATCH_SIZE):
+    """
+    Releases the reservations of orders which were neither paid nor cancelled before they
+    expired, reading only the due ones from ix_stock_reservations_unpaid_expires_at. Every
+    batch of orders is committed on its own. An order paid meanwhile has nothing left to
+    release, one paid after its reservation expired reserves again when it is paid
+    :param session:
+    :param batch_size: reservations read per batch
+    :return: {product_id: units released}
+    """
+    released = {}
+
+    while True:
+        due = session.query(StockReservation.order_id) \
+            .filter(StockReservation.paid_at.is_(None), StockReservation.expires_at < dt.utcnow()) \
+            .order_by(StockReservation.expires_at) \
+            .limit(batch_size) \
+            .all()
+
+        for order_id in {order_id for order_id, in due}:
+            for product_id, units in release_reservations(session, order_id).items():
+                released[product_id] = released.get(product_id, 0) + units
+        session.commit()
+
+        if len(due) < batch_size:
+            break
+
+    if released:
+        logger.info(f'{dt.utcnow()}: {sum(released.values())} expired reserved units released')
+
+    return released
+
+
+def compact(session, retention=timedelta(hours=INVENTORY_RETENTION_HOURS),
+            batch_size=INVENTORY_COMPACTION_BATCH_SIZE):
+    """
+    Prunes inventory item versions which are no longer current and older than retention, in
+    batches of batch_size each committed on its own so the row locks are short lived. The
+    current version of every (product, site) is never removed
+    :param session:
+    :param retention:
+    :param batch_size:
+    :return: number of rows pruned
+    """
+    count = _prune(session, _PRUNE_SUPERSEDED, dt.utcnow() - retention, batch_size)
+
+    if count:
+        logger.info(f'{dt.utcnow()}: {count} superseded inventory item versions pruned')
+
+    return count
+
+
+def prune_paid_reservations(session, retention=timedelta(hours=INVENTORY_RETENTION_HOURS),
+                            batch_size=INVENTORY_COMPACTION_BATCH_SIZE):
+    """
+    Deletes the reservations of orders paid longer than retention ago, they are kept until
+    then so a paid event delivered again doesn't remove the stock twice
+    :param session:
+    :param retention:
+    :param batch_size:
+    :return: number of rows pruned
+    """
+    return _prune(session, _PRUNE_PAID_RESERVATIONS, dt.utcnow() - retention, batch_size)
+
+
+def _prune(session, statement, cutoff, batch_size):
+    """ runs a batched delete until it removes fewer than batch_size rows, committing every batch """
+    count = 0
+
+    while True:
+        pruned = session.execute(statement, {'cutoff': cutoff, 'batch_size': batch_size}).rowcount
+        session.commit()
+
+        count += pruned
+
+        if pruned < batch_size:
+            break
+
+    return count
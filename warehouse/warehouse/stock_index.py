@@ -0,0 +1,230 @@
+import logging
+import os
+import threading
+from datetime import datetime as dt
+
+from nameko.extensions import DependencyProvider
+from sqlalchemy import func
+
+from .models import InventoryStock
+
+logger = logging.getLogger(__name__)
+
+# the most the index is expected to drift from the database between two consistency checks, it
+# answers only when the free stock is at least this many units away from the order, closer than
+# that the stock is read from the database
+STOCK_INDEX_MARGIN = int(os.getenv('STOCK_INDEX_MARGIN', 10))
+STOCK_INDEX_CHECK_INTERVAL = float(os.getenv('STOCK_INDEX_CHECK_INTERVAL', 60))
+
+
+def stock_totals(session):
+    """ {product_id: (available, reserved)} of all sites, from the current stock """
+    return {product_id: (available, reserved) for product_id, available, reserved in
+            session.query(InventoryStock.product_id,
+                          func.sum(InventoryStock.available_stock),
+                          func.sum(InventoryStock.committed_stock))
+            .group_by(InventoryStock.product_id)}
+
+
+class StockTotals(object):
+    """
+    Thread-safe map of product_id to the available and reserved units of all sites, shared by
+    the workers of a service
+    """
+
+    def __init__(self):
+        self.loaded = False
+
+        self._totals = {}
+        # changes applied while the totals are read from the database, None when not reloading
+        self._replay = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    @staticmethod
+    def _add(totals, deltas):
+        for product_id, (available, reserved) in deltas.items():
+            units = totals.setdefault(product_id, [0, 0])
+            units[0] += available
+            units[1] += reserved
+
+    def reload(self, read):
+        """
+        Replaces the totals with the ones read from the database. Changes applied while they are
+        read are applied again on top, a change committed before the read is counted twice only
+        when its worker had not applied it yet, until the next reload
+        :param read: callable returning {product_id: (available, reserved)}
+        :return: {product_id: ((available, reserved) in the index, (available, reserved) read)} of
+        the products which differed, empty when nothing was loaded before
+        """
+        with self._reload_lock:
+            with self._lock:
+                self._replay = {}
+
+            try:
+                actual = read()
+            finally:
+                with self._lock:
+                    replay, self._replay = self._replay, None
+
+            with self._lock:
+                # the index as it was when the totals were read
+                indexed = {product_id: (units[0] - replay.get(product_id, (0, 0))[0],
+                                        units[1] - replay.get(product_id, (0, 0))[1])
+                           for product_id, units in self._totals.items()}
+                was_loaded = self.loaded
+
+                self._totals = {product_id: list(units) for product_id, units in actual.items()}
+                self._add(self._totals, replay)
+                self.loaded = True
+
+        if not was_loaded:
+            return {}
+
+        return {product_id: (indexed.get(product_id), actual.get(product_id))
+                for product_id in set(indexed) | set(actual)
+                if indexed.get(product_id, (0, 0)) != tuple(actual.get(product_id, (0, 0)))}
+
+    def ensure_loaded(self, read):
+        """ loads the totals unless they are, for when loading them at start failed """
+        if not self.loaded:
+            self.reload(read)
+
+    def apply(self, deltas):
+        """ :param deltas: {product_id: (available change, reserved change)} """
+        with self._lock:
+            self._add(self._totals, deltas)
+            if self._replay is not None:
+                self._add(self._replay, deltas)
+
+    def free(self, product_id):
+        with self._lock:
+            units = self._totals.get(product_id)
+            return None if units is None else units[0] - units[1]
+
+
+class StockIndexView(object):
+    """
+    What a worker sees of the stock index. Stock changes are collected here and applied to
+    the shared totals only when the worker succeeds, after its transaction committed
+    """
+
+    def __init__(self, totals, session, margin):
+        self.totals = totals
+        self.session = session
+        self.margin = margin
+        self.deltas = {}
+
+    def _read(self):
+        return stock_totals(self.session())
+
+    def check(self, units):
+        """
+        An order short of a product by more than the margin is short whatever the index missed,
+        it is rejected without reading the stock rows. The rest is reserved from the database
+        :param units: {product_id: units ordered}
+        :return: {product_id: True in stock, False short, None too close to tell or not indexed}
+        """
+        self.totals.ensure_loaded(self._read)
+
+        answers = {}
+        for product_id, wanted in units.items():
+            free = self.totals.free(product_id)
+
+            if free is None or abs(free - wanted) < self.margin:
+                answers[product_id] = None
+            else:
+                answers[product_id] = free >= wanted
+
+        return answers
+
+    def _change(self, units, available, reserved):
+        for product_id, count in units.items():
+            change = self.deltas.setdefault(product_id, [0, 0])
+            change[0] += available * count
+            change[1] += reserved * count
+
+    def added(self, units):
+        """ new stock of {product_id: units} """
+        self._change(units, 1, 0)
+
+    def reserved(self, units):
+        self._change(units, 0, 1)
+
+    def released(self, units):
+        self._change(units, 0, -1)
+
+    def removed(self, units):
+        """ reserved units sold, they leave both the available and the reserved stock """
+        self._change(units, -1, -1)
+
+    def drift(self):
+        """
+        Compares the index with the current stock in the database and reloads it from there
+        :return: {product_id: ((available, reserved) in the index, (available, reserved) in the db)}
+        """
+        return self.totals.reload(self._read)
+
+
+class StockIndex(DependencyProvider):
+    """
+    In-memory index of the available and reserved stock of every product, loaded from
+    inventory_stock when the service starts and kept up to date with the stock changes of
+    this service's workers.
+
+    Changes made by other replicas, or lost when a worker fails after committing, are not
+    seen until check_consistency reloads the index. The margin bounds that drift: only an
+    order short by more than the margin is rejected from the index, closer ones are left to
+    the database.
+    """
+
+    def __init__(self, session='db', margin=STOCK_INDEX_MARGIN):
+        self.session = session
+        self.margin = margin
+        self.totals = StockTotals()
+        self._views = {}
+
+    def start(self):
+        # no worker is running yet, the totals are read with a session of the service's DatabaseSession
+        provider = next(dependency for dependency in self.container.dependencies
+                        if dependency.attr_name == self.session)
+        session = provider.Session()
+
+        try:
+            self.totals.reload(lambda: stock_totals(session))
+            logger.info(f'{dt.utcnow()}: stock index loaded')
+        except Exception as e:
+            logger.error(f'{dt.utcnow()}: stock index not loaded at start, the first worker using it loads it: {e}')
+        finally:
+            session.close()
+
+    def get_dependency(self, worker_ctx):
+        view = StockIndexView(self.totals, lambda: getattr(worker_ctx.service, self.session), self.margin)
+        self._views[worker_ctx] = view
+        return view
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        view = self._views.pop(worker_ctx, None)
+
+        if view is not None and exc_info is None and view.deltas:
+            self.totals.apply(view.deltas)
+
+    def worker_teardown(self, worker_ctx):
+        self._views.pop(worker_ctx, None)
+
+
+def check_consistency(view):
+    """
+    Reports the products whose indexed stock differs from the database and repairs them
+    :param view: StockIndexView of the checking worker
+    :return: number of products which drifted
+    """
+    drifted = view.drift()
+
+    for product_id, (indexed, actual) in list(drifted.items())[:20]:
+        logger.info(f'{dt.utcnow()}: stock index drift for product {product_id}: index {indexed}, database {actual}')
+
+    if drifted:
+        logger.info(f'{dt.utcnow()}: stock index reloaded, {len(drifted)} products had drifted')
+
+    return len(drifted)